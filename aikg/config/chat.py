@@ -29,6 +29,16 @@ class ChatConfig(BaseModel):
         num_output: The number of outputs to generate.
         max_chunk_overlap: The maximum number of tokens to overlap between chunks.
         prompt_template: The template for the prompt to inject into the model. The template should contain the following variables: context_str, query_str.
+        answer_cache_threshold: The minimum cosine similarity between two questions for a cached answer to be reused.
+        answer_cache_size: The maximum number of answers kept in the cache. Set to 0 to disable the cache.
+        answer_cache_ttl: The number of seconds after which cached answers expire.
+        answer_cache_check_interval: The number of seconds between checks for a rebuilt vector index, which invalidates cached answers.
+        n_workers: The number of threads running blocking operations (embedding, vector store lookups, local RDF queries) in the server.
+        max_connections: The maximum number of concurrent connections from the server to the SPARQL endpoint.
+        context_token_budget: The maximum number of tokens of ontology triples given as context to generate SPARQL queries. Triples are ranked by relevance to the question and the least relevant ones are dropped. Set to 0 to disable the limit.
+        result_token_budget: The maximum number of tokens of query results given to the LLM to generate answers. Larger results are replaced by a summary with column statistics and a sample of rows. Set to 0 to disable the limit.
+        metrics_enabled: Whether the server records stage timings, token counts and cache statistics, exported on /metrics.
+        admin_token: Token which clients must send as a bearer token to clear the server caches on /cache/invalidate/. If empty, the endpoint is disabled.
     """
 
     openai_api_base: str = os.environ.get(
@@ -36,6 +46,20 @@ class ChatConfig(BaseModel):
     )
     openai_api_key: str = os.environ.get("OPENAI_API_KEY", "")
     model: str = os.environ.get("OPENAI_MODEL", "gpt-4o")
+    answer_cache_threshold: float = float(
+        os.environ.get("CHAT_ANSWER_CACHE_THRESHOLD", "0.95")
+    )
+    answer_cache_size: int = int(os.environ.get("CHAT_ANSWER_CACHE_SIZE", "1024"))
+    answer_cache_ttl: float = float(os.environ.get("CHAT_ANSWER_CACHE_TTL", "3600"))
+    answer_cache_check_interval: float = float(
+        os.environ.get("CHAT_ANSWER_CACHE_CHECK_INTERVAL", "30")
+    )
+    n_workers: int = int(os.environ.get("CHAT_N_WORKERS", "8"))
+    max_connections: int = int(os.environ.get("CHAT_MAX_CONNECTIONS", "20"))
+    context_token_budget: int = int(os.environ.get("CHAT_CONTEXT_TOKENS", "3000"))
+    result_token_budget: int = int(os.environ.get("CHAT_RESULT_TOKENS", "2000"))
+    metrics_enabled: bool = os.environ.get("CHAT_METRICS", "false").lower() == "true"
+    admin_token: str = os.environ.get("CHAT_ADMIN_TOKEN", "")
     answer_template: str = """
 We have provided the contextual facts below.
 -----------------
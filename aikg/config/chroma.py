@@ -34,8 +34,24 @@ class ChromaConfig(BaseModel):
             The HuggingFace ID of the embedding model to use.
         batch_size:
             The number of documents to vectorize and store in each batch.
+        n_workers:
+            The number of threads computing embeddings concurrently when building the index. A single embedding call already runs on all CPU cores through torch, so more workers oversubscribe the cores on CPU-only machines. Increase it when embeddings are computed on a GPU or by a remote service, where workers overlap waiting times.
+        queue_size:
+            The maximum number of batches waiting between two stages of the index build.
+        subject_batch_size:
+            The number of subjects whose triples are fetched from the SPARQL endpoint in each query.
+        page_size:
+            The number of result rows fetched from the SPARQL endpoint in each query when listing subjects. Set to 0 to disable pagination.
         persist_directory:
             If set to client-only mode, local path where the db is saved.
+        embedding_cache:
+            Path to a SQLite file where computed embeddings are cached. If empty, embeddings are not cached.
+        embedding_cache_size:
+            The maximum number of embeddings kept in the cache.
+        query_cache_size:
+            The maximum number of question embeddings kept in memory by the chat server.
+        query_cache_ttl:
+            The number of seconds after which cached question embeddings expire.
     """
 
     host: str = os.environ.get("CHROMA_HOST", "127.0.0.1")
@@ -43,5 +59,15 @@ class ChromaConfig(BaseModel):
     collection_name: str = os.environ.get("CHROMA_COLLECTION", "schema")
     collection_examples: str = os.environ.get("CHROMA_EXAMPLES", "examples")
     batch_size: int = int(os.environ.get("CHROMA_BATCH_SIZE", "50"))
+    n_workers: int = int(os.environ.get("CHROMA_N_WORKERS", "1"))
+    queue_size: int = int(os.environ.get("CHROMA_QUEUE_SIZE", "4"))
+    subject_batch_size: int = int(os.environ.get("CHROMA_SUBJECT_BATCH_SIZE", "500"))
+    page_size: int = int(os.environ.get("CHROMA_PAGE_SIZE", "10000"))
     embedding_model: str = os.environ.get("CHROMA_MODEL", "all-mpnet-base-v2")
     persist_directory: str = os.environ.get("CHROMA_PERSIST_DIR", ".chroma/")
+    embedding_cache: str = os.environ.get("CHROMA_EMBEDDING_CACHE", "")
+    embedding_cache_size: int = int(
+        os.environ.get("CHROMA_EMBEDDING_CACHE_SIZE", "1000000")
+    )
+    query_cache_size: int = int(os.environ.get("CHROMA_QUERY_CACHE_SIZE", "1024"))
+    query_cache_ttl: float = float(os.environ.get("CHROMA_QUERY_CACHE_TTL", "3600"))
@@ -26,6 +26,30 @@ class SparqlConfig(BaseModel):
         repo: The name of the repository or dataset to query.
         user: The username to use for authentication.
         password: The password to use for authentication.
+        load_chunk_size: Number of statements sent per request when loading data.
+        load_concurrency: Number of requests in flight when loading data.
+        load_retries: Number of retries of a failed request when loading data.
+        load_retry_backoff: Delay before the first retry, in seconds.
+        load_mode: How data is sent when loading, either "insert" for SPARQL
+            INSERT DATA queries, or "upload" to post N-Triples / N-Quads directly.
+        upload_endpoint: URL receiving RDF uploads in "upload" mode, e.g. a graph
+            store endpoint. Defaults to the update endpoint, <endpoint>/statements.
+        query_cache_size: The maximum number of query results cached by the chat
+            server. Set to 0 to disable the cache.
+        query_cache_ttl: The number of seconds after which cached query results expire.
+        max_rows: The maximum number of result rows of generated queries. Queries
+            get a LIMIT clause if they have none, and results are truncated.
+        max_bytes: The maximum size of the results of generated queries, in bytes.
+        query_timeout: The number of seconds after which generated queries are aborted.
+        result_format: Format of the results of SELECT queries sent by the endpoint to
+            the server: "csv", or "tsv" / "json" for typed columnar results.
+        generation_file: File storing the generation of the knowledge graph, bumped
+            by the insert flow after each load to invalidate cached query results.
+            Relative paths are resolved against the working directory, so the server
+            and the insert flow must run on a shared filesystem from the same
+            directory, or use an absolute path on a shared volume. The kubernetes
+            deployment does not provide this: there, use /cache/invalidate/ instead
+            (see ChatConfig.admin_token).
     """
 
     endpoint: str = os.environ.get(
@@ -34,3 +58,20 @@ class SparqlConfig(BaseModel):
 
     user: str = os.environ.get("SPARQL_USER", "admin")
     password: str = os.environ.get("SPARQL_PASSWORD", "admin")
+    load_chunk_size: int = int(os.environ.get("SPARQL_LOAD_CHUNK_SIZE", "1000"))
+    load_concurrency: int = int(os.environ.get("SPARQL_LOAD_CONCURRENCY", "4"))
+    load_retries: int = int(os.environ.get("SPARQL_LOAD_RETRIES", "3"))
+    load_retry_backoff: float = float(
+        os.environ.get("SPARQL_LOAD_RETRY_BACKOFF", "1.0")
+    )
+    load_mode: str = os.environ.get("SPARQL_LOAD_MODE", "insert")
+    upload_endpoint: str = os.environ.get("SPARQL_UPLOAD_ENDPOINT", "")
+    query_cache_size: int = int(os.environ.get("SPARQL_QUERY_CACHE_SIZE", "256"))
+    query_cache_ttl: float = float(os.environ.get("SPARQL_QUERY_CACHE_TTL", "600"))
+    max_rows: int = int(os.environ.get("SPARQL_MAX_ROWS", "1000"))
+    max_bytes: int = int(os.environ.get("SPARQL_MAX_BYTES", "1000000"))
+    query_timeout: float = float(os.environ.get("SPARQL_QUERY_TIMEOUT", "30"))
+    result_format: str = os.environ.get("SPARQL_RESULT_FORMAT", "csv")
+    generation_file: str = os.environ.get(
+        "SPARQL_GENERATION_FILE", ".sparql_generation"
+    )
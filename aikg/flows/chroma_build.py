@@ -19,31 +19,33 @@
 
 For each subject in the target graph, a document is generated. The document consists of:
 * A human readable body made up of the annotations (rdfs:comment, rdf:label) associated with the subject.
-* Triples with the subject attached as metadata.
+* Triples with the subject attached as metadata, both in N-Triples and in a compact
+  prefixed turtle form which is given as is to the LLM.
 
 The documents are then stored in a vector database. The embedding is computed using the document body,
 and triples included as metadata. The index is persisted to disk and can be subsequently loaded into memory
 for querying."""
 
+from functools import partial
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple
 from typing_extensions import Annotated
-import uuid
 
 from chromadb.api import ClientAPI, Collection
+from chromadb.api.types import Embedding, EmbeddingFunction
 from dotenv import load_dotenv
 from langchain.schema import Document
 from more_itertools import chunked
 from prefect import flow, task
 from prefect import get_run_logger
-from rdflib import ConjunctiveGraph, Graph
-from SPARQLWrapper import SPARQLWrapper
 import typer
 
 from aikg.config import ChromaConfig, SparqlConfig
 from aikg.config.common import parse_yaml_config
 import aikg.utils.rdf as akrdf
 import aikg.utils.chroma as akchroma
+from aikg.utils.cache import EmbeddingCache
+from aikg.utils.pipeline import run_pipeline
 
 
 @task
@@ -53,28 +55,32 @@ def init_chromadb(
     collection_name: str,
     embedding_model: str,
     persist_directory: str,
+    cache: Optional[EmbeddingCache] = None,
 ) -> Tuple[ClientAPI, Collection]:
     """Prepare chromadb client."""
     client = akchroma.setup_client(host, port, persist_directory=persist_directory)
-    coll = akchroma.setup_collection(client, collection_name, embedding_model)
+    coll = akchroma.setup_collection(
+        client, collection_name, embedding_model, cache=cache
+    )
 
     return client, coll
 
 
-@task
-def sparql_to_documents(
-    kg: Graph | SPARQLWrapper, graph: Optional[str] = None
-) -> list[Document]:
-    return list(akrdf.get_subjects_docs(kg, graph=graph))
+def embed_batch(
+    embed: EmbeddingFunction, batch: list[Document]
+) -> list[Tuple[Document, Embedding]]:
+    """Compute the embeddings of a batch of documents in a single pass."""
+    embeddings = embed([doc.page_content for doc in batch])
+    return list(zip(batch, embeddings))
 
 
-@task
-def index_batch(batch: list[Document]):
-    """Sends a batch of document for indexing in the vector store"""
-    coll.add(
-        ids=[str(uuid.uuid4()) for _ in batch],
-        documents=[doc.page_content for doc in batch],
-        metadatas=[doc.metadata for doc in batch],
+def index_batch(coll: Collection, batch: list[Tuple[Document, Embedding]]):
+    """Sends a batch of embedded documents for indexing in the vector store"""
+    coll.upsert(
+        ids=[akchroma.make_document_id(doc) for doc, _ in batch],
+        embeddings=[embedding for _, embedding in batch],
+        documents=[doc.page_content for doc, _ in batch],
+        metadatas=[doc.metadata for doc, _ in batch],
     )
 
 
@@ -83,6 +89,7 @@ def chroma_build_flow(
     chroma_cfg: ChromaConfig = ChromaConfig(),
     sparql_cfg: SparqlConfig = SparqlConfig(),
     graph: Optional[str] = None,
+    incremental: bool = False,
 ):
     """Build a ChromaDB vector index from RDF data in a SPARQL endpoint.
 
@@ -95,18 +102,29 @@ def chroma_build_flow(
     graph:
         URI of named graph from which to select subjects to embed.
         By default, all subjects are used.
+    incremental:
+        Only embed documents which are new or have changed since the previous
+        build, instead of re-embedding all documents. In both modes, outdated
+        documents of changed or deleted subjects of the graph are removed.
+
+    Returns
+    -------
+    Statistics of the reading, embedding and indexing stages.
     """
     load_dotenv()
     logger = get_run_logger()
     logger.info("INFO Started")
     # Connect to external resources
-    global coll
+    cache = akchroma.setup_embedding_cache(
+        chroma_cfg.embedding_cache, chroma_cfg.embedding_cache_size
+    )
     client, coll = init_chromadb(
         chroma_cfg.host,
         chroma_cfg.port,
         chroma_cfg.collection_name,
         chroma_cfg.embedding_model,
         chroma_cfg.persist_directory,
+        cache=cache,
     )
     kg = akrdf.setup_kg(
         sparql_cfg.endpoint,
@@ -114,19 +132,59 @@ def chroma_build_flow(
         password=sparql_cfg.password,
     )
 
-    # Create subject documents
-    docs = sparql_to_documents(
+    embed = akchroma.setup_embedding_function(chroma_cfg.embedding_model, cache=cache)
+
+    # Stream subject documents
+    docs = akrdf.get_subjects_docs(
         kg,
         graph=graph,
+        batch_size=chroma_cfg.subject_batch_size,
+        page_size=chroma_cfg.page_size,
     )
 
-    # Vectorize and index documents by batches to reduce overhead
-    logger.info(f"Indexing by batches of {chroma_cfg.batch_size} items")
-    embed_counter = 0
-    for batch in chunked(docs, chroma_cfg.batch_size):
-        embed_counter += len(batch)
-        index_batch(batch)
-    logger.info(f"Indexed {embed_counter} items.")
+    # Documents identifiers are derived from their content. In incremental
+    # mode, documents already in the collection are skipped. Documents built
+    # from other graphs in the same collection are left alone.
+    existing = akchroma.get_collection_ids(coll, graph=graph or "")
+    seen = set()
+
+    def new_docs() -> Iterator[Document]:
+        for doc in docs:
+            doc_id = akchroma.make_document_id(doc)
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            if not incremental or doc_id not in existing:
+                yield doc
+
+    # Vectorize and index documents by batches to reduce overhead.
+    # Reading documents, embedding and writing to the index run concurrently.
+    logger.info(
+        f"Indexing by batches of {chroma_cfg.batch_size} items "
+        f"with {chroma_cfg.n_workers} embedding workers"
+    )
+    stats = run_pipeline(
+        chunked(new_docs(), chroma_cfg.batch_size),
+        stages=[
+            ("embed", partial(embed_batch, embed), chroma_cfg.n_workers),
+            ("index", partial(index_batch, coll), 1),
+        ],
+        queue_size=chroma_cfg.queue_size,
+    )
+    for stage in stats:
+        logger.info(str(stage))
+    logger.info(f"Indexed {stats[-1].items} items.")
+
+    # Remove documents of subjects which vanished from the graph or changed,
+    # in both modes, as changed documents are indexed under a new identifier
+    stale = list(existing - seen)
+    for batch in chunked(stale, chroma_cfg.batch_size):
+        coll.delete(ids=batch)
+    logger.info(f"Deleted {len(stale)} stale items.")
+
+    # Let clients know that the index changed
+    akchroma.mark_collection_build(coll)
+    return stats
 
 
 def cli(
@@ -144,6 +202,12 @@ def cli(
             help="URI of named graph from which to select triples to embed. If not set, the default graph is used.",
         ),
     ] = None,
+    incremental: Annotated[
+        bool,
+        typer.Option(
+            help="Only embed new or changed subjects and delete vanished ones, instead of re-embedding all subjects.",
+        ),
+    ] = False,
 ):
     """Command line wrapper for RDF to ChromaDB index flow."""
     chroma_cfg = (
@@ -156,7 +220,7 @@ def cli(
         if sparql_cfg_path
         else SparqlConfig()
     )
-    chroma_build_flow(chroma_cfg, sparql_cfg, graph=graph)
+    chroma_build_flow(chroma_cfg, sparql_cfg, graph=graph, incremental=incremental)
 
 
 if __name__ == "__main__":
@@ -43,6 +43,7 @@ from aikg.config import ChromaConfig
 from aikg.config.common import parse_yaml_config
 import aikg.utils.io as akio
 import aikg.utils.chroma as akchroma
+from aikg.utils.cache import EmbeddingCache
 
 
 @task
@@ -52,10 +53,13 @@ def init_chromadb(
     collection_name: str,
     embedding_model: str,
     persist_directory: str,
+    cache: Optional[EmbeddingCache] = None,
 ) -> Tuple[ClientAPI, Collection]:
     """Prepare chromadb client."""
     client = akchroma.setup_client(host, port, persist_directory=persist_directory)
-    coll = akchroma.setup_collection(client, collection_name, embedding_model)
+    coll = akchroma.setup_collection(
+        client, collection_name, embedding_model, cache=cache
+    )
 
     return client, coll
 
@@ -98,6 +102,9 @@ def chroma_build_examples_flow(
     logger = get_run_logger()
     logger.info("INFO Started")
     # Connect to external resources
+    cache = akchroma.setup_embedding_cache(
+        chroma_cfg.embedding_cache, chroma_cfg.embedding_cache_size
+    )
     global coll
     client, coll = init_chromadb(
         chroma_cfg.host,
@@ -105,6 +112,7 @@ def chroma_build_examples_flow(
         chroma_cfg.collection_examples,
         chroma_cfg.embedding_model,
         chroma_cfg.persist_directory,
+        cache=cache,
     )
 
     # Create subject documents
@@ -117,9 +125,12 @@ def chroma_build_examples_flow(
     embed_counter = 0
     for batch in chunked(docs, chroma_cfg.batch_size):
         embed_counter += len(batch)
-        index_batch(docs)
+        index_batch(batch)
     logger.info(f"Indexed {embed_counter} items.")
 
+    # Let clients know that the index changed
+    akchroma.mark_collection_build(coll)
+
 
 def cli(
     chroma_input_dir: Annotated[
@@ -15,19 +15,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""This flow populates a SPARQL endpoint from RDF data in a file."""
+"""This flow populates a SPARQL endpoint from RDF data in a file.
+
+The file is streamed by chunks of statements, which are sent as INSERT DATA
+queries, or uploaded as N-Triples / N-Quads bodies to a graph store endpoint
+when the load mode is "upload". Several requests are kept in flight over a
+pooled HTTP session. Failed requests are retried, and the progress is saved
+to a checkpoint file next to the source file, so that an interrupted load
+can be resumed."""
+import hashlib
 import os
 from pathlib import Path
-from typing import Optional
+import threading
+import time
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
 from typing_extensions import Annotated
 
 from dotenv import load_dotenv
+import httpx
 from prefect import flow, get_run_logger, task
 from SPARQLWrapper import SPARQLWrapper
 import typer
 
 from aikg.config.common import parse_yaml_config
 from aikg.config import SparqlConfig
+from aikg.utils.cache import GenerationCounter
+from aikg.utils.io import is_compressed, open_file, strip_compression
+from aikg.utils.ntriples import Chunk, Statement, read_chunks
+from aikg.utils.pipeline import StageStats, run_pipeline
 
 
 @task
@@ -52,65 +68,278 @@ def setup_sparql_endpoint(
     return sparql
 
 
+def make_insert_query(statements: List[Statement], graph: Optional[str] = None) -> str:
+    """Build an INSERT DATA query from statements in N-Triples syntax.
+    Statements are grouped by named graph, with one GRAPH block per graph.
+    If a graph is provided, it overrides the graph of all statements.
+
+    Examples
+    --------
+    >>> a = Statement("<http://a>", "<http://b>", '"c"')
+    >>> b = Statement("<http://a>", "<http://b>", '"d"', "<http://g>")
+    >>> print(make_insert_query([a, b]))
+    INSERT DATA {
+    <http://a> <http://b> "c" .
+    GRAPH <http://g> {
+    <http://a> <http://b> "d" .
+    }
+    }
+    """
+    groups: Dict[Optional[str], List[str]] = {}
+    for st in statements:
+        target = f"<{graph}>" if graph else st.graph
+        groups.setdefault(target, []).append(st.to_ntriples())
+    blocks = []
+    for target, lines in groups.items():
+        body = "\n".join(lines)
+        blocks.append(body if target is None else f"GRAPH {target} {{\n{body}\n}}")
+    return "INSERT DATA {\n" + "\n".join(blocks) + "\n}"
+
+
+def make_upload_body(
+    statements: List[Statement], graph: Optional[str] = None
+) -> Tuple[bytes, str]:
+    """Serialize statements for a raw upload to a graph store. Statements
+    are sent as N-Triples, or as N-Quads if any of them belongs to a named
+    graph. If a graph is provided, it overrides the graph of all statements.
+
+    Returns
+    -------
+    The request body and its content type.
+
+    Examples
+    --------
+    >>> st = Statement("<http://a>", "<http://b>", '"c"')
+    >>> make_upload_body([st])
+    (b'<http://a> <http://b> "c" .\\n', 'application/n-triples')
+    >>> make_upload_body([st], graph="http://g")
+    (b'<http://a> <http://b> "c" <http://g> .\\n', 'application/n-quads')
+    """
+    if graph:
+        statements = [st._replace(graph=f"<{graph}>") for st in statements]
+    if all(st.graph is None for st in statements):
+        body = "".join(f"{st.to_ntriples()}\n" for st in statements)
+        return body.encode("utf-8"), "application/n-triples"
+    lines = []
+    for st in statements:
+        graph_term = f" {st.graph}" if st.graph else ""
+        lines.append(f"{st.subject} {st.predicate} {st.object}{graph_term} .\n")
+    return "".join(lines).encode("utf-8"), "application/n-quads"
+
+
+def post_with_retry(
+    client: httpx.Client,
+    url: str,
+    retries: int = 3,
+    backoff: float = 1.0,
+    **kwargs,
+) -> httpx.Response:
+    """Send a POST request, retrying with exponential backoff on connection
+    errors, server errors and rate limiting. Other errors are raised directly.
+    """
+    attempt = 0
+    while True:
+        try:
+            resp = client.post(url, **kwargs)
+            resp.raise_for_status()
+            return resp
+        except (httpx.TransportError, httpx.HTTPStatusError) as err:
+            if isinstance(err, httpx.HTTPStatusError):
+                status = err.response.status_code
+                if status < 500 and status != 429:
+                    raise
+            if attempt >= retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+            attempt += 1
+
+
+def make_bnode_base(rdf_file: Path) -> str:
+    """Base of the IRIs replacing the blank nodes of a source file. It only
+    depends on the file path, so that a resumed or repeated load of a file
+    produces the same IRIs, while blank nodes of other files stay apart.
+
+    Examples
+    --------
+    >>> make_bnode_base(Path("/data/file.nt"))
+    'urn:aikg:bnode:be5ce73f033d8890:'
+    """
+    digest = hashlib.sha256(str(rdf_file.absolute()).encode("utf-8")).hexdigest()
+    return f"urn:aikg:bnode:{digest[:16]}:"
+
+
+class Checkpoint:
+    """Byte offset in a source file up to which all chunks were acknowledged
+    by the endpoint, persisted in a sidecar file. Chunks may be acknowledged
+    out of order: the offset only moves past a chunk once all chunks before
+    it are acknowledged."""
+
+    def __init__(self, path: Path, offset: int = 0):
+        self.path = path
+        self.offset = offset
+        self._acked: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_file(cls, rdf_file: Path, resume: bool = False) -> "Checkpoint":
+        """Get the checkpoint of a source file. Unless resuming,
+        the load starts from the beginning of the file."""
+        path = rdf_file.with_name(rdf_file.name + ".checkpoint")
+        offset = 0
+        if resume and path.exists():
+            offset = int(path.read_text())
+        return cls(path, offset)
+
+    def ack(self, chunk: Chunk):
+        """Mark a chunk as acknowledged and save the new offset, if any."""
+        with self._lock:
+            self._acked[chunk.start] = chunk.end
+            offset = self.offset
+            while offset in self._acked:
+                offset = self._acked.pop(offset)
+            if offset != self.offset:
+                self.offset = offset
+                tmp = self.path.with_name(self.path.name + ".tmp")
+                tmp.write_text(str(offset))
+                os.replace(tmp, self.path)
+
+    def clear(self):
+        """Remove the checkpoint file once the load is complete."""
+        self.path.unlink(missing_ok=True)
+
+
 @task
 def insert_triples(
     rdf_file: Path,
     endpoint: SPARQLWrapper,
     graph: Optional[str] = None,
     chunk_size: int = 1000,
-):
+    concurrency: int = 4,
+    retries: int = 3,
+    backoff: float = 1.0,
+    resume: bool = False,
+    mode: str = "insert",
+    upload_endpoint: Optional[str] = None,
+) -> StageStats:
     """Insert triples from source file into SPARQL endpoint.
 
     Parameters
     ----------
     rdf_file:
-        Path to RDF file to load into the SPARQL endpoint.
+        Path to N-Triples or N-Quads file to load into the SPARQL endpoint,
+        optionally compressed with gzip, bzip2 or xz.
     endpoint:
         SPARQL endpoint to load RDF data into.
     graph:
-        URI of named graph to load RDF data into.
-        If set to None, the default graph is used.
+        URI of named graph to load RDF data into. If set to None, quads
+        are loaded into their own graph and triples into the default graph.
     chunk_size:
         Number of triples per insert operation.
+    concurrency:
+        Number of insert operations in flight.
+    retries:
+        Number of times a failed insert operation is retried.
+    backoff:
+        Delay before the first retry, in seconds. The delay doubles after
+        each retry.
+    resume:
+        Resume from the checkpoint of a previous, interrupted load.
+    mode:
+        How statements are sent to the endpoint. With "insert", they are
+        sent as SPARQL INSERT DATA queries. With "upload", they are posted
+        as N-Triples or N-Quads to a graph store endpoint, which avoids
+        parsing SPARQL on the server.
+    upload_endpoint:
+        URL receiving RDF uploads in "upload" mode. Defaults to the update
+        endpoint, which accepts RDF payloads on RDF4J and GraphDB.
+
+    Blank node labels are scoped to a single request, so blank nodes are
+    replaced by IRIs derived from the file path and their label. Statements
+    about the same blank node may then be sent in different chunks, or
+    again when a load is retried or resumed.
+
+    Returns
+    -------
+    Statistics of the insert operations.
     """
-    from rdflib import Dataset
     from rdflib.util import guess_format
 
-    format = guess_format(str(rdf_file))
+    format = guess_format(strip_compression(rdf_file))
     if format not in ["nt", "nquads"]:
         raise ValueError("Unsupported RDF format, must be ntriples or nquads.")
+    if mode not in ["insert", "upload"]:
+        raise ValueError("Unsupported load mode, must be insert or upload.")
+
+    logger = get_run_logger()
+    auth = None
+    if endpoint.user and endpoint.passwd:
+        auth = (endpoint.user, endpoint.passwd)
+    checkpoint = Checkpoint.for_file(rdf_file, resume=resume)
+    cur = checkpoint.offset
+    n_inserted = 0
+    # Offsets refer to decompressed data, whose size is unknown in advance
+    tot = None if is_compressed(rdf_file) else os.path.getsize(rdf_file)
+    if tot is not None and cur > tot:
+        raise ValueError(f"Checkpoint {checkpoint.path} is beyond the end of file.")
+    if cur:
+        logger.info(f"resuming from byte {cur}")
+    lock = threading.Lock()
 
-    cur = 0
-    tot = os.path.getsize(rdf_file)
-    with open(rdf_file, "r", encoding="utf-8") as source:
-        # Run INSERT DATA queries by chunks of triples
-        while True:
-            data = "".join([source.readline() for _ in range(chunk_size)])
-            if data == "":
-                break
-
-            ds = Dataset()
-            ds.parse(data=data, format=format)
-
-            query = "\n".join(
-                [f"PREFIX {prefix}: {ns.n3()}" for prefix, ns in ds.namespaces()]
-            )
-            query += f"\nINSERT DATA {{"
-            if graph:
-                query += f"\n\tGRAPH <{graph}> {{"
-            query += " .\n".join(
-                [f"\t\t{s.n3()} {p.n3()} {o.n3()}" for (s, p, o, _) in ds.quads()]
-            )
-            if graph:
-                query += f"\n\t}}"
-            query += f" . \n\n}}\n"
-            endpoint.setQuery(query)
-            endpoint.queryType = "INSERT"
-            endpoint.method = "POST"
-            endpoint.setReturnFormat("json")
-            endpoint.query()
-            cur += len(data.encode("utf-8"))
-            print(f"inserted triples: {round(100 * cur / tot, 2)}%")
+    with httpx.Client(
+        auth=auth,
+        limits=httpx.Limits(max_connections=concurrency),
+        timeout=None,
+    ) as client, open_file(rdf_file, "rb") as source:
+
+        def send(chunk: Chunk):
+            nonlocal cur, n_inserted
+            if mode == "upload":
+                body, content_type = make_upload_body(chunk.statements, graph)
+                post_with_retry(
+                    client,
+                    upload_endpoint or endpoint.updateEndpoint,
+                    retries=retries,
+                    backoff=backoff,
+                    content=body,
+                    headers={"Content-Type": content_type},
+                )
+            else:
+                query = make_insert_query(chunk.statements, graph)
+                post_with_retry(
+                    client,
+                    endpoint.updateEndpoint,
+                    retries=retries,
+                    backoff=backoff,
+                    data={"update": query},
+                )
+            checkpoint.ack(chunk)
+            with lock:
+                cur += chunk.end - chunk.start
+                n_inserted += len(chunk)
+                if tot:
+                    print(f"inserted triples: {round(100 * cur / tot, 2)}%")
+                else:
+                    print(f"inserted triples: {n_inserted}")
+
+        # Send statements by chunks
+        source.seek(cur)
+        start = perf_counter()
+        stats = run_pipeline(
+            read_chunks(
+                source, chunk_size, offset=cur, bnode_base=make_bnode_base(rdf_file)
+            ),
+            stages=[("insert", send, concurrency)],
+            queue_size=concurrency,
+        )
+        elapsed = perf_counter() - start
+
+    checkpoint.clear()
+    inserted = stats[-1].items
+    logger.info(
+        f"inserted {inserted} triples in {elapsed:.2f}s "
+        f"({inserted / elapsed if elapsed else 0:.1f} triples/s)"
+    )
+    return stats[-1]
 
 
 @flow
@@ -118,6 +347,7 @@ def sparql_insert_flow(
     rdf_file: Path,
     sparql_cfg: SparqlConfig = SparqlConfig(),
     graph: Optional[str] = None,
+    resume: bool = False,
 ):
     """Workflow to connect to a SPARQL endpoint and send insert
     queries to load triples from a local file.
@@ -128,6 +358,16 @@ def sparql_insert_flow(
         Path to source RDF file.
     sparql_cfg:
         Configuration for the target SPARQL endpoint.
+    graph:
+        URI of named graph to load RDF data into. If not set, quads are
+        loaded into their own graph and triples into the default graph.
+    resume:
+        Resume an interrupted load from its checkpoint instead of
+        starting from the beginning of the file.
+
+    Returns
+    -------
+    Statistics of the insert operations.
     """
     load_dotenv()
     logger = get_run_logger()
@@ -135,15 +375,30 @@ def sparql_insert_flow(
         sparql_cfg.endpoint, sparql_cfg.user, sparql_cfg.password
     )
     logger.info("SPARQL endpoint connected")
-    insert_triples(rdf_file, sparql, graph)
+    stats = insert_triples(
+        rdf_file,
+        sparql,
+        graph,
+        chunk_size=sparql_cfg.load_chunk_size,
+        concurrency=sparql_cfg.load_concurrency,
+        retries=sparql_cfg.load_retries,
+        backoff=sparql_cfg.load_retry_backoff,
+        resume=resume,
+        mode=sparql_cfg.load_mode,
+        upload_endpoint=sparql_cfg.upload_endpoint or None,
+    )
     logger.info("all triples inserted")
+    # Invalidate query results cached for the previous data
+    generation = GenerationCounter(sparql_cfg.generation_file).bump()
+    logger.info(f"knowledge graph generation: {generation}")
+    return stats
 
 
 def cli(
     rdf_file: Annotated[
         Path,
         typer.Argument(
-            help="RDF file to load into the SPARQL endpoint, in turtle or n-triples format.",
+            help="RDF file to load into the SPARQL endpoint, in n-triples or n-quads format. Files compressed with gzip, bzip2 or xz are decompressed on the fly.",
             exists=True,
             file_okay=True,
             dir_okay=False,
@@ -156,9 +411,15 @@ def cli(
     graph: Annotated[
         Optional[str],
         typer.Option(
-            help="URI of named graph to load RDF data into. If not set, the default graph is used.",
+            help="URI of named graph to load RDF data into. If not set, quads are loaded into their own graph and triples into the default graph.",
         ),
     ] = None,
+    resume: Annotated[
+        bool,
+        typer.Option(
+            help="Resume an interrupted load from the checkpoint saved next to the RDF file.",
+        ),
+    ] = False,
 ):
     """Command line wrapper to insert triples to a SPARQL endpoint."""
     sparql_cfg = (
@@ -166,7 +427,7 @@ def cli(
         if sparql_cfg_path
         else SparqlConfig()
     )
-    sparql_insert_flow(rdf_file, sparql_cfg, graph)
+    sparql_insert_flow(rdf_file, sparql_cfg, graph, resume=resume)
 
 
 if __name__ == "__main__":
@@ -19,85 +19,609 @@
 fetches context for that question in a vector store and injects them into a prompt.
 It then sends the prompt to a LLM and returns the response to the client.
 """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import partial
+import json
 import logging
 import os
+import secrets
 import sys
+import time
+from typing import Optional
 
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import httpx
 from langchain.chat_models import ChatOpenAI
 from pathlib import Path
 
 from aikg.config import ChatConfig, ChromaConfig, SparqlConfig
 from aikg.config.common import parse_yaml_config
 from aikg.models import Conversation, Message
-from aikg.utils.chat import generate_answer, generate_examples, generate_sparql
+from aikg.utils.cache import GenerationCounter, SemanticCache, SingleFlight, TTLCache
+from aikg.utils.chat import (
+    agenerate_answer,
+    agenerate_sparql,
+    astream_answer,
+    embed_question,
+    normalize_question,
+)
 from aikg.utils.llm import setup_llm_chain
-from aikg.utils.chroma import setup_collection, setup_client
-from aikg.utils.rdf import setup_kg, query_kg
+from aikg.utils.chroma import (
+    get_collection_build,
+    setup_collection,
+    setup_client,
+    setup_embedding_cache,
+    setup_embedding_function,
+)
+from aikg.utils.columnar import aquery_kg_columns
+from aikg.utils.metrics import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    CACHE_SIZE,
+    COMPONENT_READY_SECONDS,
+    REQUEST_SECONDS,
+    STAGE_SECONDS,
+    TRUNCATED_RESULTS,
+    Metrics,
+)
+from aikg.utils.rdf import (
+    QueryCache,
+    QueryLimits,
+    aquery_kg,
+    count_results,
+    setup_kg,
+)
+from aikg.utils.readiness import ComponentError, Readiness
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 load_dotenv()
-chroma_config = ChromaConfig()
-sparql_config = SparqlConfig()
-if os.environ.get("CHAT_CONFIG"):
-    chat_config = parse_yaml_config(Path(os.environ["CHAT_CONFIG"]), ChatConfig)
-else:
-    chat_config = ChatConfig()
-
-
-client = setup_client(
-    chroma_config.host,
-    chroma_config.port,
-    chroma_config.persist_directory,
-)
-collection = setup_collection(
-    client,
-    chroma_config.collection_name,
-    chroma_config.embedding_model,
-)
 
-llm = ChatOpenAI(
-    model_name=chat_config.model,
-    openai_api_key=chat_config.openai_api_key,
-    openai_api_base=chat_config.openai_api_base,
-)
 
-answer_chain = setup_llm_chain(llm, chat_config.answer_template)
-sparql_chain = setup_llm_chain(llm, chat_config.sparql_template)
-kg = setup_kg(**sparql_config.dict())
-app = FastAPI()
+def load_chat_config() -> ChatConfig:
+    """Load the chat configuration, from the yaml file given in CHAT_CONFIG
+    if set."""
+    if os.environ.get("CHAT_CONFIG"):
+        return parse_yaml_config(Path(os.environ["CHAT_CONFIG"]), ChatConfig)
+    return ChatConfig()
+
+
+# Components loaded in the background, required to answer questions
+COMPONENTS = ["embedding_model", "vector_index", "kg", "llm"]
+
+# Number of schema documents given as context to generate queries, more for
+# answers since the query must run. Cached queries generated with fewer
+# documents than a request needs are not reused.
+ASK_CONTEXT_LIMIT = 15
+SPARQL_CONTEXT_LIMIT = 5
+
+
+class ChatServer:
+    """Resources and request handling of the chat server.
+
+    Caches, the thread pool and the HTTP client are created right away. The
+    embedding model, vector index, knowledge graph and LLM clients are slow
+    to set up (e.g. a local RDF file is fully parsed), so they are loaded by
+    warm_up in the background and requests wait until the components they
+    need are ready.
+    """
+
+    def __init__(
+        self,
+        chat_config: ChatConfig,
+        chroma_config: ChromaConfig,
+        sparql_config: SparqlConfig,
+    ):
+        self.chat_config = chat_config
+        self.chroma_config = chroma_config
+        self.sparql_config = sparql_config
+        self.readiness = Readiness()
+        for name in COMPONENTS:
+            self.readiness.add(name)
+
+        self.embedding_cache = setup_embedding_cache(
+            chroma_config.embedding_cache, chroma_config.embedding_cache_size
+        )
+        # Questions are embedded once per request, and recent questions are cached
+        self.question_embeddings = TTLCache(
+            maxsize=chroma_config.query_cache_size, ttl=chroma_config.query_cache_ttl
+        )
+        # Answers to similar questions are reused until the index is rebuilt
+        self.answer_cache = SemanticCache(
+            threshold=chat_config.answer_cache_threshold,
+            maxsize=chat_config.answer_cache_size,
+            ttl=chat_config.answer_cache_ttl,
+        )
+        self.index_builds = None
+        self.index_checked = 0.0
+        # Concurrent requests for the same question share a single computation
+        self.inflight = SingleFlight()
+        # Stage timings, token counts and cache statistics exported on /metrics
+        self.metrics = Metrics(enabled=chat_config.metrics_enabled)
+
+        # Results of equivalent queries are reused until data is loaded in the kg
+        self.kg_generation = GenerationCounter(sparql_config.generation_file)
+        self.query_cache = QueryCache(
+            maxsize=sparql_config.query_cache_size,
+            ttl=sparql_config.query_cache_ttl,
+            generation=self.kg_generation,
+        )
+        # Generated queries may be arbitrarily expensive, so their cost is bounded
+        self.query_limits = QueryLimits(
+            max_rows=sparql_config.max_rows,
+            max_bytes=sparql_config.max_bytes,
+            timeout=sparql_config.query_timeout or None,
+        )
+
+        # Blocking operations run in a bounded thread pool, and SPARQL endpoints
+        # are queried through a pooled async HTTP client
+        self.executor = ThreadPoolExecutor(max_workers=chat_config.n_workers)
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=chat_config.max_connections),
+            timeout=None,
+        )
+
+        # Loaded in the background by warm_up
+        self.embed = None
+        self.client = None
+        self.collection = None
+        self.kg = None
+        self.answer_chain = None
+        self.stream_answer_chain = None
+        self.sparql_chain = None
+
+    def load_embedding_model(self):
+        """Load the embedding model and run it once, as the first inference
+        is much slower than the next ones."""
+        model = self.chroma_config.embedding_model
+        # The cached embedding function loads the model lazily
+        embed = setup_embedding_function(model)
+        embed(["warm-up"])
+        if self.embedding_cache is not None:
+            embed = setup_embedding_function(model, cache=self.embedding_cache)
+        self.embed = embed
+
+    def load_vector_index(self):
+        """Connect to ChromaDB and load the collection, querying it once
+        so that its index is in memory before the first question."""
+        config = self.chroma_config
+        client = setup_client(config.host, config.port, config.persist_directory)
+        collection = setup_collection(
+            client,
+            config.collection_name,
+            config.embedding_model,
+            cache=self.embedding_cache,
+        )
+        if collection.count():
+            collection.query(query_embeddings=self.embed(["warm-up"]), n_results=1)
+        self.client = client
+        self.collection = collection
+
+    def load_kg(self):
+        """Connect to the SPARQL endpoint, or parse the local RDF file."""
+        self.kg = setup_kg(
+            self.sparql_config.endpoint,
+            user=self.sparql_config.user,
+            password=self.sparql_config.password,
+        )
+
+    def load_llm(self):
+        """Create the LLM clients and chains."""
+        config = self.chat_config
+        llm = ChatOpenAI(
+            model_name=config.model,
+            openai_api_key=config.openai_api_key,
+            openai_api_base=config.openai_api_base,
+        )
+        # Streamed answers use a separate model client emitting tokens as they come
+        streaming_llm = ChatOpenAI(
+            model_name=config.model,
+            openai_api_key=config.openai_api_key,
+            openai_api_base=config.openai_api_base,
+            streaming=True,
+        )
+        self.answer_chain = setup_llm_chain(llm, config.answer_template)
+        self.stream_answer_chain = setup_llm_chain(
+            streaming_llm, config.answer_template
+        )
+        self.sparql_chain = setup_llm_chain(llm, config.sparql_template)
+
+    async def warm_up(self):
+        """Load all components concurrently, recording their time to ready."""
+        await asyncio.gather(
+            self.readiness.run("embedding_model", self.load_embedding_model),
+            self.readiness.run(
+                "vector_index", self.load_vector_index, after=["embedding_model"]
+            ),
+            self.readiness.run("kg", self.load_kg),
+            self.readiness.run("llm", self.load_llm),
+        )
+
+    async def wait_ready(self, *names: str):
+        """Wait until components are loaded. Requests fail with 503 if one of
+        them could not be loaded."""
+        try:
+            await self.readiness.wait(*names)
+        except ComponentError as err:
+            raise HTTPException(status_code=503, detail=str(err)) from err
+
+    async def close(self):
+        await self.http_client.aclose()
+        self.executor.shutdown(wait=False)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Run a blocking function in the thread pool without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def check_index_builds(self):
+        """Clear cached answers if the collection was rebuilt or data was loaded
+        in the knowledge graph since the last check. Checks are done at most
+        once per check interval."""
+        now = time.monotonic()
+        if now - self.index_checked < self.chat_config.answer_cache_check_interval:
+            return
+        self.index_checked = now
+        builds = (
+            get_collection_build(self.client, self.chroma_config.collection_name),
+            self.kg_generation.get(),
+        )
+        if builds != self.index_builds:
+            self.answer_cache.clear()
+            self.index_builds = builds
+
+    async def get_query(
+        self, question: str, embedding, limit: int = SPARQL_CONTEXT_LIMIT
+    ) -> str:
+        """Generate a sparql query from the question, using the
+        k-nearest schema documents as context."""
+        with self.metrics.time(STAGE_SECONDS, stage="generate_sparql"):
+            return await agenerate_sparql(
+                question,
+                self.collection,
+                self.sparql_chain,
+                limit=limit,
+                embedding=embedding,
+                executor=self.executor,
+                metrics=self.metrics,
+                token_budget=self.chat_config.context_token_budget or None,
+            )
+
+    async def get_embedding(self, question: str):
+        """Embed the question, reusing the embeddings of recent questions."""
+        with self.metrics.time(STAGE_SECONDS, stage="embed_question"):
+            return await self.run_blocking(
+                embed_question, question, self.embed, self.question_embeddings
+            )
+
+    async def run_query(self, query: str):
+        """Execute a sparql query on the knowledge graph, within the query limits."""
+        cache = self.query_cache if self.sparql_config.query_cache_size else None
+        with self.metrics.time(STAGE_SECONDS, stage="query_kg"):
+            try:
+                if self.sparql_config.result_format == "csv":
+                    results = await aquery_kg(
+                        self.kg,
+                        query,
+                        self.http_client,
+                        executor=self.executor,
+                        cache=cache,
+                        limits=self.query_limits,
+                    )
+                else:
+                    results = await aquery_kg_columns(
+                        self.kg,
+                        query,
+                        self.http_client,
+                        executor=self.executor,
+                        fmt=self.sparql_config.result_format,
+                        cache=cache,
+                        limits=self.query_limits,
+                    )
+            except (asyncio.TimeoutError, httpx.TimeoutException) as err:
+                raise HTTPException(
+                    status_code=504, detail="The SPARQL query timed out."
+                ) from err
+        if results.truncated:
+            logging.warning(f"Query results truncated: {query}")
+            self.metrics.inc(TRUNCATED_RESULTS)
+        return results
+
+    def inflight_key(self, kind: str, question: str) -> tuple:
+        """Key identifying identical computations for in-flight deduplication."""
+        return (kind, self.sparql_config.endpoint, normalize_question(question))
+
+    @staticmethod
+    def cached_query(cached: dict, limit: int) -> Optional[str]:
+        """Return the query of a cache entry if it was generated with at
+        least limit context documents."""
+        if cached.get("limit", 0) >= limit:
+            return cached["query"]
+        return None
+
+    async def answer_question(self, question: str) -> str:
+        """Generate a sparql query from the question, execute it on the kg
+        and generate an answer based on results."""
+        await self.wait_ready(*COMPONENTS)
+        await self.run_blocking(self.check_index_builds)
+        embedding = await self.get_embedding(question)
+        cached = self.answer_cache.get(embedding, {})
+        if "answer" in cached:
+            return cached["answer"]
+        query = self.cached_query(cached, ASK_CONTEXT_LIMIT)
+        if query is None:
+            query = await self.get_query(question, embedding, limit=ASK_CONTEXT_LIMIT)
+        results = await self.run_query(query)
+        with self.metrics.time(STAGE_SECONDS, stage="generate_answer"):
+            answer = await agenerate_answer(
+                question,
+                query,
+                results,
+                self.answer_chain,
+                metrics=self.metrics,
+                token_budget=self.chat_config.result_token_budget or None,
+            )
+        self.answer_cache.put(
+            embedding,
+            {"query": query, "limit": ASK_CONTEXT_LIMIT, "answer": answer},
+        )
+        return answer
 
+    async def generate_query(self, question: str) -> str:
+        """Generate a sparql query from the question, reusing cached queries."""
+        await self.wait_ready("embedding_model", "vector_index", "llm")
+        await self.run_blocking(self.check_index_builds)
+        embedding = await self.get_embedding(question)
+        cached = self.answer_cache.get(embedding, {})
+        query = self.cached_query(cached, SPARQL_CONTEXT_LIMIT)
+        if query is None:
+            query = await self.get_query(question, embedding)
+            self.answer_cache.put(
+                embedding, {"query": query, "limit": SPARQL_CONTEXT_LIMIT}
+            )
+        return query
 
-@app.get("/")
+    def cache_stats(self) -> dict:
+        """Return hit and miss counters of the server caches."""
+        return {
+            "question_embeddings": self.question_embeddings.stats(),
+            "answers": self.answer_cache.stats(),
+            "inflight": self.inflight.stats(),
+            "query_results": self.query_cache.stats(),
+        }
+
+
+router = APIRouter()
+
+
+def get_server(request: Request) -> ChatServer:
+    """Return the chat server of the application handling the request."""
+    return request.app.state.server
+
+
+@router.get("/")
 def index():
     return {
         "title": "Hello, welcome to the knowledge graph chatbot!",
         "description": "This is a simple chatbot that uses a knowledge graph to answer questions.",
-        "usage": "Ask a single question using /ask?question='...', or only generate the query using /sparql?question='...'.",
+        "usage": "Ask a single question using /ask?question='...', stream the answer as server-sent events using /ask/stream?question='...', or only generate the query using /sparql?question='...'.",
     }
 
 
-@app.get("/test/")
+@router.get("/test/")
 async def test() -> Message:
     return Message(text="Hello, world!", sender="AI", time=datetime.now())
 
 
-@app.get("/ask/")
-async def ask(question: str) -> Message:
+@router.get("/healthz")
+def healthz():
+    """Liveness probe: the server is up, even if components are still loading."""
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+def readyz(server: ChatServer = Depends(get_server)):
+    """Readiness probe: fails with 503 until all components are loaded. The
+    status and time to ready of each component are returned in both cases."""
+    status = server.readiness.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@router.get("/ask/")
+async def ask(question: str, server: ChatServer = Depends(get_server)) -> Message:
     """Generate sparql query from question
     and execute query on kg and return an answer based on results."""
-    ...
-    query = generate_sparql(question, collection, sparql_chain, limit=15)
-    results = query_kg(kg, query)
-    answer = generate_answer(question, query, results, answer_chain)
+    answer = await server.inflight.run(
+        server.inflight_key("ask", question), server.answer_question, question
+    )
     return Message(text=answer, sender="AI", time=datetime.now())
 
 
-@app.get("/sparql/")
-async def sparql(question: str) -> Message:
+def format_sse(event: str, data: str) -> str:
+    """Format a server-sent event. Multiline data is split into
+    several data fields, as required by the SSE specification."""
+    lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+    return f"event: {event}\n{lines}\n"
+
+
+@router.get("/ask/stream/")
+async def ask_stream(
+    question: str, server: ChatServer = Depends(get_server)
+) -> StreamingResponse:
+    """Streaming variant of /ask/ using server-sent events. The generated
+    query, the number of results and the answer tokens are sent as soon as
+    they are available. The last event contains the complete message, or an
+    error event if the answer could not be generated."""
+    await server.wait_ready(*COMPONENTS)
+
+    async def events():
+        # Send headers and a first byte right away
+        yield ": started\n\n"
+        try:
+            await server.run_blocking(server.check_index_builds)
+            embedding = await server.get_embedding(question)
+            cached = server.answer_cache.get(embedding, {})
+            if "answer" in cached:
+                yield format_sse("query", cached["query"])
+                answer = cached["answer"]
+            else:
+                query = server.cached_query(cached, ASK_CONTEXT_LIMIT)
+                if query is None:
+                    query = await server.inflight.run(
+                        server.inflight_key("ask_query", question),
+                        server.get_query,
+                        question,
+                        embedding,
+                        limit=ASK_CONTEXT_LIMIT,
+                    )
+                yield format_sse("query", query)
+                results = await server.run_query(query)
+                summary = {
+                    "count": count_results(results),
+                    "truncated": results.truncated,
+                }
+                yield format_sse("results", json.dumps(summary))
+                tokens = []
+                with server.metrics.time(STAGE_SECONDS, stage="generate_answer"):
+                    async for token in astream_answer(
+                        question,
+                        query,
+                        results,
+                        server.stream_answer_chain,
+                        metrics=server.metrics,
+                        token_budget=server.chat_config.result_token_budget or None,
+                    ):
+                        tokens.append(token)
+                        yield format_sse("token", token)
+                answer = "".join(tokens)
+                server.answer_cache.put(
+                    embedding,
+                    {"query": query, "limit": ASK_CONTEXT_LIMIT, "answer": answer},
+                )
+            message = Message(text=answer, sender="AI", time=datetime.now())
+            yield format_sse("message", message.model_dump_json())
+        except Exception as err:
+            # The response has already started, so errors are sent to the
+            # client as a last event instead of an error status
+            if isinstance(err, HTTPException):
+                detail = err.detail
+            else:
+                logging.exception(f"Failed to answer question: {question}")
+                detail = "Internal server error"
+            yield format_sse("error", json.dumps({"detail": detail}))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@router.get("/sparql/")
+async def sparql(question: str, server: ChatServer = Depends(get_server)) -> Message:
     """Generate and return sparql query from question."""
-    query = generate_sparql(question, collection, sparql_chain)
+    query = await server.inflight.run(
+        server.inflight_key("sparql", question), server.generate_query, question
+    )
     return Message(text=query, sender="AI", time=datetime.now())
+
+
+@router.post("/cache/invalidate/")
+def invalidate_cache(
+    authorization: str = Header(""), server: ChatServer = Depends(get_server)
+):
+    """Clear cached answers and query results, e.g. after the knowledge graph
+    was reloaded. Requires the admin token as a bearer token."""
+    token = server.chat_config.admin_token
+    if not token:
+        raise HTTPException(status_code=404, detail="Cache invalidation is disabled.")
+    if not secrets.compare_digest(authorization, f"Bearer {token}"):
+        raise HTTPException(status_code=401, detail="Invalid admin token.")
+    server.answer_cache.clear()
+    server.query_cache.clear()
+    return {"status": "ok"}
+
+
+@router.get("/stats/")
+def stats(server: ChatServer = Depends(get_server)):
+    """Return hit and miss counters of the server caches."""
+    return server.cache_stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def export_metrics(server: ChatServer = Depends(get_server)):
+    """Export server metrics in the Prometheus text format."""
+    metrics = server.metrics
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled.")
+    for name, cache in [
+        ("question_embeddings", server.question_embeddings),
+        ("answers", server.answer_cache),
+        ("inflight", server.inflight),
+        ("query_results", server.query_cache),
+    ]:
+        cache_stats = cache.stats()
+        metrics.set_total(CACHE_HITS, cache_stats["hits"], cache=name)
+        metrics.set_total(CACHE_MISSES, cache_stats["misses"], cache=name)
+        metrics.set(CACHE_SIZE, cache_stats["size"], cache=name)
+    for name, component in server.readiness.status()["components"].items():
+        if component["status"] == "ready":
+            metrics.set(COMPONENT_READY_SECONDS, component["seconds"], component=name)
+    return metrics.render()
+
+
+def create_app(
+    chat_config: Optional[ChatConfig] = None,
+    chroma_config: Optional[ChromaConfig] = None,
+    sparql_config: Optional[SparqlConfig] = None,
+) -> FastAPI:
+    """Create the chat server application. Resources are created when the
+    application starts, and slow components are loaded in the background,
+    so that the server accepts connections immediately. /healthz reports
+    that the server is alive and /readyz whether all components are loaded.
+
+    Parameters
+    ----------
+    chat_config:
+        Chat configuration, loaded from the environment if not provided.
+    chroma_config:
+        ChromaDB configuration, loaded from the environment if not provided.
+    sparql_config:
+        SPARQL configuration, loaded from the environment if not provided.
+    """
+    chat_config = chat_config or load_chat_config()
+    chroma_config = chroma_config or ChromaConfig()
+    sparql_config = sparql_config or SparqlConfig()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        server = ChatServer(chat_config, chroma_config, sparql_config)
+        app.state.server = server
+        warm_up = asyncio.create_task(server.warm_up())
+        yield
+        warm_up.cancel()
+        await server.close()
+
+    app = FastAPI(lifespan=lifespan)
+
+    if chat_config.metrics_enabled:
+
+        @app.middleware("http")
+        async def time_requests(request: Request, call_next):
+            start = time.perf_counter()
+            response = await call_next(request)
+            # Label requests with the route template, so that path parameters
+            # and unknown paths do not create a new series each
+            route = request.scope.get("route")
+            path = route.path if route else "unmatched"
+            request.app.state.server.metrics.observe(
+                REQUEST_SECONDS, time.perf_counter() - start, path=path
+            )
+            return response
+
+    app.include_router(router)
+    return app
+
+
+app = create_app()
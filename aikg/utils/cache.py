@@ -0,0 +1,420 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches used to avoid recomputing expensive results."""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+
+class TTLCache:
+    """In-memory, thread-safe least recently used cache where entries
+    expire after a time-to-live. Hits and misses are counted.
+
+    Parameters
+    ----------
+    maxsize:
+        Maximum number of entries in the cache.
+    ttl:
+        Number of seconds after which an entry expires.
+        If None, entries do not expire.
+
+    Examples
+    --------
+    >>> cache = TTLCache(maxsize=2)
+    >>> cache.put("a", 1)
+    >>> cache.get("a"), cache.get("b")
+    (1, None)
+    >>> cache.stats()
+    {'hits': 1, 'misses': 1, 'size': 1}
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the value cached for key, or default if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (
+                self.ttl is None or time.monotonic() - entry[0] < self.ttl
+            ):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any):
+        """Cache a value, evicting the least recently used entry if full."""
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls of coroutine functions. While a call
+    for a key is in flight, other calls with the same key wait for it and
+    share its result or exception, instead of running again. Calls which
+    joined an in-flight computation are counted as hits.
+
+    Examples
+    --------
+    >>> async def compute(x):
+    ...     await asyncio.sleep(0.01)
+    ...     return x * 2
+    >>> async def main():
+    ...     flight = SingleFlight()
+    ...     calls = [flight.run("a", compute, 1) for _ in range(3)]
+    ...     return await asyncio.gather(*calls), flight.stats()
+    >>> asyncio.run(main())
+    ([2, 2, 2], {'hits': 2, 'misses': 1, 'size': 0})
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(
+        self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs
+    ) -> Any:
+        """Await func(*args, **kwargs), or the in-flight call with the same key."""
+        call = self._calls.get(key)
+        if call is None:
+            self.misses += 1
+            call = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.hits += 1
+        # A cancelled caller must not cancel the call shared with others
+        return await asyncio.shield(call)
+
+    def _forget(self, key: Hashable, call: asyncio.Future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class GenerationCounter:
+    """Version number of a data source, stored in a file so that it can be
+    bumped by the process loading data and read by the processes caching
+    results derived from it. A missing file is generation 0.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> counter = GenerationCounter(Path(tempfile.mkdtemp()) / "generation")
+    >>> counter.get()
+    0
+    >>> counter.bump()
+    1
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+
+    def get(self) -> int:
+        try:
+            return int(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump(self) -> int:
+        """Increment the generation, invalidating results cached for previous ones."""
+        generation = self.get() + 1
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(str(generation))
+        os.replace(tmp, self.path)
+        return generation
+
+
+class SemanticCache:
+    """In-memory cache where values are keyed by embeddings. A lookup returns
+    the value of the most similar cached embedding, if its cosine similarity
+    with the query embedding is above a threshold. Entries expire after a
+    time-to-live and least recently used entries are evicted when full.
+
+    Parameters
+    ----------
+    threshold:
+        Minimum cosine similarity between embeddings to return a cached value.
+    maxsize:
+        Maximum number of entries in the cache.
+    ttl:
+        Number of seconds after which an entry expires.
+        If None, entries do not expire.
+
+    Examples
+    --------
+    >>> cache = SemanticCache(threshold=0.9)
+    >>> cache.put([1.0, 0.0], "a")
+    >>> cache.get([0.99, 0.05]), cache.get([0.0, 1.0])
+    ('a', None)
+    """
+
+    def __init__(
+        self, threshold: float = 0.95, maxsize: int = 1024, ttl: Optional[float] = None
+    ):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._vectors: Optional[np.ndarray] = None
+        self._values: List[Any] = [None] * maxsize
+        self._created = np.zeros(maxsize)
+        self._accessed = np.zeros(maxsize)
+        self._valid = np.zeros(maxsize, dtype=bool)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _expire(self, now: float):
+        if self.ttl is not None:
+            self._valid &= now - self._created < self.ttl
+
+    def get(self, embedding: Sequence[float], default: Any = None) -> Any:
+        """Return the value of the most similar cached embedding,
+        or default if none is similar enough."""
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if self._vectors is not None and self._valid.any():
+                sims = np.where(self._valid, self._vectors @ query, -np.inf)
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    self._accessed[best] = now
+                    self.hits += 1
+                    return self._values[best]
+            self.misses += 1
+            return default
+
+    def put(self, embedding: Sequence[float], value: Any):
+        """Cache a value, replacing an entry with the same embedding or
+        evicting the least recently used entry if full."""
+        if self.maxsize == 0:
+            return
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.maxsize, len(vector)), dtype=np.float32)
+            sims = np.where(self._valid, self._vectors @ vector, -np.inf)
+            if self._valid.any() and sims.max() >= 1.0 - 1e-6:
+                slot = int(np.argmax(sims))
+            elif not self._valid.all():
+                slot = int(np.argmin(self._valid))
+            else:
+                slot = int(np.argmin(self._accessed))
+            self._vectors[slot] = vector
+            self._values[slot] = value
+            self._created[slot] = self._accessed[slot] = now
+            self._valid[slot] = True
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._valid[:] = False
+            self._values = [None] * self.maxsize
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+    def __len__(self) -> int:
+        return int(self._valid.sum())
+
+
+class EmbeddingCache:
+    """Persistent cache of text embeddings, stored in a SQLite database.
+    Embeddings are keyed by embedding model and hash of the text. When the
+    cache exceeds its maximum size, least recently used entries are evicted.
+    The database can be shared by multiple processes.
+
+    Parameters
+    ----------
+    path:
+        Path to the SQLite database file. It is created if needed.
+    max_entries:
+        Maximum number of embeddings kept in the cache.
+    touch_interval:
+        Access times are only updated when older than this number of
+        seconds, so that lookups of recently used embeddings do not write
+        to the database.
+
+    Examples
+    --------
+    >>> cache = EmbeddingCache(":memory:")
+    >>> cache.put_many("model", ["hello"], [[0.5, 1.0]])
+    >>> cache.get_many("model", ["hello", "world"])
+    [array([0.5, 1. ], dtype=float32), None]
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_entries: int = 1_000_000,
+        touch_interval: float = 3600,
+    ):
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (model, key)
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_accessed "
+                "ON embeddings (accessed)"
+            )
+            # The number of entries is maintained by triggers, as counting
+            # rows scans the whole table. Rows inserted before the count is
+            # initialized are included in it.
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings_count (n INTEGER NOT NULL);
+                CREATE TRIGGER IF NOT EXISTS embeddings_insert
+                AFTER INSERT ON embeddings
+                BEGIN UPDATE embeddings_count SET n = n + 1; END;
+                CREATE TRIGGER IF NOT EXISTS embeddings_delete
+                AFTER DELETE ON embeddings
+                BEGIN UPDATE embeddings_count SET n = n - 1; END;
+                """
+            )
+            self._conn.execute(
+                "INSERT INTO embeddings_count SELECT COUNT(*) FROM embeddings "
+                "WHERE NOT EXISTS (SELECT 1 FROM embeddings_count)"
+            )
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Retrieve cached embeddings of texts, with None for missing ones."""
+        keys = [self.make_key(text) for text in texts]
+        found = {}
+        stale = []
+        now = time.time()
+        with self._lock, self._conn:
+            # Query by chunks to stay below SQLite's variables limit
+            for start in range(0, len(keys), 500):
+                chunk = list(set(keys[start : start + 500]))
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector, accessed FROM embeddings "
+                    f"WHERE model = ? AND key IN ({marks})",
+                    [model, *chunk],
+                ).fetchall()
+                for key, vector, accessed in rows:
+                    found[key] = vector
+                    if accessed <= now - self.touch_interval:
+                        stale.append(key)
+            # Reads only take the write lock when access times are outdated
+            if stale:
+                self._conn.executemany(
+                    "UPDATE embeddings SET accessed = ? WHERE model = ? AND key = ?",
+                    [(now, model, key) for key in stale],
+                )
+        return [
+            np.frombuffer(found[key], dtype=np.float32) if key in found else None
+            for key in keys
+        ]
+
+    def put_many(self, model: str, texts: Sequence[str], embeddings: Sequence):
+        """Store embeddings of texts and evict old entries if needed."""
+        now = time.time()
+        rows = [
+            (
+                model,
+                self.make_key(text),
+                np.asarray(emb, dtype=np.float32).tobytes(),
+                now,
+            )
+            for text, emb in zip(texts, embeddings)
+        ]
+        with self._lock, self._conn:
+            # Existing entries are updated in place rather than replaced, so
+            # that only new entries are counted
+            self._conn.executemany(
+                "INSERT INTO embeddings VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (model, key) DO UPDATE "
+                "SET vector = excluded.vector, accessed = excluded.accessed",
+                rows,
+            )
+            (n_entries,) = self._conn.execute(
+                "SELECT n FROM embeddings_count"
+            ).fetchone()
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN ("
+                    "SELECT rowid FROM embeddings ORDER BY accessed LIMIT ?)",
+                    (n_entries - self.max_entries,),
+                )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT n FROM embeddings_count").fetchone()[0]
@@ -16,11 +16,29 @@
 # limitations under the License.
 
 """Utilities to help processing chatbot prompts or answers."""
-from typing import Any, Iterable
+import asyncio
+from concurrent.futures import Executor
+import re
+from typing import Any, AsyncIterator, Iterable, List, NamedTuple, Optional, Tuple
 
 from chromadb.api import Collection
+from chromadb.api.types import Embedding, EmbeddingFunction
 from rdflib import Graph
 from langchain import LLMChain
+from langchain.callbacks import AsyncIteratorCallbackHandler
+
+from aikg.utils.cache import TTLCache
+from aikg.utils.columnar import ColumnarResults
+from aikg.utils.llm import estimate_tokens
+from aikg.utils.metrics import (
+    CONTEXT_TRIPLES,
+    LLM_TOKENS,
+    NO_METRICS,
+    STAGE_SECONDS,
+    Metrics,
+)
+from aikg.utils.rdf import compact_triples, count_results, format_prefixes
+from aikg.utils.summary import summarize_results
 
 
 def keep_first_line(text: str) -> str:
@@ -55,38 +73,270 @@ def post_process_answer(answer: str) -> str:
     return text
 
 
+def normalize_question(question: str) -> str:
+    r"""Normalize a question so that trivial variations share cache entries.
+
+    Examples
+    --------
+    >>> normalize_question("  What is   a Person?\n")
+    'what is a person?'
+    """
+    return re.sub(r"\s+", " ", question).strip().lower()
+
+
+def embed_question(
+    question: str,
+    embed: EmbeddingFunction,
+    cache: Optional[TTLCache] = None,
+) -> Embedding:
+    """Compute the embedding of a question, reusing the embedding
+    of previous identical questions if a cache is provided."""
+    key = normalize_question(question)
+    embedding = cache.get(key) if cache is not None else None
+    if embedding is None:
+        embedding = embed([question])[0]
+        if cache is not None:
+            cache.put(key, embedding)
+    return embedding
+
+
+def query_collection(
+    question: str,
+    collection: Collection,
+    limit: int = 5,
+    embedding: Optional[Embedding] = None,
+) -> dict:
+    """Retrieve the k-nearest documents of a question in a collection.
+    If provided, the precomputed question embedding is used instead of
+    embedding the question again."""
+    if embedding is not None:
+        return collection.query(query_embeddings=[embedding], n_results=limit)
+    return collection.query(query_texts=question, n_results=limit)
+
+
+def _words(text: str) -> set[str]:
+    """Split a text into lowercase words of 3 letters or more,
+    including the parts of camelCase words.
+
+    Examples
+    --------
+    >>> sorted(_words("Who is the birthDate of a Person?"))
+    ['birth', 'date', 'person', 'the', 'who']
+    """
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    return {w.lower() for w in re.findall(r"[A-Za-z0-9]+", text) if len(w) > 2}
+
+
+def _line_text(line: str) -> str:
+    """Replace full IRIs in a turtle statement by their local name.
+
+    Examples
+    --------
+    >>> _line_text('<http://ex.org/a> rdfs:label "A" .')
+    'a rdfs:label "A" .'
+    """
+    return re.sub(r"<[^>]*?([^/#>]*)[/#]?>", r"\1", line)
+
+
+def rank_triples(question: str, hits: Iterable[str]) -> List[str]:
+    """Deduplicate the statements of retrieved documents, one per line, and
+    rank them by relevance to the question. Statements sharing more words
+    with the question come first, then statements from higher ranked
+    documents.
+
+    Examples
+    --------
+    >>> hits = [
+    ...     'ex:a ex:name "A" .\\nex:a ex:age "3" .',
+    ...     'ex:a ex:name "A" .',
+    ... ]
+    >>> rank_triples("What is the age of A?", hits)
+    ['ex:a ex:age "3" .', 'ex:a ex:name "A" .']
+    """
+    question_words = _words(question)
+    scores = {}
+    for rank, hit in enumerate(hits):
+        for pos, line in enumerate(hit.splitlines()):
+            line = line.strip()
+            if not line or line.startswith("#") or line in scores:
+                continue
+            overlap = len(question_words & _words(_line_text(line)))
+            scores[line] = (-overlap, rank, pos)
+    return sorted(scores, key=scores.__getitem__)
+
+
+def pack_triples(
+    triples: List[str], token_budget: Optional[int] = None
+) -> Tuple[List[str], int]:
+    """Greedily select triples, in order, until the token budget is spent.
+    Triples which do not fit are skipped, but smaller ones after them may
+    still be selected.
+
+    Returns
+    -------
+    The selected triples and the number of dropped triples.
+
+    Examples
+    --------
+    >>> pack_triples(["<a> <b> <c> .", "<a> <b> <d> <e> <f> .", "<a> <b> <g> ."], 25)
+    (['<a> <b> <c> .', '<a> <b> <g> .'], 1)
+    """
+    if token_budget is None:
+        return list(triples), 0
+    packed = []
+    used = 0
+    for triple in triples:
+        cost = estimate_tokens(triple)
+        if used + cost <= token_budget:
+            packed.append(triple)
+            used += cost
+    return packed, len(triples) - len(packed)
+
+
+class SparqlContext(NamedTuple):
+    """Triples given as context to generate a SPARQL query."""
+
+    text: str
+    n_triples: int
+    n_dropped: int
+
+
+def get_document_context(metadata: dict) -> Tuple[str, str]:
+    """Get the compact turtle statements and prefix declarations stored in
+    the metadata of a document. Documents indexed without them are converted
+    from their N-Triples."""
+    if "context" in metadata:
+        return metadata["context"], metadata["prefixes"]
+    graph = Graph().parse(data=metadata.get("triples", ""), format="nt")
+    lines, prefixes = compact_triples(graph)
+    return "\n".join(lines), format_prefixes(prefixes)
+
+
+def build_sparql_context(
+    question: str,
+    collection: Collection,
+    limit: int = 5,
+    embedding: Optional[Embedding] = None,
+    token_budget: Optional[int] = None,
+) -> SparqlContext:
+    """Retrieve triples from the k-nearest documents in the vector store,
+    rank them by relevance to the question and pack them into the token
+    budget. The statements precomputed at index time are concatenated
+    under the prefix declarations they use, without any RDF parsing."""
+
+    # Retrieve documents and triples from top k subjects
+    results = query_collection(question, collection, limit, embedding)
+    hits, declarations = [], {}
+    for metadata in results["metadatas"][0]:
+        context, prefixes = get_document_context(metadata)
+        hits.append(context)
+        declarations.update(dict.fromkeys(prefixes.splitlines()))
+    header = "\n".join(sorted(declarations))
+    if token_budget is not None:
+        token_budget = max(0, token_budget - estimate_tokens(header))
+    triples, n_dropped = pack_triples(rank_triples(question, hits), token_budget)
+    body = "\n".join(triples)
+    # Only declare the prefixes of the statements which were kept
+    header = "\n".join(line for line in sorted(declarations) if line.split()[1] in body)
+    return SparqlContext(f"{header}\n\n{body}\n", len(triples), n_dropped)
+
+
+def get_sparql_context(
+    question: str,
+    collection: Collection,
+    limit: int = 5,
+    embedding: Optional[Embedding] = None,
+    token_budget: Optional[int] = None,
+) -> str:
+    """Retrieve triples from the k-nearest documents in the vector store
+    and format them as turtle, within an optional token budget."""
+    return build_sparql_context(
+        question, collection, limit, embedding, token_budget
+    ).text
+
+
+def record_tokens(
+    metrics: Metrics, chain: str, llm_chain: LLMChain, inputs: dict, output: str
+):
+    """Count the estimated prompt and completion tokens of a LLM call.
+    Nothing is computed if metrics are disabled."""
+    if not metrics.enabled:
+        return
+    prompt = llm_chain.prompt.format(**inputs)
+    metrics.inc(LLM_TOKENS, estimate_tokens(prompt), chain=chain, kind="prompt")
+    metrics.inc(LLM_TOKENS, estimate_tokens(output), chain=chain, kind="completion")
+
+
 def generate_sparql(
     question: str,
     collection: Collection,
     llm_chain: LLMChain,
     examples: str = "",
     limit: int = 5,
+    embedding: Optional[Embedding] = None,
+    token_budget: Optional[int] = None,
 ) -> str:
     """Retrieve k-nearest documents from the vector store and synthesize
     SPARQL query."""
 
-    # Retrieve documents and triples from top k subjects
-    results = collection.query(query_texts=question, n_results=limit)
-    # Extract triples and concatenate as a ntriples string
-    triples = "\n".join([res.get("triples", "") for res in results["metadatas"][0]])
-    # Convert to turtle for better readability and fewer tokens
-    triples = Graph().parse(data=triples).serialize(format="turtle")
+    triples = get_sparql_context(question, collection, limit, embedding, token_budget)
     query = llm_chain.run(
         question_str=question, context_str=triples, examples_str=examples
     )
     return query
 
 
+async def agenerate_sparql(
+    question: str,
+    collection: Collection,
+    llm_chain: LLMChain,
+    examples: str = "",
+    limit: int = 5,
+    embedding: Optional[Embedding] = None,
+    executor: Optional[Executor] = None,
+    metrics: Metrics = NO_METRICS,
+    token_budget: Optional[int] = None,
+) -> str:
+    """Asynchronous variant of generate_sparql. The vector store lookup runs
+    in the executor and the LLM is called without blocking the event loop.
+    The lookup time, the size of the context and the number of triples
+    dropped from it are recorded in metrics."""
+
+    loop = asyncio.get_running_loop()
+    with metrics.time(STAGE_SECONDS, stage="retrieve_context"):
+        context = await loop.run_in_executor(
+            executor,
+            build_sparql_context,
+            question,
+            collection,
+            limit,
+            embedding,
+            token_budget,
+        )
+    inputs = dict(
+        question_str=question, context_str=context.text, examples_str=examples
+    )
+    query = await llm_chain.arun(**inputs)
+    if metrics.enabled:
+        context_tokens = estimate_tokens(context.text)
+        metrics.inc(LLM_TOKENS, context_tokens, chain="sparql", kind="context")
+        metrics.inc(CONTEXT_TRIPLES, context.n_triples, kind="kept")
+        metrics.inc(CONTEXT_TRIPLES, context.n_dropped, kind="dropped")
+        record_tokens(metrics, "sparql", llm_chain, inputs, query)
+    return query
+
+
 def generate_examples(
     question: str,
     collection: Collection,
     limit: int = 5,
+    embedding: Optional[Embedding] = None,
 ) -> str:
     """Retrieve k-nearest questions from the examples in the vector store and return them
     together with their correponding query."""
 
     # Retrieve documents and triples from top k subjects
-    examples = collection.query(query_texts=question, n_results=limit)
+    examples = query_collection(question, collection, limit, embedding)
     # Extract relevant information from dict
     example_docs = examples["documents"][0]
     example_meta = examples["metadatas"][0]
@@ -102,19 +352,89 @@ def generate_examples(
     return example_prompt
 
 
+def format_results(
+    results: Iterable[Any], token_budget: Optional[int] = None
+) -> list[str]:
+    """Format query results to be inserted in the answer prompt. A note is
+    added to results which were truncated to fit in the query limits.
+    Results larger than the token budget are replaced by a summary."""
+    # Each row has at least one token, so the full text is not needed
+    if token_budget is not None and count_results(results) > token_budget:
+        return [summarize_results(results, token_budget)]
+    if isinstance(results, ColumnarResults):
+        results = results.to_table()
+    text = "\n".join(map(str, results))
+    if getattr(results, "truncated", False):
+        text += "\n(results truncated, more rows exist)"
+    # Tokens are rarely longer than 8 characters, so long texts are over budget
+    if token_budget is not None and (
+        len(text) > 8 * token_budget or estimate_tokens(text) > token_budget
+    ):
+        text = summarize_results(results, token_budget)
+    return [text]
+
+
 def generate_answer(
     question: str,
     query: str,
     results: Iterable[Any],
     llm_chain: LLMChain,
+    token_budget: Optional[int] = None,
 ) -> str:
     """
     Given a question, associated SPARQL query and execution result,
     use a LLM to generate a natural language answer describing the results.
+    Results larger than the token budget are summarized.
     """
     # Extract triples and concatenate as a ntriples string
-    fmt_results = ["\n".join(map(str, results))]
+    fmt_results = format_results(results, token_budget)
     answer = llm_chain.run(
         query_str=query, question_str=question, result_str=fmt_results
     )
     return answer
+
+
+async def agenerate_answer(
+    question: str,
+    query: str,
+    results: Iterable[Any],
+    llm_chain: LLMChain,
+    metrics: Metrics = NO_METRICS,
+    token_budget: Optional[int] = None,
+) -> str:
+    """Asynchronous variant of generate_answer."""
+    fmt_results = format_results(results, token_budget)
+    inputs = dict(query_str=query, question_str=question, result_str=fmt_results)
+    answer = await llm_chain.arun(**inputs)
+    record_tokens(metrics, "answer", llm_chain, inputs, answer)
+    return answer
+
+
+async def astream_answer(
+    question: str,
+    query: str,
+    results: Iterable[Any],
+    llm_chain: LLMChain,
+    metrics: Metrics = NO_METRICS,
+    token_budget: Optional[int] = None,
+) -> AsyncIterator[str]:
+    """Streaming variant of generate_answer, yielding answer tokens as the
+    LLM produces them. The LLM must be configured with streaming enabled,
+    otherwise the whole answer is yielded at once when it is complete."""
+    fmt_results = format_results(results, token_budget)
+    inputs = dict(query_str=query, question_str=question, result_str=fmt_results)
+    handler = AsyncIteratorCallbackHandler()
+    task = asyncio.create_task(llm_chain.arun(**inputs, callbacks=[handler]))
+    # Stop iterating if the chain fails before the LLM is called
+    task.add_done_callback(lambda _: handler.done.set())
+    streamed = False
+    try:
+        async for token in handler.aiter():
+            streamed = True
+            yield token
+        answer = await task
+    finally:
+        task.cancel()
+    record_tokens(metrics, "answer", llm_chain, inputs, answer)
+    if not streamed:
+        yield answer
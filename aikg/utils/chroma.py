@@ -15,8 +15,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import threading
+from typing import Optional
+import uuid
+
 import chromadb
 from chromadb.api import ClientAPI, Collection
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from langchain.schema import Document
+
+from aikg.utils.cache import EmbeddingCache
 
 
 def setup_client(host: str, port: int, persist_directory: str = ".chroma") -> ClientAPI:
@@ -28,19 +37,129 @@ def setup_client(host: str, port: int, persist_directory: str = ".chroma") -> Cl
     return chroma_client
 
 
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Sentence-transformers embedding function backed by a persistent
+    embedding cache. The model is only loaded when an embedding is missing
+    from the cache.
+
+    Attributes
+    ----------
+    n_computed:
+        Number of embeddings computed by the model.
+    """
+
+    def __init__(self, embedding_model: str, cache: EmbeddingCache):
+        self.embedding_model = embedding_model
+        self.cache = cache
+        self.n_computed = 0
+        self._embed: Optional[EmbeddingFunction] = None
+        self._lock = threading.Lock()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        texts = list(input)
+        embeddings = self.cache.get_many(self.embedding_model, texts)
+        missing = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+        if not missing:
+            return embeddings
+
+        with self._lock:
+            if self._embed is None:
+                self._embed = setup_embedding_function(self.embedding_model)
+        computed = self._embed(missing)
+        self.n_computed += len(missing)
+        self.cache.put_many(self.embedding_model, missing, computed)
+        lookup = dict(zip(missing, computed))
+        return [lookup[t] if e is None else e for t, e in zip(texts, embeddings)]
+
+
+def setup_embedding_cache(
+    path: Optional[str], max_entries: int = 1_000_000
+) -> Optional[EmbeddingCache]:
+    """Open the persistent embedding cache, if a path is provided."""
+    if not path:
+        return None
+    return EmbeddingCache(path, max_entries=max_entries)
+
+
+def setup_embedding_function(
+    embedding_model: str, cache: Optional[EmbeddingCache] = None
+) -> EmbeddingFunction:
+    """Load a sentence-transformers embedding function. The underlying model
+    is loaded once and shared by all embedding functions using it. If a cache
+    is provided, embeddings are read from and stored to it."""
+
+    if cache is not None:
+        return CachedEmbeddingFunction(embedding_model, cache)
+
+    from chromadb.utils import embedding_functions
+
+    return embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name=embedding_model
+    )
+
+
 def setup_collection(
     client: ClientAPI,
     collection_name: str,
     embedding_model: str,
+    cache: Optional[EmbeddingCache] = None,
 ) -> Collection:
     """Setup the connection to ChromaDB collection."""
 
-    from chromadb.utils import embedding_functions
-
-    embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name=embedding_model
-    )
+    embedding_function = setup_embedding_function(embedding_model, cache=cache)
     collection = client.get_or_create_collection(
         collection_name, embedding_function=embedding_function
     )
     return collection
+
+
+def make_document_id(doc: Document) -> str:
+    """Derive a deterministic identifier for a document from its subject URI
+    and a hash of its content, so that unchanged documents keep the same
+    identifier across index builds. Documents of the same subject built
+    from different graphs have different identifiers."""
+    subject = doc.metadata.get("subject", "")
+    if doc.metadata.get("graph"):
+        subject = f"{doc.metadata['graph']} {subject}"
+    content = "\n".join([doc.page_content, doc.metadata.get("triples", "")])
+    subject_hash = hashlib.sha256(subject.encode("utf-8")).hexdigest()[:32]
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+    return f"{subject_hash}-{content_hash}"
+
+
+def get_collection_ids(
+    collection: Collection, page_size: int = 10000, graph: Optional[str] = None
+) -> set[str]:
+    """Retrieve the identifiers of all documents in a collection, by pages.
+    If graph is given, only documents built from that graph are included,
+    where documents without a recorded graph were built from all subjects."""
+    ids: set[str] = set()
+    offset = 0
+    include = [] if graph is None else ["metadatas"]
+    while True:
+        page = collection.get(include=include, limit=page_size, offset=offset)
+        if graph is None:
+            ids.update(page["ids"])
+        else:
+            ids.update(
+                doc_id
+                for doc_id, meta in zip(page["ids"], page["metadatas"])
+                if (meta or {}).get("graph", "") == graph
+            )
+        if len(page["ids"]) < page_size:
+            return ids
+        offset += page_size
+
+
+def mark_collection_build(collection: Collection):
+    """Record a new build identifier in the collection metadata, so that
+    clients can detect when the collection has been rebuilt."""
+    metadata = dict(collection.metadata or {})
+    metadata["build_id"] = str(uuid.uuid4())
+    collection.modify(metadata=metadata)
+
+
+def get_collection_build(client: ClientAPI, collection_name: str) -> Optional[str]:
+    """Retrieve the current build identifier of a collection from the server."""
+    collection = client.get_collection(collection_name, embedding_function=None)
+    return (collection.metadata or {}).get("build_id")
@@ -0,0 +1,503 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Columnar, typed representation of query results.
+
+Each column of the results is an array of integer identifiers in a
+dictionary of RDF terms shared by all columns. Raw values are first
+deduplicated, so that each distinct term is only decoded once, which makes
+large results with repeated values fast to decode. Terms keep their
+datatype and language, unlike CSV results.
+
+SELECT results are requested as SPARQL JSON or TSV, ASK results as SPARQL
+JSON and CONSTRUCT / DESCRIBE results as N-Triples, which are decoded into
+subject, predicate and object columns."""
+
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from functools import partial
+import asyncio
+import json
+import math
+import re
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import httpx
+import numpy as np
+from rdflib import BNode, Graph, Literal, URIRef
+from rdflib.namespace import XSD
+from rdflib.plugins.parsers.ntriples import unquote
+from rdflib.query import Result
+from SPARQLWrapper import SPARQLWrapper
+
+from aikg.utils.ntriples import parse_statement
+from aikg.utils.rdf import (
+    QueryCache,
+    QueryLimits,
+    ResultTable,
+    afetch_results,
+    limit_query,
+    prepare_query,
+    query_timeout,
+    term_to_str,
+    truncate_lines,
+)
+
+# Media type of each result format
+MEDIA_TYPES = {
+    "json": "application/sparql-results+json",
+    "tsv": "text/tab-separated-values",
+    "nt": "application/n-triples",
+}
+GRAPH_VARIABLES = ["subject", "predicate", "object"]
+NUMERIC_TYPES = {
+    XSD[name]
+    for name in [
+        "integer",
+        "decimal",
+        "double",
+        "float",
+        "int",
+        "long",
+        "short",
+        "byte",
+        "nonNegativeInteger",
+        "positiveInteger",
+        "nonPositiveInteger",
+        "negativeInteger",
+        "unsignedInt",
+        "unsignedLong",
+        "unsignedShort",
+        "unsignedByte",
+    ]
+}
+# Identifier of unbound values in columns
+UNBOUND = -1
+
+
+@dataclass
+class ColumnarResults:
+    """Query results stored by column.
+
+    Attributes
+    ----------
+    variables:
+        Names of the columns. Graph results have the columns subject,
+        predicate and object.
+    columns:
+        Array of term identifiers for each variable, UNBOUND (-1) marking
+        unbound values.
+    terms:
+        Dictionary of the RDF terms present in the results.
+    truncated:
+        Whether results were cut to fit in the query limits.
+    """
+
+    variables: List[str]
+    columns: Dict[str, np.ndarray]
+    terms: List[Any]
+    truncated: bool = False
+
+    def __len__(self) -> int:
+        if not self.variables:
+            return 0
+        return len(self.columns[self.variables[0]])
+
+    def column(self, name: str) -> List[Any]:
+        """Return the terms of a column, with None for unbound values."""
+        terms = self.terms + [None]
+        return [terms[i] for i in self.columns[name]]
+
+    def to_array(self) -> np.ndarray:
+        """Return a 2D array of the values of the results formatted as in CSV
+        results, with empty strings for unbound values."""
+        # Unbound values (-1) index the empty string at the end
+        labels = np.array([term_to_str(t) for t in self.terms] + [""], dtype=object)
+        table = np.empty((len(self), len(self.variables)), dtype=object)
+        for i, name in enumerate(self.variables):
+            table[:, i] = labels[self.columns[name]]
+        return table
+
+    def to_table(self) -> ResultTable:
+        """Convert to a result table as returned by query_kg for SELECT queries."""
+        table = ResultTable([list(self.variables)] + self.to_array().tolist())
+        table.truncated = self.truncated
+        return table
+
+    def numeric(self, name: str) -> np.ndarray:
+        """Return the values of a column as floats, with NaN for values which
+        are not numeric literals."""
+        values = [
+            float(term)
+            if getattr(term, "datatype", None) in NUMERIC_TYPES
+            else math.nan
+            for term in self.terms
+        ]
+        return np.array(values + [math.nan], dtype=np.float64)[self.columns[name]]
+
+    def triples(self) -> Iterator[Tuple[Any, Any, Any]]:
+        """Iterate over the triples of graph results."""
+        return zip(*(self.column(name) for name in GRAPH_VARIABLES))
+
+    def to_graph(self) -> Graph:
+        """Convert graph results to an rdflib Graph."""
+        graph = Graph()
+        for triple in self.triples():
+            graph.add(triple)
+        return graph
+
+    def head(self, n_rows: int) -> "ColumnarResults":
+        """Keep the first rows of the results."""
+        columns = {name: ids[:n_rows] for name, ids in self.columns.items()}
+        return ColumnarResults(self.variables, columns, self.terms, self.truncated)
+
+
+def parse_term(raw: str) -> Any:
+    """Parse an RDF term written in the SPARQL syntax used by TSV results,
+    which includes the N-Triples syntax.
+
+    Examples
+    --------
+    >>> parse_term("<http://ex.org/a>")
+    rdflib.term.URIRef('http://ex.org/a')
+    >>> parse_term('"caf\\\\u00e9"@fr')
+    rdflib.term.Literal('café', lang='fr')
+    >>> parse_term("42").datatype
+    rdflib.term.URIRef('http://www.w3.org/2001/XMLSchema#integer')
+    """
+    if raw.startswith("<"):
+        return URIRef(raw[1:-1])
+    if raw.startswith("_:"):
+        return BNode(raw[2:])
+    if raw[:1] in "\"'":
+        end = raw.rindex(raw[0])
+        value = unquote(raw[1:end])
+        suffix = raw[end + 1 :]
+        if suffix.startswith("@"):
+            return Literal(value, lang=suffix[1:])
+        if suffix.startswith("^^"):
+            return Literal(value, datatype=URIRef(suffix[3:-1]))
+        return Literal(value)
+    # Abbreviated numbers and booleans
+    if raw in ("true", "false"):
+        return Literal(raw, datatype=XSD.boolean)
+    if re.fullmatch(r"[+-]?\d+", raw):
+        return Literal(raw, datatype=XSD.integer)
+    if re.fullmatch(r"[+-]?\d*\.\d+", raw):
+        return Literal(raw, datatype=XSD.decimal)
+    return Literal(raw, datatype=XSD.double)
+
+
+def _encode(
+    values: Iterable[Hashable], dictionary: Dict[Hashable, int], n_rows: int
+) -> np.ndarray:
+    """Map values to their identifier in the dictionary, adding new values."""
+    values = list(values)
+    for value in dict.fromkeys(values):
+        if value not in dictionary:
+            dictionary[value] = len(dictionary) - 1
+    return np.fromiter(map(dictionary.__getitem__, values), np.int32, count=n_rows)
+
+
+def _from_columns(
+    variables: List[str],
+    columns: Iterable[Sequence[Hashable]],
+    n_rows: int,
+    unbound: Hashable,
+    decode: Callable[[Hashable], Any],
+) -> ColumnarResults:
+    """Build columnar results from columns of raw values, decoding each
+    distinct raw value into a term once."""
+    dictionary = {unbound: UNBOUND}
+    encoded = {
+        name: _encode(values, dictionary, n_rows)
+        for name, values in zip(variables, columns)
+    }
+    terms = [decode(raw) for raw in list(dictionary)[1:]]
+    return ColumnarResults(variables, encoded, terms)
+
+
+def _from_rows(
+    variables: List[str],
+    rows: List[Tuple],
+    unbound: Hashable,
+    decode: Callable[[Hashable], Any],
+) -> ColumnarResults:
+    """Build columnar results from rows of raw values."""
+    columns = zip(*rows) if rows else [()] * len(variables)
+    return _from_columns(variables, columns, len(rows), unbound, decode)
+
+
+def _json_term(key: Tuple[Tuple[str, str], ...]) -> Any:
+    term = dict(key)
+    if term["type"] == "uri":
+        return URIRef(term["value"])
+    if term["type"] == "bnode":
+        return BNode(term["value"])
+    return Literal(
+        term["value"], lang=term.get("xml:lang"), datatype=term.get("datatype")
+    )
+
+
+_JSON_HEAD = re.compile(r'"head"\s*:\s*')
+_JSON_BINDINGS = re.compile(r'"bindings"\s*:\s*\[\s*')
+_JSON_SEPARATOR = re.compile(r"\s*,\s*")
+
+
+def load_json_prefix(text: str) -> Dict[str, Any]:
+    """Load the head and the complete bindings of SPARQL JSON results which
+    were cut, e.g. to fit in a byte budget. Bindings are decoded one at a
+    time until the first incomplete one.
+
+    Examples
+    --------
+    >>> text = '{"head": {"vars": ["s"]}, "results": {"bindings": [{"s": 1}, {"s'
+    >>> load_json_prefix(text)
+    {'head': {'vars': ['s']}, 'results': {'bindings': [{'s': 1}]}}
+    """
+    decoder = json.JSONDecoder()
+    head = _JSON_HEAD.search(text)
+    if head is None:
+        raise ValueError("Invalid SPARQL JSON results: head not found")
+    doc = {"head": decoder.raw_decode(text, head.end())[0], "results": {}}
+    bindings = doc["results"]["bindings"] = []
+    match = _JSON_BINDINGS.search(text, head.end())
+    pos = match.end() if match else len(text)
+    while pos < len(text):
+        try:
+            binding, pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            break
+        bindings.append(binding)
+        separator = _JSON_SEPARATOR.match(text, pos)
+        if separator is None:
+            break
+        pos = separator.end()
+    return doc
+
+
+def decode_json(data: bytes, partial: bool = False) -> ColumnarResults:
+    """Decode SPARQL JSON results. ASK results have a single boolean column.
+    If partial is set, the results were cut and only their complete bindings
+    are decoded.
+
+    Examples
+    --------
+    >>> res = decode_json(b'''{"head": {"vars": ["s", "l"]}, "results": {"bindings": [
+    ...     {"s": {"type": "uri", "value": "http://ex.org/a"},
+    ...      "l": {"type": "literal", "value": "a", "xml:lang": "en"}},
+    ...     {"s": {"type": "bnode", "value": "b0"}}]}}''')
+    >>> res.column("l")
+    [rdflib.term.Literal('a', lang='en'), None]
+    """
+    if partial:
+        # The data may be cut in the middle of a multibyte character
+        doc = load_json_prefix(data.decode("utf-8", errors="ignore"))
+    else:
+        doc = json.loads(data)
+    if "boolean" in doc:
+        value = Literal(doc["boolean"])
+        return _from_rows(["boolean"], [(value,)], None, lambda term: term)
+    variables = doc["head"].get("vars", [])
+    bindings = doc["results"]["bindings"]
+    # The items of JSON terms are hashable, to decode distinct terms once
+    columns = [
+        [tuple(row[name].items()) if name in row else None for row in bindings]
+        for name in variables
+    ]
+    return _from_columns(variables, columns, len(bindings), None, _json_term)
+
+
+def decode_tsv(data: bytes) -> ColumnarResults:
+    """Decode SPARQL TSV results.
+
+    Examples
+    --------
+    >>> res = decode_tsv(b'?s\\t?n\\n<http://ex.org/a>\\t42\\n<http://ex.org/b>\\t\\n')
+    >>> res.to_table()
+    [['s', 'n'], ['http://ex.org/a', '42'], ['http://ex.org/b', '']]
+    >>> res.numeric("n")
+    array([42., nan])
+    """
+    text = data.decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n")
+    header, _, body = text.partition("\n")
+    variables = [name.lstrip("?$") for name in header.split("\t")] if header else []
+    body = body[:-1] if body.endswith("\n") else body
+    # All rows have one cell per variable, so that the cells of a column
+    # are evenly spaced in the flat list of cells.
+    cells = body.replace("\t", "\n").split("\n") if body else []
+    n_cols = len(variables)
+    if n_cols == 0 or len(cells) % n_cols:
+        if cells:
+            raise ValueError("Invalid TSV results: rows have different lengths")
+        n_cols = max(n_cols, 1)
+    columns = [cells[i::n_cols] for i in range(len(variables))]
+    return _from_columns(variables, columns, len(cells) // n_cols, "", parse_term)
+
+
+def decode_ntriples(data: bytes) -> ColumnarResults:
+    """Decode N-Triples graph results into subject, predicate and object columns."""
+    statements = map(parse_statement, data.decode("utf-8").splitlines())
+    rows = [statement[:3] for statement in statements if statement is not None]
+    return _from_rows(GRAPH_VARIABLES, rows, None, parse_term)
+
+
+DECODERS = {"json": decode_json, "tsv": decode_tsv, "nt": decode_ntriples}
+
+
+def from_rdflib(resp: Result) -> ColumnarResults:
+    """Convert the results of a query on an rdflib graph, without serializing
+    them."""
+    if resp.type == "ASK":
+        return _from_rows(["boolean"], [(Literal(resp.askAnswer),)], None, lambda t: t)
+    if resp.type == "SELECT":
+        variables = [str(var) for var in resp.vars]
+        rows = [tuple(row) for row in resp]
+    else:
+        variables = GRAPH_VARIABLES
+        rows = list(resp.graph)
+    return _from_rows(variables, rows, None, lambda term: term)
+
+
+def _result_format(kg: SPARQLWrapper, query: str, fmt: str) -> str:
+    kg.setQuery(query)
+    if kg.queryType in ("CONSTRUCT", "DESCRIBE"):
+        return "nt"
+    if kg.queryType == "ASK":
+        return "json"
+    return fmt
+
+
+def _apply_limits(
+    results: ColumnarResults, limits: Optional[QueryLimits]
+) -> ColumnarResults:
+    if limits is not None and len(results) > limits.max_rows:
+        results = results.head(limits.max_rows)
+        results.truncated = True
+    return results
+
+
+def _decode(data: bytes, fmt: str, limits: Optional[QueryLimits]) -> ColumnarResults:
+    truncated = False
+    if limits is None:
+        results = DECODERS[fmt](data)
+    elif fmt == "json":
+        truncated = len(data) > limits.max_bytes
+        results = decode_json(data[: limits.max_bytes], partial=truncated)
+    else:
+        data, truncated = truncate_lines(data, limits.max_bytes)
+        results = DECODERS[fmt](data)
+    results = _apply_limits(results, limits)
+    results.truncated = results.truncated or truncated
+    return results
+
+
+def query_kg_columns(
+    kg: Graph | SPARQLWrapper,
+    query: str,
+    fmt: str = "tsv",
+    cache: Optional[QueryCache] = None,
+    limits: Optional[QueryLimits] = None,
+) -> ColumnarResults:
+    """Query a knowledge graph, either an rdflib Graph or a SPARQLWrapper,
+    and return columnar results. Results of rdflib graphs are converted
+    without being serialized.
+
+    Parameters
+    ----------
+    kg:
+        Knowledge graph to query.
+    query:
+        SPARQL query to run.
+    fmt:
+        Format of SELECT results requested from SPARQL endpoints, "json" or
+        "tsv". TSV is more compact and faster to decode.
+    cache:
+        Cache of query results. It should only be used for columnar results.
+    limits:
+        Limits on the query execution and results, as in query_kg.
+    """
+    if cache is not None:
+        key, results = cache.get(query, limits)
+        if results is not None:
+            return results
+        results = query_kg_columns(kg, query, fmt, limits=limits)
+        cache.put(key, results)
+        return results
+
+    if limits is not None:
+        query = limit_query(query, limits.max_rows + 1)
+    if isinstance(kg, Graph):
+        return _apply_limits(from_rdflib(kg.query(prepare_query(query, kg))), limits)
+    elif not isinstance(kg, SPARQLWrapper):
+        raise ValueError(f"Invalid type for kg: {type(kg)}")
+
+    fmt = _result_format(kg, query, fmt)
+    kg.setReturnFormat(fmt)
+    with query_timeout(kg, limits):
+        data = kg.query().response.read()
+    return _decode(data, fmt, limits)
+
+
+async def aquery_kg_columns(
+    kg: Graph | SPARQLWrapper,
+    query: str,
+    client: httpx.AsyncClient,
+    executor: Optional[Executor] = None,
+    fmt: str = "tsv",
+    cache: Optional[QueryCache] = None,
+    limits: Optional[QueryLimits] = None,
+) -> ColumnarResults:
+    """Asynchronous variant of query_kg_columns, using a shared async HTTP
+    client for SPARQL endpoints and a worker thread for rdflib graphs.
+    Responses are decoded in the executor."""
+    loop = asyncio.get_running_loop()
+    timeout = limits.timeout if limits is not None else None
+    if isinstance(kg, Graph):
+        run = partial(query_kg_columns, kg, query, fmt, cache, limits)
+        return await asyncio.wait_for(loop.run_in_executor(executor, run), timeout)
+    elif not isinstance(kg, SPARQLWrapper):
+        raise ValueError(f"Invalid type for kg: {type(kg)}")
+
+    if cache is not None:
+        key, results = await loop.run_in_executor(executor, cache.get, query, limits)
+        if results is not None:
+            return results
+
+    if limits is not None:
+        query = await loop.run_in_executor(
+            executor, limit_query, query, limits.max_rows + 1
+        )
+    fmt = _result_format(kg, query, fmt)
+    data = await afetch_results(kg, query, client, MEDIA_TYPES[fmt], limits)
+    results = await loop.run_in_executor(executor, _decode, data, fmt, limits)
+    if cache is not None:
+        cache.put(key, results)
+    return results
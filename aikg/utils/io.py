@@ -15,13 +15,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bz2
+import gzip
+import lzma
 import requests
 from pathlib import Path
-from typing import TextIO
+from typing import IO, TextIO
 from langchain.schema import Document
 from tqdm import tqdm
 
 
+# Openers of compressed files, by file extension
+COMPRESSIONS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def is_compressed(path: str | Path) -> bool:
+    """Check if a file is compressed, based on its extension."""
+    return Path(path).suffix in COMPRESSIONS
+
+
+def strip_compression(path: str | Path) -> str:
+    """Remove the compression extension from a path, if any.
+
+    Examples
+    --------
+    >>> strip_compression("dump.nq.gz")
+    'dump.nq'
+    >>> strip_compression("dump.nt")
+    'dump.nt'
+    """
+    if is_compressed(path):
+        return str(Path(path).with_suffix(""))
+    return str(path)
+
+
+def open_file(path: str | Path, mode: str = "rb") -> IO:
+    """Open a file, decompressing it on the fly if it is compressed
+    with gzip, bzip2 or xz."""
+    opener = COMPRESSIONS.get(Path(path).suffix, open)
+    return opener(path, mode)
+
+
 def download_file(url: str, output_path: str | Path):
     # send a GET request to the URL to download the file. Stream since it's large
     response = requests.get(url, stream=True)
@@ -30,3 +30,16 @@ def setup_llm_chain(llm: LLM, prompt_template: str) -> LLMChain:
         input_variables=variables,
     )
     return LLMChain(prompt=prompt, llm=llm)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text by counting words and
+    punctuation marks, which is close to the count of BPE tokenizers
+    on English text and RDF, without loading a tokenizer.
+
+    Examples
+    --------
+    >>> estimate_tokens("What is a Person?")
+    5
+    """
+    return len(re.findall(r"\w+|[^\w\s]", text))
@@ -0,0 +1,172 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight in-process metrics, exported in the Prometheus text format.
+When disabled, recording a metric is a no-op."""
+import bisect
+from contextlib import contextmanager, nullcontext
+import threading
+from time import perf_counter
+from typing import ContextManager, Dict, Iterator, List, Sequence, Tuple
+
+# Upper bounds of latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Names of the metrics recorded by the chat server
+STAGE_SECONDS = "aikg_stage_duration_seconds"
+REQUEST_SECONDS = "aikg_request_duration_seconds"
+LLM_TOKENS = "aikg_llm_tokens_total"
+CONTEXT_TRIPLES = "aikg_context_triples_total"
+TRUNCATED_RESULTS = "aikg_truncated_results_total"
+CACHE_HITS = "aikg_cache_hits_total"
+CACHE_MISSES = "aikg_cache_misses_total"
+CACHE_SIZE = "aikg_cache_size"
+COMPONENT_READY_SECONDS = "aikg_component_ready_seconds"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, **extra: str) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms identified by a name and
+    a set of labels.
+
+    Parameters
+    ----------
+    enabled:
+        Whether metrics are recorded. If False, all methods return immediately.
+    buckets:
+        Upper bounds of histogram buckets.
+
+    Examples
+    --------
+    >>> metrics = Metrics()
+    >>> metrics.inc("requests_total", path="/ask/")
+    >>> metrics.observe("latency_seconds", 0.3, buckets=(0.1, 1))
+    >>> print(metrics.render())
+    # TYPE requests_total counter
+    requests_total{path="/ask/"} 1.0
+    # TYPE latency_seconds histogram
+    latency_seconds_bucket{le="0.1"} 0
+    latency_seconds_bucket{le="1"} 1
+    latency_seconds_bucket{le="+Inf"} 1
+    latency_seconds_sum 0.3
+    latency_seconds_count 1
+    <BLANKLINE>
+    """
+
+    def __init__(
+        self, enabled: bool = True, buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._types: Dict[str, str] = {}
+        self._values: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Tuple[tuple, List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1.0, **labels: str):
+        """Increment a counter."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, "counter")
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set_total(self, name: str, value: float, **labels: str):
+        """Set a counter to a total counted elsewhere, which never decreases."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, "counter")
+            self._values[key] = float(value)
+
+    def set(self, name: str, value: float, **labels: str):
+        """Set the value of a gauge."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, "gauge")
+            self._values[key] = float(value)
+
+    def observe(
+        self, name: str, value: float, buckets: Sequence[float] = (), **labels: str
+    ):
+        """Record a value in a histogram."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, "histogram")
+            if key not in self._histograms:
+                bounds = tuple(buckets) or self.buckets
+                # One count per bucket, then +Inf, sum and count
+                self._histograms[key] = (bounds, [0.0] * (len(bounds) + 3))
+            bounds, counts = self._histograms[key]
+            counts[bisect.bisect_left(bounds, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, name: str, **labels: str) -> ContextManager:
+        """Measure the duration of a block of code into a histogram."""
+        if not self.enabled:
+            return nullcontext()
+        return self._time(name, **labels)
+
+    @contextmanager
+    def _time(self, name: str, **labels: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        """Format all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, kind in self._types.items():
+                lines.append(f"# TYPE {name} {kind}")
+                for (key, labels), value in self._values.items():
+                    if key == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+                for (key, labels), (bounds, counts) in self._histograms.items():
+                    if key != name:
+                        continue
+                    total = 0
+                    for bound, count in zip(bounds + ("+Inf",), counts):
+                        total += int(count)
+                        le = _format_labels(labels, le=str(bound))
+                        lines.append(f"{name}_bucket{le} {total}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {counts[-2]}")
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {int(counts[-1])}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry for callers which do not record metrics
+NO_METRICS = Metrics(enabled=False)
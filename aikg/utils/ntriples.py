@@ -0,0 +1,136 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight streaming reader for line-based RDF formats (N-Triples and
+N-Quads). Terms are kept as their N-Triples representation, which is also
+valid SPARQL syntax, so that statements can be sent to an endpoint without
+building rdflib objects."""
+from dataclasses import dataclass
+import re
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional
+
+_IRI = r"<[^<>\"{}|^`\\\s]*>"
+_BNODE = r"_:[^\s.<\"]+(?:\.+[^\s.<\"]+)*"
+_LITERAL = r'"(?:[^"\\\n\r]|\\.)*"(?:@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*|\^\^' + _IRI + ")?"
+_STATEMENT = re.compile(
+    rf"\s*({_IRI}|{_BNODE})\s*({_IRI})\s*({_IRI}|{_BNODE}|{_LITERAL})"
+    rf"\s*({_IRI}|{_BNODE})?\s*\.\s*(?:#.*)?"
+)
+_IGNORED = re.compile(r"\s*(?:#.*)?")
+
+
+class Statement(NamedTuple):
+    """A triple, or a quad if graph is set. Terms are in N-Triples syntax."""
+
+    subject: str
+    predicate: str
+    object: str
+    graph: Optional[str] = None
+
+    def to_ntriples(self) -> str:
+        """Format the statement as an N-Triples line, without the graph."""
+        return f"{self.subject} {self.predicate} {self.object} ."
+
+
+def parse_statement(line: str) -> Optional[Statement]:
+    """Parse a line of N-Triples or N-Quads. Returns None for empty
+    lines and comments.
+
+    Examples
+    --------
+    >>> parse_statement('<http://a> <http://b> "c"@en <http://g> .')
+    Statement(subject='<http://a>', predicate='<http://b>', object='"c"@en', graph='<http://g>')
+    >>> parse_statement("# comment") is None
+    True
+    """
+    match = _STATEMENT.fullmatch(line.rstrip("\r\n"))
+    if match is None:
+        if _IGNORED.fullmatch(line.rstrip("\r\n")):
+            return None
+        raise ValueError(f"Invalid N-Triples or N-Quads statement: {line!r}")
+    return Statement(*match.groups())
+
+
+def skolemize(statement: Statement, base: str) -> Statement:
+    """Replace the blank nodes of a statement by IRIs made of a base and
+    their label. Blank node labels are scoped to a single document, so
+    statements about the same blank node must be skolemized before they
+    are sent in separate requests.
+
+    Examples
+    --------
+    >>> skolemize(Statement("_:b1", "<http://p>", "_:b2"), "urn:x:")
+    Statement(subject='<urn:x:b1>', predicate='<http://p>', object='<urn:x:b2>', graph=None)
+    """
+    return Statement(
+        *(
+            f"<{base}{term[2:]}>" if term and term.startswith("_:") else term
+            for term in statement
+        )
+    )
+
+
+@dataclass
+class Chunk:
+    """A chunk of statements read from a file, with the byte offsets
+    of the lines it spans."""
+
+    statements: List[Statement]
+    start: int
+    end: int
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+
+def read_chunks(
+    source: BinaryIO,
+    chunk_size: int = 1000,
+    offset: int = 0,
+    bnode_base: Optional[str] = None,
+) -> Iterator[Chunk]:
+    """Stream chunks of statements from a binary N-Triples or N-Quads file.
+
+    Parameters
+    ----------
+    source:
+        File opened in binary mode, positioned at the given offset.
+    chunk_size:
+        Maximum number of statements per chunk.
+    offset:
+        Byte offset of the current position in the file.
+    bnode_base:
+        If set, blank nodes are replaced by IRIs starting with this base,
+        so that a blank node spanning several chunks stays a single node.
+    """
+    statements: List[Statement] = []
+    start = offset
+    for line in source:
+        try:
+            statement = parse_statement(line.decode("utf-8"))
+        except ValueError as err:
+            raise ValueError(f"At byte offset {offset}: {err}") from err
+        offset += len(line)
+        if statement is not None:
+            if bnode_base is not None and b"_:" in line:
+                statement = skolemize(statement, bnode_base)
+            statements.append(statement)
+        if len(statements) >= chunk_size:
+            yield Chunk(statements, start, offset)
+            statements, start = [], offset
+    if statements:
+        yield Chunk(statements, start, offset)
@@ -0,0 +1,174 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utilities to run multi-stage processing pipelines, where stages run
+concurrently in threads and are connected by bounded queues."""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+import threading
+from time import perf_counter
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+# Marks the end of the stream in a queue
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    """Number of items processed by a pipeline stage and its wall-clock time."""
+
+    name: str
+    items: int = 0
+    start: Optional[float] = None
+    end: Optional[float] = None
+
+    def record(self, n_items: int, start: float, end: float):
+        self.items += n_items
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+
+    @property
+    def elapsed(self) -> float:
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    @property
+    def throughput(self) -> float:
+        """Items processed per second."""
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.items} items in {self.elapsed:.2f}s "
+            f"({self.throughput:.1f} items/s)"
+        )
+
+
+def run_pipeline(
+    source: Iterable[Any],
+    stages: Sequence[Tuple[str, Callable[[Any], Any], int]],
+    queue_size: int = 4,
+    size: Callable[[Any], int] = len,
+) -> List[StageStats]:
+    """Stream items from a source through successive processing stages.
+
+    The source and each stage run in separate threads and are connected by
+    bounded queues, so that stages overlap while memory stays bounded.
+    If any stage fails, the pipeline is stopped and the error is raised.
+
+    Parameters
+    ----------
+    source:
+        Iterable of items to process, read in a dedicated thread.
+    stages:
+        Sequence of (name, function, n_workers) tuples. Each function receives
+        the output of the previous stage. The output of the last stage is
+        discarded.
+    queue_size:
+        Maximum number of items waiting between two stages.
+    size:
+        Function giving the number of elements in an item, used for statistics.
+
+    Returns
+    -------
+    Statistics of the source and of each stage.
+
+    Examples
+    --------
+    >>> stats = run_pipeline([[1, 2], [3]], [("double", lambda x: x * 2, 2)])
+    >>> [s.items for s in stats]
+    [3, 3]
+    """
+    queues: List[Queue] = [Queue(maxsize=queue_size) for _ in stages]
+    stats = [StageStats("source")] + [StageStats(name) for name, _, _ in stages]
+    remaining = [n_workers for _, _, n_workers in stages]
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors: List[BaseException] = []
+
+    def put(queue: Queue, item: Any):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def get(queue: Queue) -> Any:
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return _DONE
+
+    def fail(err: BaseException):
+        errors.append(err)
+        stop.set()
+
+    def produce():
+        items = iter(source)
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                with lock:
+                    stats[0].record(size(item), start, perf_counter())
+                put(queues[0], item)
+        except BaseException as err:
+            fail(err)
+        finally:
+            for _ in range(stages[0][2]):
+                put(queues[0], _DONE)
+
+    def work(idx: int):
+        _, func, _ = stages[idx]
+        last = idx == len(stages) - 1
+        try:
+            while (item := get(queues[idx])) is not _DONE:
+                start = perf_counter()
+                out = func(item)
+                with lock:
+                    stats[idx + 1].record(size(item), start, perf_counter())
+                if not last:
+                    put(queues[idx + 1], out)
+        except BaseException as err:
+            fail(err)
+        finally:
+            # The last worker of a stage signals the end to the next stage
+            with lock:
+                remaining[idx] -= 1
+                signal = remaining[idx] == 0 and not last
+            if signal:
+                for _ in range(stages[idx + 1][2]):
+                    put(queues[idx + 1], _DONE)
+
+    n_threads = 1 + sum(remaining)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pool.submit(produce)
+        for idx, (_, _, n_workers) in enumerate(stages):
+            for _ in range(n_workers):
+                pool.submit(work, idx)
+
+    if errors:
+        raise errors[0]
+    return stats
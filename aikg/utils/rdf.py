@@ -15,16 +15,40 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+from concurrent.futures import Executor
+from contextlib import contextmanager
+import csv
+from dataclasses import dataclass
+from functools import partial
+import hashlib
+import io
 from itertools import groupby
+import math
+import re
+import threading
 from pathlib import Path
-from typing import Any, Dict, Iterable, Iterator, List, Optional
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
 
+import httpx
 from langchain.schema import Document
-from rdflib import ConjunctiveGraph, Graph
-from rdflib.exceptions import ParserError
+from more_itertools import chunked
+from rdflib import BNode, ConjunctiveGraph, Graph, Literal, URIRef
+from rdflib.compare import to_canonical_graph
+from rdflib.namespace import split_uri
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.sparql import Query
+from rdflib.util import guess_format
 from SPARQLWrapper import SPARQLWrapper, CSV
 from urllib.parse import urlparse
 
+from aikg.utils.cache import GenerationCounter, TTLCache
+from aikg.utils.io import is_compressed, open_file, strip_compression
+
+# Marker in the WHERE clause of queries paginated by key, replaced by a
+# filter starting the page after the last key of the previous page
+PAGE_FILTER = "#PAGE_FILTER"
+
 # Retrieve triples of human readable labels/values from a SPARQL endpoint.
 TRIPLE_LABEL_QUERY = """
 PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -49,7 +73,9 @@ WHERE
     FILTER(LANG(?oLabOrVal) = "{lang}" || LANG(?oLabOrVal) = "")
     BIND (REPLACE(STR(?oLabOrVal), "^.*[#/:]([^/:#]*)$", "$1") as ?oClean)
     {graph_mask}
+    {page_filter}
 }}
+ORDER BY ?s
 """
 
 # Retrieve each subject and its annotations
@@ -70,8 +96,28 @@ WHERE
         FILTER(LANG(?sLab) = "{lang}" || LANG(?sLab) = "")
         FILTER(LANG(?sCom) = "{lang}" || LANG(?sCom) = "")
         {graph_mask}
+        {page_filter}
 }}
 GROUP BY ?s ?sCom
+ORDER BY ?s
+"""
+
+# Retrieve the triples of a batch of subjects, along with the triples
+# of their blank node objects.
+SUBJECT_TRIPLES_QUERY = """
+CONSTRUCT {{
+    ?s ?p ?o .
+    ?o ?bp ?bo .
+}}
+WHERE
+{{
+    VALUES ?s {{ {subjects} }}
+    ?s ?p ?o .
+    OPTIONAL {{
+        ?o ?bp ?bo .
+        FILTER(isBlank(?o))
+    }}
+}}
 """
 
 
@@ -96,7 +142,8 @@ def setup_kg(
     endpoint: str, user: Optional[str] = None, password: Optional[str] = None
 ) -> Graph | SPARQLWrapper:
     """Try to connect to SPARQL endpoint. If not a URL, attempt
-    to parse RDF file with rdflib."""
+    to parse RDF file with rdflib. Files compressed with gzip, bzip2
+    or xz are decompressed on the fly."""
 
     if is_uri(endpoint):
         kg = SPARQLWrapper(endpoint)
@@ -105,42 +152,56 @@ def setup_kg(
             kg.setCredentials(user, password)
     else:
         kg = ConjunctiveGraph()
-        kg.parse(endpoint)
+        if is_compressed(endpoint):
+            with open_file(endpoint, "rb") as source:
+                kg.parse(
+                    source,
+                    format=guess_format(strip_compression(endpoint)),
+                    publicID=Path(endpoint).absolute().as_uri(),
+                )
+        else:
+            kg.parse(endpoint)
     return kg
 
 
 def split_documents_from_endpoint(
     kg: Graph | SPARQLWrapper,
     graph: Optional[str] = None,
+    page_size: Optional[int] = None,
 ) -> Iterator[Document]:
     """Load subject-based documents from a SPARQL endpoint.
+    Triples are ordered by subject on the endpoint, so that documents
+    are built while streaming, one subject at a time.
 
     Parameters
     ----------
-    endpoint:
-        URL of the SPARQL endpoint.
-    user:
-        Username to use for authentication.
-    password:
-        Password to use for authentication.
+    kg:
+        Knowledge graph to load RDF data from.
     graph:
         URI of named graph to load RDF data from.
         If not specified, all subjects are used.
+    page_size:
+        Number of rows to retrieve per query. If not specified,
+        all rows are retrieved in a single query. Pages are split
+        between subjects.
     """
 
     graph_mask = make_graph_mask(graph)
 
-    # Load the query results
+    # Stream the query results, ordered by subject
     # Query results contain 6 columns:
     # subject, predicate, object, subject label, predicate label, object label
-    results = query_kg(kg, TRIPLE_LABEL_QUERY.format(lang="en", graph_mask=graph_mask))
-    # skip header if present
-    if not is_uri(results[0][0]):
-        results = results[1:]
+    results = iter_query_kg(
+        kg,
+        TRIPLE_LABEL_QUERY.format(
+            lang="en", graph_mask=graph_mask, page_filter=PAGE_FILTER
+        ),
+        page_size=page_size,
+        key="s",
+    )
     # Exclude empty / incomplete results (e.g. missing labels)
     results = filter(lambda x: len(list(x)) == 6, results)
-    results = sorted(results, key=lambda x: x[0])[1:]
-    # Yield triples and text by subject
+    # Yield triples and text by subject, one subject in memory at a time
     for k, g in groupby(results, lambda x: x[0]):
         # Original triples about subject k
         data = list(g)
@@ -150,62 +211,765 @@ def split_documents_from_endpoint(
         yield Document(page_content=doc, metadata={"subject": k, "triples": triples})
 
 
+def describe_subjects(
+    kg: Graph | SPARQLWrapper, subjects: Iterable[str]
+) -> Dict[str, Graph]:
+    """Retrieve the triples describing multiple subjects in a single query.
+    Results are split by subject on the client side, each subject being
+    associated with its concise bounded description.
+
+    Parameters
+    ----------
+    kg:
+        Knowledge graph to query.
+    subjects:
+        URIs of the subjects to describe.
+    """
+    subjects = list(dict.fromkeys(subjects))
+    values = " ".join([f"<{sub}>" for sub in subjects])
+    triples = query_kg(kg, SUBJECT_TRIPLES_QUERY.format(subjects=values))
+
+    # Both SPARQLWrapper and rdflib return a ntriples string
+    g = Graph()
+    g.parse(data=triples[0][0], format="nt")
+    return {sub: g.cbd(URIRef(sub)) for sub in subjects}
+
+
+def canonicalize_bnodes(graph: Graph) -> Graph:
+    """Relabel the blank nodes of a graph deterministically, so that the same
+    triples are serialized identically across runs. Blank node labels
+    assigned by parsers are random, which would otherwise change the
+    identifiers of documents derived from the triples.
+
+    Examples
+    --------
+    >>> data = "<http://ex.org/a> <http://ex.org/p> [ <http://ex.org/q> 1 ] ."
+    >>> nt = [
+    ...     canonicalize_bnodes(Graph().parse(data=data, format="turtle"))
+    ...     .serialize(format="nt")
+    ...     for _ in range(2)
+    ... ]
+    >>> nt[0] == nt[1], "_:b0" in nt[0]
+    (True, True)
+    """
+    if not any(isinstance(term, BNode) for triple in graph for term in triple):
+        return graph
+    canonical = to_canonical_graph(graph)
+    # Canonical labels are long hashes, shortened to keep documents compact
+    bnodes = sorted(
+        {term for triple in canonical for term in triple if isinstance(term, BNode)}
+    )
+    labels = {bnode: BNode(f"b{i}") for i, bnode in enumerate(bnodes)}
+    relabelled = Graph()
+    for triple in canonical:
+        relabelled.add(tuple(labels.get(term, term) for term in triple))
+    return relabelled
+
+
+# Prefixes of well-known vocabularies, used in compact document triples
+KNOWN_PREFIXES = {
+    str(namespace): prefix
+    for prefix, namespace in Graph(bind_namespaces="rdflib").namespaces()
+}
+KNOWN_PREFIXES["http://schema.org/"] = "schema"
+
+
+def get_prefix(namespace: str) -> str:
+    """Get the prefix of a namespace in compact triples. Well-known
+    vocabularies keep their usual prefix, other namespaces get a prefix
+    derived from their hash, so that a namespace has the same prefix in
+    every document of an index.
+
+    Examples
+    --------
+    >>> get_prefix("http://www.w3.org/2000/01/rdf-schema#")
+    'rdfs'
+    >>> get_prefix("http://example.org/")
+    'nsbbf5ca'
+    """
+    if namespace in KNOWN_PREFIXES:
+        return KNOWN_PREFIXES[namespace]
+    return "ns" + hashlib.sha1(namespace.encode("utf-8")).hexdigest()[:6]
+
+
+def compact_term(term: Any, prefixes: Dict[str, str]) -> str:
+    """Format an RDF term in turtle, using a prefixed name for IRIs where
+    possible. The prefixes used are added to the prefixes mapping.
+
+    Examples
+    --------
+    >>> prefixes = {}
+    >>> compact_term(URIRef("http://example.org/Person"), prefixes)
+    'nsbbf5ca:Person'
+    >>> compact_term(Literal(3), prefixes)
+    '"3"^^xsd:integer'
+    >>> sorted(prefixes.values())
+    ['http://example.org/', 'http://www.w3.org/2001/XMLSchema#']
+    """
+    if isinstance(term, URIRef):
+        try:
+            namespace, name = split_uri(term)
+        except ValueError:
+            return term.n3()
+        # Turtle local names cannot end with a dot
+        if name.endswith("."):
+            return term.n3()
+        prefix = get_prefix(namespace)
+        prefixes[prefix] = namespace
+        return f"{prefix}:{name}"
+    if isinstance(term, Literal) and term.datatype is not None:
+        value = Literal(str(term)).n3()
+        return f"{value}^^{compact_term(term.datatype, prefixes)}"
+    return term.n3()
+
+
+def compact_triples(graph: Graph) -> Tuple[List[str], Dict[str, str]]:
+    """Format the triples of a graph as sorted turtle statements, one per
+    line, using prefixed names. Returns the statements and the mapping of
+    prefixes to namespaces which they use."""
+    prefixes: Dict[str, str] = {}
+    lines = {
+        " ".join(compact_term(term, prefixes) for term in triple) + " ."
+        for triple in graph
+    }
+    return sorted(lines), prefixes
+
+
+def format_prefixes(prefixes: Dict[str, str]) -> str:
+    """Format a mapping of prefixes to namespaces as turtle prefix declarations.
+
+    Examples
+    --------
+    >>> format_prefixes({"rdfs": "http://www.w3.org/2000/01/rdf-schema#"})
+    '@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .'
+    """
+    return "\n".join(
+        f"@prefix {prefix}: <{namespace}> ."
+        for prefix, namespace in sorted(prefixes.items())
+    )
+
+
 def get_subjects_docs(
-    kg: Graph | SPARQLWrapper, graph: Optional[str] = None
-) -> List[Document]:
+    kg: Graph | SPARQLWrapper,
+    graph: Optional[str] = None,
+    batch_size: int = 500,
+    page_size: Optional[int] = None,
+) -> Iterator[Document]:
     """Given an RDF graph, iterate over subjects, extract human-readable
     RDFS annotations. For each subject, retrieve a "text document" with
-    original triples attached as metadata."""
+    original triples attached as metadata. The triples are also stored in
+    a compact turtle form, along with the prefixes they use, so that they
+    can be given to the LLM without any conversion. The graph documents
+    were loaded from is recorded in their metadata, empty for all subjects.
 
-    results = query_kg(
-        kg, SUBJECT_DOC_QUERY.format(lang="en", graph_mask=make_graph_mask(graph))
+    Parameters
+    ----------
+    kg:
+        Knowledge graph to load subjects from.
+    graph:
+        URI of named graph to load subjects from.
+        If not specified, all subjects are used.
+    batch_size:
+        Number of subjects whose triples are retrieved in a single query.
+    page_size:
+        Number of subjects to retrieve per query. If not specified,
+        all subjects are retrieved in a single query.
+    """
+
+    results = iter_query_kg(
+        kg,
+        SUBJECT_DOC_QUERY.format(
+            lang="en", graph_mask=make_graph_mask(graph), page_filter=PAGE_FILTER
+        ),
+        page_size=page_size,
+        key="s",
     )
-    docs = []
-    # skip header if present
-    if not is_uri(results[0][0]):
-        results = results[1:]
 
-    for sub, label, comment in results:
-        text = f"""
+    for batch in chunked(results, batch_size):
+        descriptions = describe_subjects(kg, [sub for sub, _, _ in batch])
+        for sub, label, comment in batch:
+            text = f"""
         {label}
         {comment or ''}
         """
-        triples = query_kg(kg, f"DESCRIBE <{sub}>")
+            # Sort triples and relabel blank nodes so that documents, and
+            # their identifiers, are reproducible
+            description = canonicalize_bnodes(descriptions[sub])
+            triples = description.serialize(format="nt").splitlines()
+            context, prefixes = compact_triples(description)
+            meta = {
+                "subject": sub,
+                "triples": "\n".join(sorted(filter(None, triples))),
+                "context": "\n".join(context),
+                "prefixes": format_prefixes(prefixes),
+                "graph": graph or "",
+            }
+            yield Document(page_content=text, metadata=meta)
+
+
+# Result format and HTTP media type of each query type
+QUERY_FORMATS = {
+    "DESCRIBE": ("nt", "application/n-triples"),
+    "SELECT": ("csv", "text/csv"),
+    "CONSTRUCT": ("nt", "application/n-triples"),
+}
+
+
+class ResultTable(list):
+    """Query results as a list of lists representing a table. The truncated
+    flag is set when results were cut to fit in the limits of the query."""
+
+    truncated: bool = False
+
+
+@dataclass
+class QueryLimits:
+    """Limits on the execution of queries which are not trusted,
+    e.g. generated by a LLM.
+
+    Attributes
+    ----------
+    max_rows:
+        Maximum number of result rows. Queries get a LIMIT clause of at
+        most this value, and extra rows are dropped. For graph results,
+        this is the maximum number of solutions used to build the graph.
+    max_bytes:
+        Maximum size of the raw results. Results are read until this size
+        is reached, and only complete rows are kept.
+    timeout:
+        Number of seconds after which the query is aborted. It is also sent
+        to the endpoint, which may stop evaluating the query earlier.
+    """
+
+    max_rows: int = 1000
+    max_bytes: int = 1_000_000
+    timeout: Optional[float] = 30.0
+
+
+@contextmanager
+def query_timeout(kg: SPARQLWrapper, limits: Optional[QueryLimits] = None):
+    """Apply the timeout of query limits to a SPARQLWrapper, restoring its
+    previous timeout afterwards, since the wrapper is shared by queries."""
+    previous = kg.timeout
+    if limits is not None and limits.timeout:
+        kg.setTimeout(math.ceil(limits.timeout))
+    try:
+        yield
+    finally:
+        kg.timeout = previous
+
+
+def truncate_lines(raw_results: bytes, max_bytes: int) -> Tuple[bytes, bool]:
+    """Truncate raw results to at most max_bytes, keeping only complete lines.
+    Returns the results and whether they were truncated.
+
+    Examples
+    --------
+    >>> truncate_lines(b"a,b\\nc,d\\ne,f\\n", 9)
+    (b'a,b\\nc,d\\n', True)
+    """
+    if len(raw_results) <= max_bytes:
+        return raw_results, False
+    raw_results = raw_results[:max_bytes]
+    return raw_results[: raw_results.rfind(b"\n") + 1], True
+
+
+def parse_results(
+    raw_results: bytes, fmt: str, limits: Optional[QueryLimits] = None
+) -> ResultTable:
+    """Convert raw query results to a list of lists representing a table.
+    Graph results (ntriples) are returned as a single cell. If limits are
+    provided, results larger than the byte or row budget are truncated."""
+    truncated = False
+    if limits is not None:
+        raw_results, truncated = truncate_lines(raw_results, limits.max_bytes)
+    if fmt == "csv":
+        lines = raw_results.decode("utf-8").splitlines()
+        rows = [row for row in csv.reader(lines, quotechar='"', delimiter=",") if row]
+        if limits is not None and len(rows) > limits.max_rows + 1:
+            rows = rows[: limits.max_rows + 1]
+            truncated = True
+        results = ResultTable(rows)
+    else:
+        results = ResultTable([[raw_results]])
+    results.truncated = truncated
+    return results
+
+
+def count_results(results: List[List[Any]]) -> int:
+    r"""Count the rows of a result table as returned by query_kg, excluding
+    the header. For graph results, the number of triples is returned.
+    Other result types, e.g. columnar results, are counted with len().
+
+    Examples
+    --------
+    >>> count_results([["s", "p"], ["a", "b"], ["c", "d"]])
+    2
+    >>> count_results([[b"<a> <b> <c> .\n<a> <b> <d> .\n"]])
+    2
+    """
+    if not isinstance(results, list):
+        return len(results)
+    if len(results) == 1 and isinstance(results[0][0], bytes):
+        return len(results[0][0].strip().splitlines())
+    return max(len(results) - 1, 0)
+
+
+# The SPARQL parser of rdflib is not thread-safe, queries are parsed one
+# at a time and then evaluated concurrently
+_PARSER_LOCK = threading.Lock()
+
+
+def prepare_query(query: str, kg: Optional[Graph] = None) -> Query:
+    """Parse a SPARQL query with rdflib, holding the parser lock. The parsed
+    query can be evaluated on a graph without the lock. If kg is provided,
+    the prefixes bound in the graph can be used in the query, as when
+    passing the query string to Graph.query."""
+    init_ns = dict(kg.namespaces()) if kg is not None else {}
+    with _PARSER_LOCK:
+        return prepareQuery(query, initNs=init_ns)
 
-        g = Graph()
-        # SPARQLWrapper returns a ntriple string, rdflib a list of triples
-        try:
-            g.parse(data=triples[0][0], format="nt")
-        except (RuntimeError, ParserError):
-            for triple in triples:
-                g.add(triple)
-        meta = {"triples": g.serialize(format="nt")}
-        docs.append(Document(page_content=text, metadata=meta))
-    return docs
 
+def canonicalize_query(query: str) -> str:
+    r"""Compute a canonical form of a SPARQL query, so that queries which
+    only differ in whitespace, keyword case or prefix declarations share the
+    same form. The query is parsed by rdflib and its algebra, where prefixed
+    names are expanded, is used as canonical form. Queries which rdflib
+    cannot parse (e.g. using vendor extensions) are only normalized for
+    whitespace.
 
-def query_kg(kg: Graph | SPARQLWrapper, query: str) -> List[List[Any]]:
+    Examples
+    --------
+    >>> a = canonicalize_query("PREFIX ex: <http://ex.org/> SELECT ?s {?s ex:p 1}")
+    >>> b = canonicalize_query("select ?s where {\n  ?s <http://ex.org/p> 1 .\n}")
+    >>> a == b
+    True
+    """
+    try:
+        return str(prepare_query(query).algebra)
+    except Exception:
+        return re.sub(r"\s+", " ", query).strip()
+
+
+# IRIs, strings and comments, which may contain keywords
+_QUERY_TOKENS = re.compile(
+    r"""<[^<>"{}|^`\\\s]*>|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|#[^\n]*"""
+)
+# LIMIT and OFFSET clauses of the outer query, in either order
+_SOLUTION_SLICE = re.compile(
+    r"(?:\b(?:LIMIT|OFFSET)\s+\d+\s*){1,2}$", flags=re.IGNORECASE
+)
+_LIMIT = re.compile(r"\bLIMIT\s+(\d+)", flags=re.IGNORECASE)
+# VALUES clause of the outer query, which comes after solution modifiers
+_TRAILING_VALUES = re.compile(
+    r"\bVALUES\s*(?:\?\w+|\([^()]*\))\s*\{[^{}]*\}\s*$", flags=re.IGNORECASE
+)
+
+
+def _mask_query(query: str) -> str:
+    """Replace the IRIs, strings and comments of a query by spaces, keeping
+    the positions of the other characters.
+
+    Examples
+    --------
+    >>> _mask_query("SELECT * { ?s ?p 'LIMIT 1' } # LIMIT 2")
+    'SELECT * { ?s ?p           }          '
+    """
+    return _QUERY_TOKENS.sub(lambda match: " " * len(match.group()), query)
+
+
+def limit_query(query: str, limit: int) -> str:
+    r"""Add a LIMIT clause to a query without one, or lower its limit if it
+    is larger. ASK queries and DESCRIBE queries of fixed resources are
+    returned unchanged. Queries which rdflib cannot parse are only checked
+    for LIMIT and OFFSET clauses at their end. Comments are ignored.
+
+    Examples
+    --------
+    >>> limit_query("SELECT * WHERE { ?s ?p ?o }", 10)
+    'SELECT * WHERE { ?s ?p ?o }\nLIMIT 10'
+    >>> limit_query("SELECT * WHERE { ?s ?p ?o } LIMIT 100 OFFSET 5", 10)
+    'SELECT * WHERE { ?s ?p ?o } LIMIT 10 OFFSET 5'
+    >>> limit_query("SELECT * WHERE { ?s ?p ?o } LIMIT 5", 10)
+    'SELECT * WHERE { ?s ?p ?o } LIMIT 5'
+    >>> limit_query("ASK { ?s ?p ?o }", 10)
+    'ASK { ?s ?p ?o }'
+
+    A trailing VALUES clause comes after the LIMIT clause:
+
+    >>> limit_query("SELECT * { ?s ?p ?o } VALUES ?s { <a> }", 10)
+    'SELECT * { ?s ?p ?o }\nLIMIT 10\nVALUES ?s { <a> }'
+
+    Prefixes predefined by an endpoint are unknown to rdflib:
+
+    >>> limit_query("SELECT * { ?s bif:contains 'x' } LIMIT 5000 OFFSET 2", 10)
+    "SELECT * { ?s bif:contains 'x' } LIMIT 10 OFFSET 2"
+    >>> limit_query("SELECT * { ?s bif:contains 'x' } LIMIT 5 # LIMIT 5000", 10)
+    "SELECT * { ?s bif:contains 'x' } LIMIT 5 # LIMIT 5000"
+    """
+    try:
+        algebra = prepare_query(query).algebra
+    except Exception:
+        algebra = None
+
+    masked = _mask_query(query)
+    values = _TRAILING_VALUES.search(masked)
+    end = values.start() if values else len(masked)
+    # Solution modifiers of the outer query come last, before VALUES
+    clauses = _SOLUTION_SLICE.search(masked[:end].rstrip())
+    last = _LIMIT.search(masked, clauses.start()) if clauses else None
+    if algebra is None:
+        length = int(last.group(1)) if last else None
+        if re.match(r"\s*ASK\b", masked, flags=re.IGNORECASE):
+            return query
+    else:
+        modifier = algebra.get("p")
+        if algebra.name == "AskQuery" or modifier is None:
+            return query
+        length = dict.get(modifier, "length") if modifier.name == "Slice" else None
+
+    if length is None:
+        if values is None:
+            return f"{query}\nLIMIT {limit}"
+        return f"{query[:end].rstrip()}\nLIMIT {limit}\n{query[end:]}"
+    if length <= limit:
+        return query
+    if last is None:
+        *_, last = _LIMIT.finditer(masked)
+    return f"{query[: last.start()]}LIMIT {limit}{query[last.end():]}"
+
+
+class QueryCache:
+    """Least recently used cache of query results, keyed on the canonical form
+    of queries and the limits of their results. Entries expire after a time-to-live, and are all dropped when
+    the generation of the knowledge graph changes, i.e. after data was loaded.
+
+    Parameters
+    ----------
+    maxsize:
+        Maximum number of query results in the cache.
+    ttl:
+        Number of seconds after which results expire.
+        If None, results do not expire.
+    generation:
+        Generation counter of the knowledge graph, bumped by the insert flow.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: Optional[float] = None,
+        generation: Optional[GenerationCounter] = None,
+    ):
+        self.generation = generation
+        self._generation = self._current_generation()
+        self._results = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Parsing is slow, so canonical forms of recent queries are kept
+        self._canonical = TTLCache(maxsize=maxsize)
+
+    def _current_generation(self) -> int:
+        return self.generation.get() if self.generation is not None else 0
+
+    def _canonicalize(self, query: str) -> str:
+        canonical = self._canonical.get(query)
+        if canonical is None:
+            canonical = canonicalize_query(query)
+            self._canonical.put(query, canonical)
+        return canonical
+
+    def get(
+        self, query: str, limits: Optional[QueryLimits] = None
+    ) -> Tuple[Hashable, Optional[List[List[Any]]]]:
+        """Return the cache key of a query run within limits and its cached
+        results, or None. The timeout is not part of the key, since it does
+        not change results."""
+        generation = self._current_generation()
+        if generation != self._generation:
+            self._results.clear()
+            self._generation = generation
+        budget = (limits.max_rows, limits.max_bytes) if limits is not None else None
+        key = (generation, self._canonicalize(query), budget)
+        return key, self._results.get(key)
+
+    def put(self, key: Hashable, results: List[List[Any]]):
+        """Cache the results of a query, unless data was loaded meanwhile."""
+        if key[0] == self._generation:
+            self._results.put(key, results)
+
+    def clear(self):
+        self._results.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return self._results.stats()
+
+
+def query_kg(
+    kg: Graph | SPARQLWrapper,
+    query: str,
+    cache: Optional[QueryCache] = None,
+    limits: Optional[QueryLimits] = None,
+) -> ResultTable:
     """Query a knowledge graph, either an rdflib Graph or a SPARQLWrapper.
-    Results are returned as a list of lists representing a table."""
-    query2fmt = {"DESCRIBE": "nt", "SELECT": "csv", "CONSTRUCT": "nt"}
+    Results are returned as a list of lists representing a table.
+    If a cache is provided, results of equivalent queries are reused.
+    If limits are provided, the query gets a LIMIT clause and results are
+    truncated to the row and byte budget. The timeout only applies to
+    SPARQL endpoints."""
+    if cache is not None:
+        key, results = cache.get(query, limits)
+        if results is not None:
+            return results
+        results = query_kg(kg, query, limits=limits)
+        cache.put(key, results)
+        return results
+
+    if limits is not None:
+        # One extra row tells whether results were truncated
+        query = limit_query(query, limits.max_rows + 1)
+
     if isinstance(kg, Graph):
-        resp = kg.query(query)
-        fmt = query2fmt[resp.type]
+        resp = kg.query(prepare_query(query, kg))
+        fmt, _ = QUERY_FORMATS[resp.type]
         raw_results = resp.serialize(format=fmt)
 
     elif isinstance(kg, SPARQLWrapper):
         kg.setQuery(query)
-        fmt = query2fmt[kg.queryType]
+        fmt, _ = QUERY_FORMATS[kg.queryType]
         kg.setReturnFormat(fmt)
-        raw_results = kg.query().convert()
+        with query_timeout(kg, limits):
+            raw_results = kg.query().convert()
     else:
         raise ValueError(f"Invalid type for kg: {type(kg)}")
-    if fmt == "csv":
-        import csv
+    return parse_results(raw_results, fmt, limits)
 
-        lines = raw_results.decode("utf-8").splitlines()
-        return [row for row in csv.reader(lines, quotechar='"', delimiter=",") if row]
-    else:
-        return [[raw_results]]
 
+async def afetch_results(
+    kg: SPARQLWrapper,
+    query: str,
+    client: httpx.AsyncClient,
+    media_type: str,
+    limits: Optional[QueryLimits] = None,
+) -> bytes:
+    """Send a query to a SPARQL endpoint and return the raw response. With
+    limits, the response is read up to just over the byte budget and the
+    connection is closed early if needed."""
+    data = {"query": query}
+    timeout = httpx.USE_CLIENT_DEFAULT
+    if limits is not None and limits.timeout:
+        # Understood by e.g. GraphDB and Fuseki, ignored by other endpoints
+        data["timeout"] = str(math.ceil(limits.timeout))
+        timeout = limits.timeout
+    request = client.stream(
+        "POST",
+        kg.endpoint,
+        data=data,
+        headers={"Accept": media_type},
+        auth=(kg.user, kg.passwd) if kg.user and kg.passwd else None,
+        timeout=timeout,
+    )
+    async with request as resp:
+        resp.raise_for_status()
+        raw_results = bytearray()
+        async for chunk in resp.aiter_bytes():
+            raw_results += chunk
+            if limits is not None and len(raw_results) > limits.max_bytes:
+                break
+    return bytes(raw_results)
+
+
+async def aquery_kg(
+    kg: Graph | SPARQLWrapper,
+    query: str,
+    client: httpx.AsyncClient,
+    executor: Optional[Executor] = None,
+    cache: Optional[QueryCache] = None,
+    limits: Optional[QueryLimits] = None,
+) -> ResultTable:
+    """Asynchronous variant of query_kg. SPARQL endpoints are queried using
+    a shared async HTTP client, which pools connections. Local rdflib graphs
+    are queried in a worker thread.
+
+    Parameters
+    ----------
+    kg:
+        Knowledge graph to query.
+    query:
+        SPARQL query to run.
+    client:
+        HTTP client used to send requests to the SPARQL endpoint.
+    executor:
+        Executor running queries on rdflib graphs and parsing queries.
+        Defaults to the event loop's default executor.
+    cache:
+        Cache of query results. If not provided, results are not cached.
+    limits:
+        Limits on the query execution and results. With a timeout, queries on
+        rdflib graphs raise asyncio.TimeoutError, although their worker
+        thread runs until completion.
+    """
+    loop = asyncio.get_running_loop()
+    timeout = limits.timeout if limits is not None else None
+    if isinstance(kg, Graph):
+        run = partial(query_kg, kg, query, cache, limits)
+        return await asyncio.wait_for(loop.run_in_executor(executor, run), timeout)
+    elif not isinstance(kg, SPARQLWrapper):
+        raise ValueError(f"Invalid type for kg: {type(kg)}")
+
+    if cache is not None:
+        key, results = await loop.run_in_executor(executor, cache.get, query, limits)
+        if results is not None:
+            return results
+
+    if limits is not None:
+        query = await loop.run_in_executor(
+            executor, limit_query, query, limits.max_rows + 1
+        )
+    kg.setQuery(query)
+    fmt, media_type = QUERY_FORMATS[kg.queryType]
+    raw_results = await afetch_results(kg, query, client, media_type, limits)
+    results = parse_results(raw_results, fmt, limits)
+    if cache is not None:
+        cache.put(key, results)
     return results
+
+
+def term_to_str(term: Any) -> str:
+    """Format an rdflib term the same way as in SPARQL CSV results.
+
+    Examples
+    --------
+    >>> term_to_str(URIRef("https://example.org/a"))
+    'https://example.org/a'
+    >>> term_to_str(None)
+    ''
+    """
+    if term is None:
+        return ""
+    if isinstance(term, BNode):
+        return f"_:{term}"
+    return str(term)
+
+
+def _iter_select_rows(kg: Graph | SPARQLWrapper, query: str) -> Iterator[List[str]]:
+    """Lazily iterate over the rows of a SELECT query, without the header."""
+    if isinstance(kg, Graph):
+        resp = kg.query(prepare_query(query, kg))
+        if resp.type != "SELECT":
+            raise ValueError(f"Only SELECT queries can be iterated, got {resp.type}")
+        for row in resp:
+            yield [term_to_str(term) for term in row]
+
+    elif isinstance(kg, SPARQLWrapper):
+        kg.setQuery(query)
+        if kg.queryType != "SELECT":
+            raise ValueError(f"Only SELECT queries can be iterated, got {kg.queryType}")
+        kg.setReturnFormat(CSV)
+        # Parse the CSV response incrementally as it is received
+        response = kg.query().response
+        try:
+            lines = io.TextIOWrapper(response, encoding="utf-8", newline="")
+            reader = csv.reader(lines, quotechar='"', delimiter=",")
+            next(reader, None)
+            yield from (row for row in reader if row)
+        finally:
+            response.close()
+    else:
+        raise ValueError(f"Invalid type for kg: {type(kg)}")
+
+
+def _sparql_string(value: str) -> str:
+    """Format a SPARQL string literal.
+
+    Examples
+    --------
+    >>> print(_sparql_string('a "quoted" \\\\ value'))
+    "a \\"quoted\\" \\\\ value"
+    """
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _iter_offset_pages(
+    kg: Graph | SPARQLWrapper, query: str, page_size: int
+) -> Iterator[List[str]]:
+    """Paginate a query with LIMIT and OFFSET."""
+    offset = 0
+    while True:
+        page = f"{query}\nLIMIT {page_size}\nOFFSET {offset}"
+        n_rows = 0
+        for row in _iter_select_rows(kg, page):
+            n_rows += 1
+            yield row
+        if n_rows < page_size:
+            break
+        offset += page_size
+
+
+def _iter_key_pages(
+    kg: Graph | SPARQLWrapper, query: str, page_size: int, key: str
+) -> Iterator[List[str]]:
+    """Paginate a query by key: each page starts after the last key of the
+    previous page, so that the endpoint never sorts and skips the rows of
+    previous pages. Rows of the last key of a full page may continue on the
+    next page, so they are fetched again with the next page. Blank nodes
+    have no string value to compare, so rows whose key is a blank node are
+    retrieved afterwards with LIMIT and OFFSET."""
+    last = None
+    while True:
+        condition = f"isIRI(?{key})"
+        if last is not None:
+            condition += f" && STR(?{key}) > {_sparql_string(last)}"
+        page = query.replace(PAGE_FILTER, f"FILTER({condition})")
+        rows = list(_iter_select_rows(kg, page + f"\nLIMIT {page_size}"))
+        if len(rows) < page_size:
+            yield from rows
+            break
+        complete = [row for row in rows if row[0] != rows[-1][0]]
+        if complete:
+            yield from complete
+            last = complete[-1][0]
+        else:
+            # A single key fills the page, its rows are retrieved at once
+            condition = f"FILTER(STR(?{key}) = {_sparql_string(rows[-1][0])})"
+            yield from _iter_select_rows(kg, query.replace(PAGE_FILTER, condition))
+            last = rows[-1][0]
+    blank = query.replace(PAGE_FILTER, f"FILTER(isBlank(?{key}))")
+    yield from _iter_offset_pages(kg, blank, page_size)
+
+
+def iter_query_kg(
+    kg: Graph | SPARQLWrapper,
+    query: str,
+    page_size: Optional[int] = None,
+    key: Optional[str] = None,
+) -> Iterator[List[str]]:
+    """Query a knowledge graph, either an rdflib Graph or a SPARQLWrapper,
+    and lazily yield the rows of the result table, without the header.
+    Only SELECT queries are supported.
+
+    Parameters
+    ----------
+    kg:
+        Knowledge graph to query.
+    query:
+        SELECT query to run. When paginating, the query should not have
+        a LIMIT or OFFSET clause. Without key, it should have a total order
+        (e.g. ORDER BY all projected variables), otherwise rows may be
+        repeated or skipped across pages.
+    page_size:
+        Number of rows to retrieve per query. If not specified,
+        all rows are retrieved in a single query.
+    key:
+        Variable to paginate by, which must be the first projected variable
+        and bound to IRIs or blank nodes. The query must be ordered by it and
+        contain the PAGE_FILTER marker in its WHERE clause. Pages of IRI keys
+        are then retrieved with a filter on the key instead of an OFFSET, and
+        the rows of a key are never split across pages. Rows with blank node
+        keys, and all rows without key, are paged with LIMIT and OFFSET.
+    """
+    if not page_size:
+        yield from _iter_select_rows(kg, query)
+        return
+    if key is not None:
+        yield from _iter_key_pages(kg, query, page_size, key)
+    else:
+        yield from _iter_offset_pages(kg, query, page_size)
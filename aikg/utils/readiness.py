@@ -0,0 +1,117 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Readiness tracking of components which are set up in the background, so
+that a server can accept connections while slow resources (models, indices,
+large graphs) are loading."""
+import asyncio
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class ComponentError(RuntimeError):
+    """Raised when waiting for a component which failed to load."""
+
+
+@dataclass
+class ComponentStatus:
+    """Status of a component. Seconds are counted from the start of the
+    readiness tracker until the component is ready or failed."""
+
+    status: str = "pending"
+    seconds: Optional[float] = None
+    error: Optional[str] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+
+class Readiness:
+    """Track the setup of named components run in worker threads.
+
+    Examples
+    --------
+    >>> async def main():
+    ...     readiness = Readiness()
+    ...     await readiness.run("model", lambda: "loaded")
+    ...     await readiness.wait("model")
+    ...     return readiness.ready, readiness.status()["components"]["model"]["status"]
+    >>> asyncio.run(main())
+    (True, 'ready')
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.components: Dict[str, ComponentStatus] = {}
+
+    def add(self, name: str) -> ComponentStatus:
+        """Register a pending component."""
+        return self.components.setdefault(name, ComponentStatus())
+
+    async def run(
+        self,
+        name: str,
+        func: Callable[..., Any],
+        *args,
+        after: Iterable[str] = (),
+    ) -> Any:
+        """Set up a component by running func in a worker thread, once the
+        components it depends on are ready. Errors are recorded instead of
+        raised, so that other components keep loading."""
+        component = self.add(name)
+        try:
+            await self.wait(*after)
+            result = await asyncio.to_thread(func, *args)
+        except Exception as err:
+            component.status, component.error = "failed", str(err)
+            logging.exception(f"Failed to load {name}")
+            result = None
+        else:
+            component.status = "ready"
+        component.seconds = time.monotonic() - self.started
+        component.done.set()
+        logging.info(f"{name} {component.status} after {component.seconds:.2f}s")
+        return result
+
+    async def wait(self, *names: str):
+        """Wait until components are ready. Raises ComponentError if one of
+        them failed."""
+        for name in names:
+            component = self.add(name)
+            await component.done.wait()
+            if component.status == "failed":
+                raise ComponentError(f"{name} failed to load: {component.error}")
+
+    @property
+    def ready(self) -> bool:
+        """Whether all components are ready."""
+        return all(c.status == "ready" for c in self.components.values())
+
+    def status(self) -> Dict[str, Any]:
+        """Return the status and time to ready of each component."""
+        return {
+            "ready": self.ready,
+            "uptime": time.monotonic() - self.started,
+            "components": {
+                name: {
+                    "status": c.status,
+                    "seconds": c.seconds,
+                    "error": c.error,
+                }
+                for name, c in self.components.items()
+            },
+        }
@@ -0,0 +1,177 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Summarization of query results, so that the answer prompt has a bounded
+size regardless of the number of results. Results are converted to a
+columnar array, from which per-column statistics are computed with numpy,
+and a random sample of rows is added until the token budget is spent."""
+
+from collections import Counter
+from typing import Any, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from aikg.utils.columnar import ColumnarResults
+from aikg.utils.llm import estimate_tokens
+from aikg.utils.ntriples import Statement, parse_statement
+
+GRAPH_COLUMNS = ["subject", "predicate", "object"]
+
+
+def _parse_triples(data: bytes) -> Iterator[Statement]:
+    """Parse N-Triples results, skipping lines which are not statements."""
+    for line in data.decode("utf-8").splitlines():
+        try:
+            statement = parse_statement(line)
+        except ValueError:
+            continue
+        if statement is not None:
+            yield statement
+
+
+def results_to_columns(results: List[List[Any]]) -> Tuple[List[str], np.ndarray]:
+    """Convert a result table returned by query_kg to column names and a 2D
+    array of values, one column per variable. Graph results are split into
+    subject, predicate and object columns. Columnar results are converted
+    directly.
+
+    Examples
+    --------
+    >>> header, table = results_to_columns([["s", "n"], ["a", "1"], ["b", "2"]])
+    >>> header, table[:, 1].tolist()
+    (['s', 'n'], ['1', '2'])
+    >>> header, table = results_to_columns([[b"<a> <b> <c> .\\n"]])
+    >>> header, table.tolist()
+    (['subject', 'predicate', 'object'], [['<a>', '<b>', '<c>']])
+    """
+    if isinstance(results, ColumnarResults):
+        return list(results.variables), results.to_array()
+    if len(results) == 1 and isinstance(results[0][0], bytes):
+        header = GRAPH_COLUMNS
+        rows = [statement[:3] for statement in _parse_triples(results[0][0])]
+    elif results:
+        header, rows = list(results[0]), results[1:]
+    else:
+        header, rows = [], []
+    table = np.empty((len(rows), len(header)), dtype=object)
+    if rows:
+        table[:] = rows
+    return header, table
+
+
+def _shorten(value: str, width: int = 60) -> str:
+    return value if len(value) <= width else value[: width - 3] + "..."
+
+
+def _is_number(value: str) -> bool:
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def describe_column(
+    name: str,
+    values: np.ndarray,
+    top_k: int = 5,
+    numbers: Optional[np.ndarray] = None,
+) -> str:
+    """Describe the values of a column: number of bound and distinct values,
+    range and mean of numeric values and most frequent values. The numeric
+    values of typed results can be given as numbers, with NaN for values
+    which are not numeric; otherwise values are converted if they all look
+    numeric.
+
+    Examples
+    --------
+    >>> describe_column("n", np.array(["1", "2", "2", ""], dtype=object))
+    'n: 3 values, 2 distinct; min 1, max 2, mean 1.66667; most frequent: 2 (2), 1 (1)'
+    """
+    bound = values[values != ""]
+    # Counting in a hash table is faster than sorting strings with np.unique
+    counts = Counter(bound.tolist())
+    parts = [f"{len(bound)} values, {len(counts)} distinct"]
+    if numbers is not None:
+        numbers = numbers[~np.isnan(numbers)]
+        numbers = numbers if len(numbers) else None
+    # Only convert columns which look numeric, as failed conversions are slow
+    elif len(bound) and _is_number(bound[0]):
+        try:
+            numbers = bound.astype(np.float64)
+        except (TypeError, ValueError):
+            pass
+    if numbers is not None:
+        parts.append(
+            f"min {numbers.min():g}, max {numbers.max():g}, mean {numbers.mean():g}"
+        )
+    if counts:
+        frequent = ", ".join(
+            f"{_shorten(str(value))} ({count})"
+            for value, count in counts.most_common(top_k)
+        )
+        parts.append(f"most frequent: {frequent}")
+    return f"{name}: " + "; ".join(parts)
+
+
+def summarize_results(
+    results: List[List[Any]], token_budget: int = 1000, top_k: int = 5, seed: int = 0
+) -> str:
+    """Summarize query results to fit in a token budget. The summary has the
+    number of rows, a description of each column and a random sample of rows,
+    shown in their original order.
+
+    Parameters
+    ----------
+    results:
+        Result table returned by query_kg, or columnar results. Numeric
+        statistics of columnar results only use numeric literals.
+    token_budget:
+        Estimated number of tokens of the summary. Column descriptions are
+        always included, and rows are sampled until the budget is spent.
+    top_k:
+        Number of most frequent values shown for each column.
+    seed:
+        Seed of the random sample, so that summaries are reproducible.
+    """
+    header, table = results_to_columns(results)
+    n_rows = len(table)
+    count = f"{n_rows} rows"
+    if getattr(results, "truncated", False):
+        count += " (truncated, more rows exist)"
+    lines = [f"{count}, columns: {', '.join(header)}"]
+    typed = isinstance(results, ColumnarResults)
+    lines += [
+        describe_column(
+            name, table[:, i], top_k, results.numeric(name) if typed else None
+        )
+        for i, name in enumerate(header)
+    ]
+    used = estimate_tokens("\n".join(lines))
+
+    # Sampling stops at the first row over budget, so the cost is bounded
+    sample = []
+    for i in np.random.default_rng(seed).permutation(n_rows):
+        cost = estimate_tokens(", ".join(map(str, table[i]))) + 1
+        if used + cost > token_budget:
+            break
+        sample.append(i)
+        used += cost
+    if sample:
+        lines.append(f"Sample of {len(sample)} rows:")
+        lines += [", ".join(map(str, table[i])) for i in sorted(sample)]
+    return "\n".join(lines)
@@ -0,0 +1,222 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline benchmark harness, writing results as JSON.
+
+All external services are replaced by local stand-ins: a deterministic stub
+LLM, an rdflib-backed SPARQL endpoint serving a synthetic graph and a mock
+graph store. The following are measured:
+
+* chroma_build: documents indexed per second by chroma_build_flow.
+* server: throughput and latency percentiles of /ask/ and /sparql/, and time
+  to ready of the server components.
+* insert_triples: triples loaded per second by sparql_insert_flow, per load mode.
+
+Results of different runs can be compared to catch performance regressions,
+e.g. before upgrading dependencies."""
+
+import asyncio
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import tempfile
+import threading
+import time
+from typing import List
+from typing_extensions import Annotated
+
+import httpx
+import typer
+import uvicorn
+
+from .insert_modes import make_ntriples
+from .server_load import wait_ready
+from .stubs import stub_graph_store, stub_llm, stub_rdflib_sparql
+from .subject_docs import make_graph
+
+BENCHMARKS = ["chroma_build", "server", "insert_triples"]
+
+
+def summarize(latencies: List[float], elapsed: float) -> dict:
+    """Compute throughput and latency percentiles, in seconds."""
+    pct = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_p50": pct[49],
+        "latency_p95": pct[94],
+        "latency_p99": pct[98],
+    }
+
+
+async def run_requests(url: str, questions: List[str], concurrency: int) -> dict:
+    """Send questions to an endpoint of the chat server with the given number
+    of concurrent clients."""
+    queue = asyncio.Queue()
+    for question in questions:
+        queue.put_nowait(question)
+    latencies = []
+
+    async def client_loop(client: httpx.AsyncClient):
+        while not queue.empty():
+            question = queue.get_nowait()
+            start = time.perf_counter()
+            resp = await client.get(url, params={"question": question})
+            resp.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(timeout=None) as client:
+        await asyncio.gather(*[client_loop(client) for _ in range(concurrency)])
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_chroma_build() -> dict:
+    """Build the vector index from the synthetic graph."""
+    from aikg.config import ChromaConfig, SparqlConfig
+    from aikg.flows.chroma_build import chroma_build_flow
+
+    start = time.perf_counter()
+    stats = chroma_build_flow(ChromaConfig(), SparqlConfig())
+    elapsed = time.perf_counter() - start
+    return {
+        "documents": stats[-1].items,
+        "seconds": elapsed,
+        "documents_per_second": stats[-1].items / elapsed,
+        "stages_items_per_second": {s.name: s.throughput for s in stats},
+    }
+
+
+def bench_server(n_requests: int, concurrency: int, port: int) -> dict:
+    """Measure the chat server endpoints."""
+    server = uvicorn.Server(
+        uvicorn.Config("aikg.server:app", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.1)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        # Components are loaded in the background once the port is bound
+        components = wait_ready(url)["components"]
+        # Each endpoint gets its own questions, so that the second one does
+        # not reuse the question embeddings computed for the first
+        results = {
+            path: asyncio.run(
+                run_requests(
+                    url + path,
+                    [f"{prefix} subject number {i}?" for i in range(n_requests)],
+                    concurrency,
+                )
+            )
+            for path, prefix in [
+                ("/ask/", "What is the label of"),
+                ("/sparql/", "Which subjects are linked to"),
+            ]
+        }
+        results["time_to_ready"] = {
+            name: component["seconds"] for name, component in components.items()
+        }
+        return results
+    finally:
+        server.should_exit = True
+
+
+def bench_insert_triples(n_triples: int) -> dict:
+    """Load a synthetic N-Triples file into a mock graph store."""
+    from aikg.config import SparqlConfig
+    from aikg.flows.insert_triples import sparql_insert_flow
+
+    path = Path(tempfile.mkdtemp()) / "data.nt"
+    make_ntriples(path, n_triples)
+    url = stub_graph_store()
+    results = {}
+    for mode in ["insert", "upload"]:
+        start = time.perf_counter()
+        cfg = SparqlConfig(
+            endpoint=url,
+            load_mode=mode,
+            generation_file=str(path.with_name("generation")),
+        )
+        stats = sparql_insert_flow(path, cfg)
+        elapsed = time.perf_counter() - start
+        results[mode] = {
+            "triples": stats.items,
+            "seconds": elapsed,
+            "triples_per_second": stats.items / elapsed,
+        }
+    return results
+
+
+def main(
+    output: Annotated[Path, typer.Option(help="JSON file to write results to.")] = Path(
+        "benchmark.json"
+    ),
+    benchmarks: Annotated[
+        List[str], typer.Option("--benchmark", help="Benchmarks to run.")
+    ] = BENCHMARKS,
+    n_subjects: Annotated[
+        int, typer.Option(help="Subjects in the synthetic graph.")
+    ] = 1000,
+    n_requests: Annotated[int, typer.Option(help="Requests per endpoint.")] = 100,
+    concurrency: Annotated[int, typer.Option(help="Concurrent clients.")] = 8,
+    llm_latency: Annotated[float, typer.Option(help="Stub LLM latency (s).")] = 0.05,
+    n_triples: Annotated[int, typer.Option(help="Triples to load.")] = 10000,
+    port: Annotated[int, typer.Option(help="Port of the chat server.")] = 8765,
+):
+    """Run offline benchmarks and write their results as JSON."""
+    # Configuration is read from the environment when aikg is imported
+    os.environ.update(
+        OPENAI_API_BASE=stub_llm(llm_latency),
+        OPENAI_API_KEY="stub",
+        SPARQL_ENDPOINT=stub_rdflib_sparql(make_graph(n_subjects)),
+        CHROMA_HOST="local",
+        CHROMA_PERSIST_DIR=tempfile.mkdtemp(),
+        CHROMA_MODEL=os.environ.get("CHROMA_MODEL", "all-MiniLM-L6-v2"),
+        CHAT_ANSWER_CACHE_SIZE="0",
+        # The stub LLM always generates the same query, which must still run
+        SPARQL_QUERY_CACHE_SIZE="0",
+        PREFECT_LOGGING_LEVEL="WARNING",
+    )
+    results = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "parameters": {
+            "n_subjects": n_subjects,
+            "n_requests": n_requests,
+            "concurrency": concurrency,
+            "llm_latency": llm_latency,
+            "n_triples": n_triples,
+        },
+    }
+    # The index is built first, so that the server queries a populated index
+    if "chroma_build" in benchmarks:
+        results["chroma_build"] = bench_chroma_build()
+    if "server" in benchmarks:
+        results["server"] = bench_server(n_requests, concurrency, port)
+    if "insert_triples" in benchmarks:
+        results["insert_triples"] = bench_insert_triples(n_triples)
+
+    output.write_text(json.dumps(results, indent=2))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,119 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test of the chat server against local stub LLM and SPARQL servers.
+
+Questions are sent to /ask/ by a number of concurrent clients, and the
+throughput is reported for each concurrency level. With a non-blocking
+request path, throughput should grow with concurrency until the stub
+latency is no longer the bottleneck."""
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from typing import List
+from typing_extensions import Annotated
+
+import httpx
+import typer
+import uvicorn
+
+from .stubs import stub_llm, stub_sparql
+
+
+def wait_ready(url: str, timeout: float = 600) -> dict:
+    """Wait until all components of the chat server are loaded and return
+    their status. Fails if a component could not be loaded, or if the
+    server is not ready before the timeout."""
+    deadline = time.monotonic() + timeout
+    while True:
+        ready = httpx.get(f"{url}/readyz")
+        status = ready.json()
+        if ready.status_code == 200:
+            return status
+        failed = {
+            name: component["error"]
+            for name, component in status["components"].items()
+            if component["status"] == "failed"
+        }
+        if failed:
+            raise RuntimeError(f"Chat server components failed to load: {failed}")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Chat server not ready after {timeout}s: {status}")
+        time.sleep(0.1)
+
+
+async def run_load(url: str, n_requests: int, concurrency: int) -> float:
+    """Send n_requests distinct questions with the given number of concurrent
+    clients and return the throughput in requests per second."""
+    questions = asyncio.Queue()
+    for i in range(n_requests):
+        questions.put_nowait(f"Question number {i} at concurrency {concurrency}?")
+
+    async def client_loop(client: httpx.AsyncClient):
+        while not questions.empty():
+            question = questions.get_nowait()
+            resp = await client.get(f"{url}/ask/", params={"question": question})
+            resp.raise_for_status()
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(timeout=None) as client:
+        await asyncio.gather(*[client_loop(client) for _ in range(concurrency)])
+    return n_requests / (time.perf_counter() - start)
+
+
+def main(
+    concurrency: Annotated[
+        List[int], typer.Option(help="Number of concurrent clients.")
+    ] = [1, 4, 16],
+    n_requests: Annotated[int, typer.Option(help="Requests per level.")] = 32,
+    llm_latency: Annotated[float, typer.Option(help="LLM latency (s).")] = 0.5,
+    sparql_latency: Annotated[float, typer.Option(help="SPARQL latency (s).")] = 0.1,
+    port: Annotated[int, typer.Option(help="Port of the chat server.")] = 8765,
+):
+    """Measure /ask/ throughput for increasing concurrency levels."""
+    os.environ.update(
+        OPENAI_API_BASE=stub_llm(llm_latency),
+        OPENAI_API_KEY="stub",
+        SPARQL_ENDPOINT=stub_sparql(sparql_latency),
+        CHROMA_HOST="local",
+        CHROMA_PERSIST_DIR=tempfile.mkdtemp(),
+        CHROMA_MODEL=os.environ.get("CHROMA_MODEL", "all-MiniLM-L6-v2"),
+        CHAT_ANSWER_CACHE_SIZE="0",
+        # The stub LLM always generates the same query, which must still run
+        SPARQL_QUERY_CACHE_SIZE="0",
+    )
+    server = uvicorn.Server(
+        uvicorn.Config("aikg.server:app", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.1)
+
+    url = f"http://127.0.0.1:{port}"
+    # Components are loaded in the background once the port is bound
+    wait_ready(url)
+    for level in concurrency:
+        throughput = asyncio.run(run_load(url, n_requests, level))
+        print(f"concurrency={level}: {throughput:.2f} requests/s")
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,177 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-ins for external services, used to benchmark the chat server
+without network access. Each stub runs an HTTP server in a background thread
+and answers after a fixed latency."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from typing import Type
+from urllib.parse import parse_qs, urlparse
+
+from rdflib import ConjunctiveGraph, Graph
+
+from aikg.utils.rdf import prepare_query
+
+STUB_QUERY = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+SELECT ?s ?label WHERE { ?s rdfs:label ?label } LIMIT 10"""
+
+STUB_RESULTS = (
+    "s,label\r\n"
+    + "".join(f"https://example.org/s{i},Label {i}\r\n" for i in range(10))
+).encode("utf-8")
+
+
+def serve(handler: Type[BaseHTTPRequestHandler]) -> str:
+    """Start a threaded HTTP server on a free port and return its URL."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def stub_llm(latency: float = 0.5, response: str = STUB_QUERY) -> str:
+    """Start an OpenAI-compatible chat completion server which always
+    answers with the same response. Returns the API base URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            body = json.dumps(
+                {
+                    "id": "stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "stub",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": response},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "total_tokens": 0,
+                    },
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return serve(Handler) + "/v1"
+
+
+def stub_sparql(latency: float = 0.1, results: bytes = STUB_RESULTS) -> str:
+    """Start a SPARQL endpoint which always returns the same CSV results.
+    Returns the endpoint URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Length", str(len(results)))
+            self.end_headers()
+            self.wfile.write(results)
+
+        do_GET = do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    return serve(Handler) + "/sparql"
+
+
+def stub_graph_store(latency: float = 0.0) -> str:
+    """Start a SPARQL endpoint which accepts both SPARQL updates and
+    N-Triples / N-Quads uploads, like RDF4J's /statements endpoint. Payloads
+    are parsed with rdflib into a throwaway graph, so that the server-side
+    parsing cost of each load mode is accounted for. Returns the endpoint URL,
+    whose update and upload endpoint is <url>/statements."""
+
+    formats = {"application/n-triples": "nt", "application/n-quads": "nquads"}
+    # Like a graph store, writes are applied one at a time
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            content_type = self.headers.get("Content-Type", "")
+            kg = ConjunctiveGraph()
+            with lock:
+                if content_type in formats:
+                    kg.parse(data=body.decode("utf-8"), format=formats[content_type])
+                else:
+                    kg.update(parse_qs(body.decode("utf-8"))["update"][0])
+            time.sleep(latency)
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    return serve(Handler) + "/repositories/test"
+
+
+def stub_rdflib_sparql(kg: Graph, latency: float = 0.0) -> str:
+    """Start a SPARQL endpoint answering queries on a local rdflib graph.
+    SELECT results are returned as CSV and graph results as N-Triples.
+    Queries are accepted as GET parameters or POST forms. Returns the
+    endpoint URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self, params: dict):
+            # Queries are parsed under the lock shared with the chat server
+            # running in the same process, and evaluated concurrently
+            result = kg.query(prepare_query(params["query"][0], kg))
+            if result.type in ("CONSTRUCT", "DESCRIBE"):
+                body = result.serialize(format="nt")
+                content_type = "application/n-triples"
+            else:
+                body = result.serialize(format="csv")
+                content_type = "text/csv"
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.respond(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.respond(parse_qs(body.decode("utf-8")))
+
+        def log_message(self, *args):
+            pass
+
+    return serve(Handler) + "/sparql"
@@ -0,0 +1,80 @@
+# kg-llm-interface
+# Copyright 2023 - Swiss Data Science Center (SDSC)
+# A partnership between École Polytechnique Fédérale de Lausanne (EPFL) and
+# Eidgenössische Technische Hochschule Zürich (ETHZ).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the retrieval of subject documents from a knowledge graph.
+
+A synthetic graph is generated in a local rdflib ConjunctiveGraph, and subject
+documents are built with different batch sizes. A batch size of 1 corresponds
+to one query per subject. The number of queries sent to the graph and the
+wall-clock time are reported for each batch size."""
+
+import time
+from typing import List
+from typing_extensions import Annotated
+
+from rdflib import ConjunctiveGraph, Literal, Namespace, RDF, RDFS
+import typer
+
+from aikg.utils.rdf import get_subjects_docs
+
+EX = Namespace("https://example.org/")
+
+
+class CountingGraph(ConjunctiveGraph):
+    """ConjunctiveGraph which records the number of queries it receives."""
+
+    n_queries: int = 0
+
+    def query(self, *args, **kwargs):
+        self.n_queries += 1
+        return super().query(*args, **kwargs)
+
+
+def make_graph(n_subjects: int) -> CountingGraph:
+    """Generate a graph where each subject has a label, a comment,
+    a type and a link to another subject."""
+    kg = CountingGraph()
+    for i in range(n_subjects):
+        sub = EX[f"subject{i}"]
+        kg.add((sub, RDF.type, EX.Thing))
+        kg.add((sub, RDFS.label, Literal(f"Subject {i}")))
+        kg.add((sub, RDFS.comment, Literal(f"Description of subject {i}.")))
+        kg.add((sub, EX.linkedTo, EX[f"subject{(i + 1) % n_subjects}"]))
+    return kg
+
+
+def main(
+    n_subjects: Annotated[int, typer.Option(help="Number of subjects.")] = 2000,
+    batch_sizes: Annotated[
+        List[int], typer.Option("--batch-size", help="Batch sizes to compare.")
+    ] = [1, 100, 500],
+):
+    """Compare subject document retrieval across batch sizes."""
+    kg = make_graph(n_subjects)
+    for batch_size in batch_sizes:
+        kg.n_queries = 0
+        start = time.perf_counter()
+        n_docs = sum(1 for _ in get_subjects_docs(kg, batch_size=batch_size))
+        elapsed = time.perf_counter() - start
+        print(
+            f"batch_size={batch_size}: {n_docs} documents, "
+            f"{kg.n_queries} queries, {elapsed:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
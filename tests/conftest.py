@@ -1,10 +1,8 @@
-import gzip
 from pathlib import Path
 import pytest
-import shutil
 import tempfile
 
-from aikg.utils.io import download_file
+from aikg.utils.io import download_file, open_file
 
 TEST_SCHEMA_URL = "https://www.pokemonkg.org/ontology/ontology.nt"
 TEST_INSTANCES_URL = "https://www.pokemonkg.org/download/dump/poke-a.nq.gz"
@@ -12,15 +10,10 @@ TEST_INSTANCES_URL = "https://www.pokemonkg.org/download/dump/poke-a.nq.gz"
 
 @pytest.fixture(scope="module")
 def instance_file() -> Path:
-    """Download and gunzip remote instance test file."""
-    gz_path = tempfile.NamedTemporaryFile(suffix=".nq.gz", delete=False).name
-    download_file(TEST_INSTANCES_URL, gz_path)
-    path = gz_path.removesuffix(".gz")
-    # gunzip downloaded file
-    with gzip.open(gz_path, "rb") as f_in:
-        with open(path, "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
-
+    """Download remote instance test file. It is kept compressed,
+    since loaders decompress it on the fly."""
+    path = tempfile.NamedTemporaryFile(suffix=".nq.gz", delete=False).name
+    download_file(TEST_INSTANCES_URL, path)
     return Path(path)
 
 
@@ -37,7 +30,7 @@ def small_instance_file(instance_file) -> Path:
     """Create a small instance file for testing, truncated to 100 lines."""
     path = tempfile.NamedTemporaryFile(suffix=".nq", delete=False).name
 
-    with open(instance_file) as f, open(path, "w") as f_out:
+    with open_file(instance_file, "rt") as f, open(path, "w") as f_out:
         for i, line in enumerate(f):
             if i > 1000:
                 break
@@ -0,0 +1,142 @@
+# Test caches used to avoid recomputing expensive results.
+import asyncio
+import sqlite3
+import time
+
+from aikg.utils.cache import EmbeddingCache, SemanticCache, SingleFlight, TTLCache
+import numpy as np
+import pytest
+
+
+def test_embedding_cache_eviction(tmp_path):
+    """Test if least recently used embeddings are evicted first,
+    and embeddings persist across connections."""
+    path = tmp_path / "emb.sqlite"
+    cache = EmbeddingCache(path, max_entries=2, touch_interval=0)
+    cache.put_many("model", ["a", "b"], [[1.0], [2.0]])
+    cache.get_many("model", ["a"])
+    cache.put_many("model", ["c"], [[3.0]])
+    cache = EmbeddingCache(path, max_entries=2)
+    a, b, c = cache.get_many("model", ["a", "b", "c"])
+    assert b is None
+    assert np.allclose(a, [1.0]) and np.allclose(c, [3.0])
+    assert cache.get_many("other", ["a"]) == [None]
+
+
+def test_embedding_cache_count(tmp_path):
+    """Test if the number of entries is tracked across connections, without
+    counting updated entries twice, including entries stored before the
+    count was maintained."""
+    path = tmp_path / "emb.sqlite"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE embeddings (model TEXT NOT NULL, key TEXT NOT NULL, "
+        "vector BLOB NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (model, key))"
+    )
+    conn.execute("INSERT INTO embeddings VALUES ('model', 'x', x'', 0)")
+    conn.commit()
+    first = EmbeddingCache(path, max_entries=3)
+    second = EmbeddingCache(path, max_entries=3)
+    assert len(first) == 1
+    first.put_many("model", ["a", "b"], [[1.0], [2.0]])
+    second.put_many("model", ["a", "b"], [[1.5], [2.5]])
+    assert len(first) == len(second) == 3
+    assert np.allclose(first.get_many("model", ["a"])[0], [1.5])
+    second.put_many("model", ["c"], [[3.0]])
+    assert len(first) == 3
+    assert first.get_many("model", ["x"]) == [None]
+
+
+def test_embedding_cache_touch(tmp_path):
+    """Test if lookups only update outdated access times."""
+    path = tmp_path / "emb.sqlite"
+    cache = EmbeddingCache(path, touch_interval=60)
+    cache.put_many("model", ["a", "b"], [[1.0], [2.0]])
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "UPDATE embeddings SET accessed = 0 WHERE key = ?", (cache.make_key("a"),)
+    )
+    conn.commit()
+    query = "SELECT key, accessed FROM embeddings"
+    before = dict(conn.execute(query))
+    cache.get_many("model", ["a", "b"])
+    after = dict(conn.execute(query))
+    assert after[cache.make_key("a")] > 0
+    assert after[cache.make_key("b")] == before[cache.make_key("b")]
+
+
+def test_ttl_cache_expiry():
+    """Test if entries expire after their time-to-live."""
+    cache = TTLCache(maxsize=10, ttl=0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 0}
+
+
+def test_semantic_cache():
+    """Test if similar embeddings share entries and the least recently
+    used entry is evicted when full."""
+    cache = SemanticCache(threshold=0.9, maxsize=2)
+    cache.put([1.0, 0.0, 0.0], "a")
+    cache.put([0.0, 1.0, 0.0], "b")
+    assert cache.get([2.0, 0.1, 0.0]) == "a"
+    cache.put([0.0, 0.0, 1.0], "c")
+    assert cache.get([0.0, 1.0, 0.0]) is None
+    assert cache.get([1.0, 0.0, 0.0]) == "a"
+    assert cache.get([0.0, 0.0, 1.0]) == "c"
+    cache.clear()
+    assert len(cache) == 0 and cache.get([1.0, 0.0, 0.0]) is None
+
+
+def test_single_flight():
+    """Test if concurrent calls with the same key share one computation,
+    including its exception, and later calls compute again."""
+    calls = []
+
+    async def compute(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+    async def main():
+        flight = SingleFlight()
+        assert await asyncio.gather(
+            flight.run("a", compute, 1),
+            flight.run("a", compute, 1),
+            flight.run("b", compute, 2),
+        ) == [1, 1, 2]
+        assert await flight.run("a", compute, 1) == 1
+        errors = await asyncio.gather(
+            flight.run("c", compute, -1),
+            flight.run("c", compute, -1),
+            return_exceptions=True,
+        )
+        assert all(isinstance(err, ValueError) for err in errors)
+        assert len(flight) == 0
+
+    asyncio.run(main())
+    assert calls == [1, 2, 1, -1]
+
+
+def test_single_flight_cancel():
+    """Test if cancelling a caller does not cancel the shared computation."""
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.run("a", compute))
+        second = asyncio.ensure_future(flight.run("a", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "done"
@@ -0,0 +1,73 @@
+# Test chat utilities used by the server.
+import asyncio
+
+from langchain.llms.fake import FakeListLLM
+
+from aikg.utils.chat import astream_answer, build_sparql_context
+from aikg.utils.llm import setup_llm_chain
+
+TEMPLATE = "\n{question_str} {query_str} {result_str}\n"
+
+PERSON = """<http://ex.org/Person> <http://www.w3.org/2000/01/rdf-schema#label> "Person" .
+<http://ex.org/birthDate> <http://www.w3.org/2000/01/rdf-schema#domain> <http://ex.org/Person> .
+<http://ex.org/name> <http://www.w3.org/2000/01/rdf-schema#domain> <http://ex.org/Person> ."""
+PLACE = """<http://ex.org/Place> <http://www.w3.org/2000/01/rdf-schema#label> "Place" .
+<http://ex.org/birthDate> <http://www.w3.org/2000/01/rdf-schema#domain> <http://ex.org/Person> ."""
+
+
+class StaticCollection:
+    """Vector store returning the same documents for every question."""
+
+    def __init__(self, *docs: str):
+        self.docs = docs
+
+    def query(self, n_results: int, **kwargs) -> dict:
+        return {"metadatas": [[{"triples": doc} for doc in self.docs[:n_results]]]}
+
+
+class TokenListLLM(FakeListLLM):
+    """Fake LLM emitting its responses word by word through callbacks."""
+
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs):
+        response = await super()._acall(prompt, stop=stop, **kwargs)
+        for token in response.split(" "):
+            await run_manager.on_llm_new_token(token + " ")
+        return response
+
+
+async def collect(stream):
+    return [token async for token in stream]
+
+
+def test_stream_answer_tokens():
+    """Test if answer tokens are streamed as the LLM produces them."""
+    chain = setup_llm_chain(TokenListLLM(responses=["Two results."]), TEMPLATE)
+    tokens = asyncio.run(collect(astream_answer("q", "query", [["a"]], chain)))
+    assert tokens == ["Two ", "results. "]
+
+
+def test_stream_answer_no_tokens():
+    """Test if the full answer is returned when the LLM does not stream."""
+    chain = setup_llm_chain(FakeListLLM(responses=["Two results."]), TEMPLATE)
+    tokens = asyncio.run(collect(astream_answer("q", "query", [["a"]], chain)))
+    assert tokens == ["Two results."]
+
+
+def test_sparql_context_dedup():
+    """Test if triples shared by several documents are only included once."""
+    context = build_sparql_context("Places?", StaticCollection(PERSON, PLACE))
+    assert context.n_triples == 4
+    assert context.n_dropped == 0
+    assert context.text.count("birthDate") == 1
+
+
+def test_sparql_context_budget():
+    """Test if the least relevant triples are dropped to fit the token budget."""
+    question = "What is the birth date of people?"
+    full = build_sparql_context(question, StaticCollection(PERSON, PLACE))
+    context = build_sparql_context(
+        question, StaticCollection(PERSON, PLACE), token_budget=50
+    )
+    assert context.n_triples == 1
+    assert context.n_dropped == full.n_triples - 1
+    assert "birthDate" in context.text
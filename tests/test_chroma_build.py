@@ -0,0 +1,103 @@
+# Test building the vector index from a local RDF file.
+from aikg.config import ChromaConfig, SparqlConfig
+from aikg.flows.chroma_build import chroma_build_flow
+import aikg.utils.chroma as akchroma
+from aikg.utils.chroma import make_document_id, setup_client
+from aikg.utils.rdf import get_subjects_docs
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+import pytest
+from rdflib import ConjunctiveGraph
+from typing import Optional
+
+DATA = """
+@prefix ex: <https://example.org/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+ex:alice rdfs:label "Alice" ; rdfs:comment "A person." ;
+    ex:address [ ex:city "Bern" ; ex:zip 3000 ] .
+ex:bob rdfs:label "Bob" ; rdfs:comment "A person." ; ex:knows ex:alice .
+ex:carol rdfs:label "Carol" ; rdfs:comment "A person." .
+"""
+
+
+class LengthEmbedding(EmbeddingFunction[Documents]):
+    """Deterministic embedding function, so that the sentence-transformers
+    model is not needed."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [[float(len(text)), 1.0] for text in input]
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+    """Build the index of a TriG document, returning the indexed ids."""
+    monkeypatch.setattr(
+        akchroma, "setup_embedding_function", lambda *args, **kwargs: LengthEmbedding()
+    )
+    chroma_cfg = ChromaConfig(
+        host="local",
+        persist_directory=str(tmp_path / "chroma"),
+        embedding_cache="",
+    )
+
+    def run(data: str, incremental: bool, graph: Optional[str] = None) -> set:
+        path = tmp_path / "data.trig"
+        path.write_text(data)
+        chroma_build_flow(
+            chroma_cfg,
+            SparqlConfig(endpoint=str(path)),
+            graph=graph,
+            incremental=incremental,
+        )
+        client = setup_client("local", 0, chroma_cfg.persist_directory)
+        coll = client.get_collection(chroma_cfg.collection_name)
+        return set(coll.get(include=[])["ids"])
+
+    return run
+
+
+def test_document_ids_stable():
+    """Test if document ids do not depend on blank node labels, which
+    change every time the data is parsed."""
+    ids = []
+    for _ in range(2):
+        kg = ConjunctiveGraph()
+        kg.parse(data=DATA, format="turtle")
+        ids.append([make_document_id(doc) for doc in get_subjects_docs(kg)])
+    assert ids[0] == ids[1]
+    assert len(ids[0]) == 3
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_build_changes(build, incremental):
+    """Test if rebuilding keeps unchanged documents, adds new and changed
+    ones and removes outdated ones."""
+    first = build(DATA, incremental)
+    assert len(first) == 3
+    assert build(DATA, incremental) == first
+    changed = DATA.replace('"Carol"', '"Caroline"').replace("ex:bob", "ex:dan")
+    second = build(changed, incremental)
+    assert len(second) == 3
+    # Only alice is unchanged, bob is deleted, carol changed and dan is new
+    assert len(first & second) == 1
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_build_graphs(build, incremental):
+    """Test if building a graph keeps the documents of other graphs
+    indexed in the same collection."""
+    prefixes, statements = DATA.split("\n\n")
+    data = prefixes + "".join(
+        f"\n<https://example.org/{name}> {{ {statements} }}" for name in ("a", "b")
+    )
+    first = build(data, incremental, graph="https://example.org/a")
+    assert len(first) == 3
+    both = build(data, incremental, graph="https://example.org/b")
+    assert len(both) == 6 and first < both
+    changed = data.replace('"Carol"', '"Caroline"', 1)
+    last = build(changed, incremental, graph="https://example.org/a")
+    # Carol changed in graph a only
+    assert len(last) == 6 and both - first < last
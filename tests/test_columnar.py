@@ -0,0 +1,147 @@
+# Test the columnar, typed representation of query results.
+from aikg.utils.columnar import (
+    aquery_kg_columns,
+    decode_json,
+    decode_ntriples,
+    decode_tsv,
+    query_kg_columns,
+)
+from aikg.utils.rdf import QueryLimits, query_kg, setup_kg
+from aikg.utils.summary import summarize_results
+import asyncio
+import httpx
+import json
+import pytest
+from rdflib import BNode, Literal, URIRef
+from rdflib.namespace import XSD
+
+EX = "http://example.org/"
+TSV = (
+    "?s\t?name\t?age\r\n"
+    f'<{EX}alice>\t"Alice"@en\t42\r\n'
+    f'<{EX}bob>\t"B\\tob"\t"7"^^<{XSD.int}>\r\n'
+    f"_:b0\t\t\r\n"
+)
+JSON = {
+    "head": {"vars": ["s", "name", "age"]},
+    "results": {
+        "bindings": [
+            {
+                "s": {"type": "uri", "value": f"{EX}alice"},
+                "name": {"type": "literal", "value": "Alice", "xml:lang": "en"},
+                "age": {"type": "literal", "value": "42", "datatype": str(XSD.integer)},
+            },
+            {
+                "s": {"type": "uri", "value": f"{EX}bob"},
+                "name": {"type": "literal", "value": "B\tob"},
+                "age": {"type": "literal", "value": "7", "datatype": str(XSD.int)},
+            },
+            {"s": {"type": "bnode", "value": "b0"}},
+        ]
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "results",
+    [decode_tsv(TSV.encode()), decode_json(json.dumps(JSON).encode())],
+    ids=["tsv", "json"],
+)
+def test_decode_select(results):
+    """Test if TSV and JSON results are decoded into the same typed columns."""
+    assert results.variables == ["s", "name", "age"]
+    assert len(results) == 3
+    assert results.column("s") == [
+        URIRef(f"{EX}alice"),
+        URIRef(f"{EX}bob"),
+        BNode("b0"),
+    ]
+    assert results.column("name") == [
+        Literal("Alice", lang="en"),
+        Literal("B\tob"),
+        None,
+    ]
+    assert results.column("age")[1].datatype == XSD.int
+    assert results.numeric("age")[:2].tolist() == [42.0, 7.0]
+    assert results.to_table()[1:] == [
+        [f"{EX}alice", "Alice", "42"],
+        [f"{EX}bob", "B\tob", "7"],
+        ["_:b0", "", ""],
+    ]
+
+
+def test_decode_ntriples():
+    """Test if graph results are decoded into triples."""
+    data = f'<{EX}a> <{EX}p> "x"@en .\n<{EX}a> <{EX}q> _:b .\n'.encode()
+    results = decode_ntriples(data)
+    assert results.variables == ["subject", "predicate", "object"]
+    assert set(results.triples()) == {
+        (URIRef(f"{EX}a"), URIRef(f"{EX}p"), Literal("x", lang="en")),
+        (URIRef(f"{EX}a"), URIRef(f"{EX}q"), BNode("b")),
+    }
+    # Repeated terms are stored once
+    assert len(results.terms) == 5
+
+
+def test_rdflib_columns():
+    """Test if columnar results of a local graph match the result table."""
+    kg = setup_kg("data/test_data.trig")
+    query = "SELECT ?s ?p ?o WHERE { ?s ?p ?o } ORDER BY ?s ?p ?o"
+    assert query_kg_columns(kg, query).to_table() == query_kg(kg, query)
+    results = query_kg_columns(kg, query, limits=QueryLimits(max_rows=5))
+    assert len(results) == 5 and results.truncated
+    assert "5 rows (truncated" in summarize_results(results)
+    graph = query_kg_columns(kg, "CONSTRUCT WHERE { ?s ?p ?o }").to_graph()
+    assert set(graph) == set(kg.triples((None, None, None)))
+
+
+def test_endpoint_columns():
+    """Test if TSV results are requested from endpoints and decoded."""
+    accept = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        accept.append(request.headers["Accept"])
+        return httpx.Response(200, content=TSV.encode())
+
+    async def run():
+        kg = setup_kg("http://localhost:7200/repositories/test")
+        transport = httpx.MockTransport(handler)
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await aquery_kg_columns(kg, "SELECT * { ?s ?p ?o }", client)
+
+    results = asyncio.run(run())
+    assert accept == ["text/tab-separated-values"]
+    assert results.column("name")[0] == Literal("Alice", lang="en")
+
+
+def test_endpoint_json_truncated():
+    """Test if JSON results cut at the byte budget keep their complete rows."""
+    bindings = [
+        {
+            "s": {"type": "uri", "value": f"{EX}{i}"},
+            "n": {"type": "literal", "value": "é"},
+        }
+        for i in range(20_000)
+    ]
+    doc = {"head": {"vars": ["s", "n"]}, "results": {"bindings": bindings}}
+    data = json.dumps(doc, ensure_ascii=False).encode()
+    assert len(data) > 1_000_000
+
+    async def chunks():
+        for start in range(0, len(data), 65536):
+            yield data[start : start + 65536]
+
+    async def run():
+        kg = setup_kg("http://localhost:7200/repositories/test")
+        limits = QueryLimits(max_rows=10**6, max_bytes=200_000)
+        transport = httpx.MockTransport(lambda _: httpx.Response(200, content=chunks()))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await aquery_kg_columns(
+                kg, "SELECT * { ?s ?p ?o }", client, fmt="json", limits=limits
+            )
+
+    results = asyncio.run(run())
+    assert results.truncated
+    assert 1000 < len(results) < len(bindings)
+    assert results.column("s")[-1] == URIRef(f"{EX}{len(results) - 1}")
+    assert set(results.column("n")) == {Literal("é")}
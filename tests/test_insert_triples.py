@@ -0,0 +1,242 @@
+# Test loading RDF files into a local stand-in SPARQL endpoint.
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import threading
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+from rdflib import BNode, ConjunctiveGraph, Graph, URIRef
+from rdflib.compare import isomorphic
+
+from aikg.config import SparqlConfig
+from aikg.flows.insert_triples import sparql_insert_flow
+from aikg.utils.cache import GenerationCounter
+from aikg.utils.io import open_file
+from aikg.utils.ntriples import parse_statement
+
+TEST_DATA = Path("data/test_data.trig").absolute()
+EXTRA_DATA = """
+<https://example.org/a> <https://example.org/p> "quote \\" and \\\\ backslash" .
+<https://example.org/a> <https://example.org/p> "caf\\u00E9"@fr-CH .
+<https://example.org/a> <https://example.org/p> "1"^^<http://www.w3.org/2001/XMLSchema#integer> .
+<https://example.org/a> <https://example.org/p> "x" . # comment
+"""
+
+UPLOAD_FORMATS = {"application/n-triples": "nt", "application/n-quads": "nquads"}
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    """Run in a temporary directory, where the generation file is written."""
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def endpoint():
+    """Stand-in SPARQL endpoint running updates on an rdflib graph. It also
+    accepts N-Triples and N-Quads uploads, like a graph store. Each request
+    is parsed into its own graph, so that blank node labels are scoped to a
+    request as in a real store. Requests fail with a server error if
+    state["fail"](request_number) is true."""
+    kg = ConjunctiveGraph()
+    lock = threading.Lock()
+    state = {"requests": 0, "fail": lambda n: False}
+
+    def merge(request: ConjunctiveGraph):
+        fresh = defaultdict(BNode)
+        kg.addN(
+            (
+                fresh[s] if isinstance(s, BNode) else s,
+                p,
+                fresh[o] if isinstance(o, BNode) else o,
+                kg.get_context(g.identifier),
+            )
+            for s, p, o, g in request.quads()
+        )
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            with lock:
+                state["requests"] += 1
+                fail = state["fail"](state["requests"])
+                content_type = self.headers["Content-Type"]
+                request = ConjunctiveGraph(identifier=kg.default_context.identifier)
+                if fail:
+                    pass
+                elif content_type in UPLOAD_FORMATS:
+                    request.parse(
+                        data=body.decode("utf-8"),
+                        format=UPLOAD_FORMATS[content_type],
+                        publicID=kg.default_context.identifier,
+                    )
+                else:
+                    request.update(parse_qs(body.decode("utf-8"))["update"][0])
+                merge(request)
+            self.send_response(503 if fail else 200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("localhost", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://localhost:{server.server_port}", kg, state
+    server.shutdown()
+
+
+@pytest.fixture
+def nt_file(tmp_path):
+    """N-Triples file with the test data and tricky literals."""
+    path = tmp_path / "data.nt"
+    source = ConjunctiveGraph()
+    source.parse(TEST_DATA)
+    data = source.serialize(format="nt")
+    path.write_text(data + EXTRA_DATA, encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def nq_file(tmp_path):
+    """N-Quads file with statements from several named graphs."""
+    path = tmp_path / "data.nq"
+    source = ConjunctiveGraph()
+    source.parse(TEST_DATA)
+    source.serialize(path, format="nquads")
+    return path
+
+
+def graphs(kg: ConjunctiveGraph) -> dict:
+    """Map each non-empty graph identifier to its set of triples."""
+    return {str(g.identifier): set(g) for g in kg.contexts() if len(g)}
+
+
+def test_parse_statement():
+    """Test if statements are tokenized into terms in N-Triples syntax."""
+    st = parse_statement('_:b1 <http://p> "a \\"b\\""@en-US <http://g> . # c')
+    assert st == ("_:b1", "<http://p>", '"a \\"b\\""@en-US', "<http://g>")
+    with pytest.raises(ValueError):
+        parse_statement("<http://a> <http://p> .")
+
+
+def test_insert_triples(endpoint, nt_file):
+    """Test if the loaded graph matches the source file exactly."""
+    url, kg, _ = endpoint
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=7, load_concurrency=3)
+    sparql_insert_flow(nt_file, cfg)
+    source = Graph().parse(nt_file, format="nt")
+    assert len(kg) == len(source)
+    assert isomorphic(kg, source)
+    assert GenerationCounter(cfg.generation_file).get() == 1
+
+
+def test_insert_quads(endpoint, nq_file):
+    """Test if quads are loaded into their own named graph."""
+    url, kg, _ = endpoint
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=7, load_concurrency=3)
+    sparql_insert_flow(nq_file, cfg)
+    source = ConjunctiveGraph()
+    source.parse(nq_file, format="nquads")
+    assert len(graphs(source)) > 1
+    assert graphs(kg) == graphs(source)
+
+
+def test_insert_quads_graph(endpoint, nq_file):
+    """Test if the graph option overrides the graph of quads."""
+    url, kg, _ = endpoint
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=7, load_concurrency=3)
+    sparql_insert_flow(nq_file, cfg, graph="https://example.org/all")
+    source = ConjunctiveGraph()
+    source.parse(nq_file, format="nquads")
+    assert graphs(kg) == {"https://example.org/all": set(source.triples((None,) * 3))}
+
+
+def test_insert_retry(endpoint, nt_file):
+    """Test if failed inserts are retried."""
+    url, kg, state = endpoint
+    state["fail"] = lambda n: n <= 2
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=50, load_retry_backoff=0.01)
+    sparql_insert_flow(nt_file, cfg)
+    assert isomorphic(kg, Graph().parse(nt_file, format="nt"))
+
+
+def test_insert_resume(endpoint, nt_file):
+    """Test if an interrupted load resumes from its checkpoint."""
+    url, kg, state = endpoint
+    state["fail"] = lambda n: n >= 3
+    cfg = SparqlConfig(
+        endpoint=url, load_chunk_size=50, load_concurrency=1, load_retries=0
+    )
+    with pytest.raises(httpx.HTTPStatusError):
+        sparql_insert_flow(nt_file, cfg)
+    checkpoint = nt_file.with_name(nt_file.name + ".checkpoint")
+    assert int(checkpoint.read_text()) > 0
+    assert len(kg) == 100
+
+    state["fail"] = lambda n: False
+    state["requests"] = 0
+    sparql_insert_flow(nt_file, cfg, resume=True)
+    source = Graph().parse(nt_file, format="nt")
+    assert state["requests"] == -(-len(source) // 50) - 2
+    assert isomorphic(kg, source)
+    assert not checkpoint.exists()
+
+
+@pytest.mark.parametrize("ext", [".gz", ".bz2", ".xz"])
+def test_insert_compressed(endpoint, nq_file, ext):
+    """Test if compressed files are decompressed while loading."""
+    url, kg, _ = endpoint
+    path = nq_file.with_name(nq_file.name + ext)
+    with open_file(path, "wb") as dst:
+        dst.write(nq_file.read_bytes())
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=7, load_concurrency=3)
+    sparql_insert_flow(path, cfg)
+    source = ConjunctiveGraph()
+    source.parse(nq_file, format="nquads")
+    assert graphs(kg) == graphs(source)
+
+
+def test_upload_quads(endpoint, nq_file):
+    """Test if uploads load quads into their own named graph."""
+    url, kg, _ = endpoint
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=7, load_mode="upload")
+    sparql_insert_flow(nq_file, cfg)
+    source = ConjunctiveGraph()
+    source.parse(nq_file, format="nquads")
+    assert graphs(kg) == graphs(source)
+
+
+def test_upload_triples(endpoint, nt_file):
+    """Test if uploaded triples match the source file exactly."""
+    url, kg, _ = endpoint
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=7, load_mode="upload")
+    sparql_insert_flow(nt_file, cfg)
+    assert isomorphic(kg, Graph().parse(nt_file, format="nt"))
+
+
+@pytest.mark.parametrize("mode", ["insert", "upload"])
+def test_insert_bnodes(endpoint, tmp_path, mode):
+    """Test if a blank node whose statements are sent in several requests
+    stays a single node."""
+    url, kg, _ = endpoint
+    path = tmp_path / "bnodes.nt"
+    path.write_text(
+        "".join(
+            f'_:b{i // 4} <https://example.org/p{i % 4}> "{i}" .\n' for i in range(12)
+        )
+        + "<https://example.org/a> <https://example.org/knows> _:b1 .\n"
+    )
+    cfg = SparqlConfig(endpoint=url, load_chunk_size=3, load_mode=mode)
+    sparql_insert_flow(path, cfg)
+    # Blank nodes are loaded as IRIs, which stand for the same nodes
+    loaded = Graph()
+    for s, p, o in kg.triples((None, None, None)):
+        s, o = (
+            BNode(t) if isinstance(t, URIRef) and t.startswith("urn:") else t
+            for t in (s, o)
+        )
+        loaded.add((s, p, o))
+    assert len(set(kg.subjects())) == 4
+    assert isomorphic(loaded, Graph().parse(path, format="nt"))
@@ -0,0 +1,33 @@
+# Test server metrics and their Prometheus export.
+from aikg.utils.metrics import Metrics
+
+
+def test_histogram_buckets():
+    """Test if bucket counts are cumulative and include their upper bound."""
+    metrics = Metrics(buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        metrics.observe("latency", value, stage="a")
+    text = metrics.render()
+    assert 'latency_bucket{stage="a",le="0.1"} 2' in text
+    assert 'latency_bucket{stage="a",le="1.0"} 3' in text
+    assert 'latency_bucket{stage="a",le="+Inf"} 4' in text
+    assert 'latency_count{stage="a"} 4' in text
+
+
+def test_disabled_metrics():
+    """Test if nothing is recorded when metrics are disabled."""
+    metrics = Metrics(enabled=False)
+    metrics.inc("requests")
+    with metrics.time("latency"):
+        pass
+    assert metrics.render() == "\n"
+
+
+def test_set_total():
+    """Test if totals counted elsewhere are exported as counters."""
+    metrics = Metrics()
+    metrics.set_total("hits_total", 3, cache="a")
+    metrics.set_total("hits_total", 5, cache="a")
+    text = metrics.render()
+    assert "# TYPE hits_total counter" in text
+    assert 'hits_total{cache="a"} 5.0' in text
@@ -0,0 +1,34 @@
+# Test concurrent processing pipelines.
+from aikg.utils.pipeline import run_pipeline
+import pytest
+
+
+@pytest.mark.parametrize("n_workers", [1, 4])
+def test_run_pipeline(n_workers):
+    """Test if all items go through every stage."""
+    batches = [list(range(i, i + 10)) for i in range(0, 1000, 10)]
+    written = []
+    stats = run_pipeline(
+        batches,
+        stages=[
+            ("square", lambda b: [x**2 for x in b], n_workers),
+            ("write", written.extend, 1),
+        ],
+        queue_size=2,
+    )
+    assert sorted(written) == [x**2 for x in range(1000)]
+    assert [s.items for s in stats] == [1000, 1000, 1000]
+
+
+def test_run_pipeline_error():
+    """Test if errors in a stage are raised without blocking the pipeline."""
+
+    def fail(batch):
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        run_pipeline(
+            ([i] for i in range(1000)),
+            stages=[("fail", fail, 2), ("write", lambda b: None, 1)],
+            queue_size=1,
+        )
@@ -1,8 +1,27 @@
 # Test RDF functionality to interact with a knowledge graph.
 # The kg may be a SPARQL endpoint or a local RDF file.
 from aikg.config import SparqlConfig
-from aikg.utils.rdf import query_kg, setup_kg
+from aikg.utils.cache import GenerationCounter
+from aikg.utils.io import open_file
+from aikg.utils.rdf import (
+    PAGE_FILTER,
+    QueryCache,
+    QueryLimits,
+    aquery_kg,
+    limit_query,
+    get_subjects_docs,
+    iter_query_kg,
+    query_kg,
+    query_timeout,
+    setup_kg,
+    split_documents_from_endpoint,
+)
+import asyncio
+import httpx
 import pytest
+import random
+from rdflib import ConjunctiveGraph, Graph, URIRef
+from rdflib.compare import isomorphic
 
 rdflib_config = SparqlConfig(
     endpoint="data/test_data.trig",
@@ -38,6 +57,93 @@ def test_run_query_kg(kg, query, request):
     assert len(res) >= 1
 
 
+def test_query_cache(rdflib_kg, tmp_path):
+    """Test if equivalent queries share cached results until the
+    generation of the knowledge graph is bumped."""
+    generation = GenerationCounter(tmp_path / "generation")
+    cache = QueryCache(maxsize=10, generation=generation)
+    query = "PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>\nSELECT ?s {?s rdfs:label ?l}"
+    same = "select ?s where { ?s <http://www.w3.org/2000/01/rdf-schema#label> ?l . }"
+    res = query_kg(rdflib_kg, query, cache=cache)
+    assert query_kg(rdflib_kg, same, cache=cache) is res
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+    # Results truncated to other limits are cached separately
+    limited = query_kg(rdflib_kg, same, cache=cache, limits=QueryLimits(max_rows=1))
+    assert len(limited) == 2 and limited.truncated
+    assert query_kg(rdflib_kg, query, cache=cache) is res
+    generation.bump()
+    assert query_kg(rdflib_kg, same, cache=cache) == res
+    assert cache.stats()["misses"] == 3
+
+
+def test_limit_query():
+    """Test if the LIMIT of the outer query is added or lowered."""
+    sub = "SELECT * { { SELECT ?s { ?s ?p ?o } LIMIT 2 } }"
+    assert limit_query(sub, 10) == f"{sub}\nLIMIT 10"
+    query = "SELECT ?s { { SELECT ?s { ?s ?p ?o } LIMIT 2 } } LIMIT 50"
+    assert limit_query(query, 10).endswith("LIMIT 2 } } LIMIT 10")
+    # Prefixes predefined by the endpoint are unknown to rdflib
+    assert limit_query("SELECT ?s { ?s ex:p ?o } LIMIT 50", 10).endswith("LIMIT 10")
+    assert limit_query("SELECT ?s { ?s ex:p ?o }", 10).endswith("\nLIMIT 10")
+    offset = "SELECT ?s { ?s ex:p ?o } OFFSET 2 LIMIT 50"
+    assert limit_query(offset, 10).endswith("} OFFSET 2 LIMIT 10")
+    comment = "SELECT ?s { ?s ex:p ?o } LIMIT 5 # LIMIT 50"
+    assert limit_query(comment, 10) == comment
+    assert limit_query("ASK WHERE { ?s ?p ?o", 10) == "ASK WHERE { ?s ?p ?o"
+    values = "SELECT ?s { ?s ex:p ?o } VALUES ?o { 1 2 }"
+    assert limit_query(values, 10).endswith("}\nLIMIT 10\nVALUES ?o { 1 2 }")
+    values = "SELECT ?s { ?s ex:p ?o } LIMIT 50 VALUES (?o) { (1) }"
+    assert limit_query(values, 10).endswith("} LIMIT 10 VALUES (?o) { (1) }")
+
+
+def test_query_limits_rdflib(rdflib_kg):
+    """Test if results of a local graph are truncated to the row and byte budgets."""
+    query = "SELECT ?s ?p ?o WHERE { ?s ?p ?o }"
+    res = query_kg(rdflib_kg, query, limits=QueryLimits(max_rows=5))
+    assert len(res) == 6 and res.truncated
+    res = query_kg(rdflib_kg, query, limits=QueryLimits(max_bytes=300))
+    assert 1 < len(res) < 6 and res.truncated
+    res = query_kg(rdflib_kg, f"{query} LIMIT 3", limits=QueryLimits(max_rows=5))
+    assert len(res) == 4 and not res.truncated
+
+
+def test_query_limits_endpoint():
+    """Test if the limit and timeout are sent to the endpoint,
+    and large responses are only read up to the byte budget."""
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(dict(httpx.QueryParams(request.content.decode())))
+        rows = "".join(f"http://ex.org/{i}\r\n" for i in range(100_000))
+        return httpx.Response(200, content=f"s\r\n{rows}".encode())
+
+    async def run():
+        kg = setup_kg("http://localhost:7200/repositories/test")
+        limits = QueryLimits(max_rows=10**6, max_bytes=1000, timeout=5)
+        transport = httpx.MockTransport(handler)
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await aquery_kg(kg, "SELECT ?s { ?s ?p ?o }", client, limits=limits)
+
+    res = asyncio.run(run())
+    assert res.truncated and res[0] == ["s"] and 1 < len(res) < 100
+    assert requests[0]["query"].endswith("LIMIT 1000001")
+    assert requests[0]["timeout"] == "5"
+
+
+def test_query_timeout_restored():
+    """Test if the timeout of query limits is only applied to the shared
+    SPARQLWrapper while the query runs."""
+    kg = setup_kg("http://localhost:7200/repositories/test")
+    kg.setTimeout(30)
+    with pytest.raises(RuntimeError):
+        with query_timeout(kg, QueryLimits(timeout=4.5)):
+            assert kg.timeout == 5
+            raise RuntimeError
+    assert kg.timeout == 30
+    with query_timeout(kg, QueryLimits()):
+        assert kg.timeout == 30
+
+
 @pytest.mark.parametrize("query", QUERIES)
 def test_compare_query_kg(sparql_kg, rdflib_kg, query):
     """Test if the same query on rdflib and sparql yields
@@ -46,3 +152,150 @@ def test_compare_query_kg(sparql_kg, rdflib_kg, query):
     sparql_res = query_kg(sparql_kg, query)
     assert len(sparql_res) == len(rdflib_res)
     assert all([len(x) == len(y) for x, y in zip(sparql_res, rdflib_res)])
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 500])
+def test_subjects_docs_batch(rdflib_kg, batch_size):
+    """Test if batched subject documents contain the same triples
+    as individual DESCRIBE queries."""
+    docs = list(get_subjects_docs(rdflib_kg, batch_size=batch_size))
+    assert len(docs) >= 1
+    for doc in docs:
+        sub = doc.metadata["subject"]
+        described = query_kg(rdflib_kg, f"DESCRIBE <{sub}>")[0][0].decode()
+        assert doc.metadata["triples"].splitlines() == sorted(
+            filter(None, described.splitlines())
+        )
+
+
+def test_subjects_docs_context(rdflib_kg):
+    """Test if the compact turtle context of subject documents
+    contains the same triples as their N-Triples."""
+    for doc in get_subjects_docs(rdflib_kg):
+        meta = doc.metadata
+        context = Graph().parse(
+            data=f"{meta['prefixes']}\n{meta['context']}", format="turtle"
+        )
+        triples = Graph().parse(data=meta["triples"], format="nt")
+        assert isomorphic(context, triples)
+
+
+@pytest.mark.parametrize("page_size", [None, 1, 7, 1000])
+def test_iter_query_kg_pages(rdflib_kg, page_size):
+    """Test if paginated iteration yields the same rows as query_kg."""
+    query = "SELECT ?s ?p ?o WHERE { ?s ?p ?o } ORDER BY ?s ?p ?o"
+    rows = list(iter_query_kg(rdflib_kg, query, page_size=page_size))
+    assert rows == query_kg(rdflib_kg, query)[1:]
+
+
+class UnstableGraph(Graph):
+    """Graph whose triples are stored in a random order for each query, so
+    that rows sorted on a partial key come in random order, like on
+    endpoints whose sort is not stable."""
+
+    def query(self, *args, **kwargs):
+        triples = list(self)
+        random.shuffle(triples)
+        shuffled = Graph()
+        for triple in triples:
+            shuffled.add(triple)
+        return shuffled.query(*args, **kwargs)
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 100])
+def test_iter_query_kg_key_pages(page_size):
+    """Test if pagination by key neither repeats nor skips rows when page
+    boundaries split the rows of a subject."""
+    kg = UnstableGraph()
+    kg.parse(data=LABELLED_DATA, format="turtle")
+    query = f"SELECT ?s ?p ?o WHERE {{ ?s ?p ?o {PAGE_FILTER} }} ORDER BY ?s"
+    rows = list(iter_query_kg(kg, query, page_size=page_size, key="s"))
+    expected = query_kg(kg, query.replace(PAGE_FILTER, ""))[1:]
+    assert sorted(rows) == sorted(expected)
+    subjects = [row[0] for row in rows]
+    assert subjects == sorted(subjects)
+
+
+BLANK_DATA = """
+@prefix ex: <https://example.org/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+ex:alice rdfs:label "Alice"@en ; rdfs:comment "A person."@en .
+[] rdfs:label "Home"@en ; rdfs:comment "An address."@en ; ex:city "Bern" .
+[] rdfs:label "Work"@en ; rdfs:comment "An address."@en ; ex:city "Basel" .
+ex:bob rdfs:label "Bob"@en ; rdfs:comment "A person."@en .
+"""
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 100])
+def test_iter_query_kg_blank_keys(page_size):
+    """Test if rows whose key is a blank node are neither skipped nor
+    repeated when paginating by key."""
+    kg = ConjunctiveGraph()
+    kg.parse(data=BLANK_DATA, format="turtle")
+    query = f"SELECT ?s ?p ?o WHERE {{ ?s ?p ?o {PAGE_FILTER} }} ORDER BY ?s"
+    rows = list(iter_query_kg(kg, query, page_size=page_size, key="s"))
+    expected = query_kg(kg, query.replace(PAGE_FILTER, ""))[1:]
+    assert sorted(rows) == sorted(expected)
+    docs = list(get_subjects_docs(kg, page_size=page_size))
+    assert len(docs) == len({doc.metadata["subject"] for doc in docs}) == 4
+
+
+LABELLED_DATA = """
+@prefix ex: <https://example.org/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+ex:name rdfs:label "name"@en .
+ex:knows rdfs:label "knows"@en .
+ex:alice rdfs:label "Alice"@en ; ex:name "Alice" ; ex:knows ex:bob ;
+    rdfs:comment "A person."@en .
+ex:bob rdfs:label "Bob"@en ; ex:name "Bob" ; ex:knows ex:alice ;
+    rdfs:comment "A person."@en .
+"""
+
+
+@pytest.mark.parametrize("page_size", [None, 1, 2, 100])
+def test_split_documents_pages(page_size):
+    """Test if streamed documents are identical regardless of pagination,
+    and include all subjects."""
+    kg = ConjunctiveGraph()
+    kg.parse(data=LABELLED_DATA, format="turtle")
+    docs = list(split_documents_from_endpoint(kg, page_size=page_size))
+    expected = list(split_documents_from_endpoint(kg))
+    assert docs == expected
+    assert len(docs) == 2
+    subjects = [doc.metadata["subject"] for doc in docs]
+    assert subjects == sorted(subjects)
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 4])
+def test_documents_split_subjects(page_size):
+    """Test if documents are complete when page boundaries fall within the
+    triples of a subject, with rows in random order within subjects."""
+    kg = UnstableGraph()
+    kg.parse(data=LABELLED_DATA, format="turtle")
+    docs = list(split_documents_from_endpoint(kg, page_size=page_size))
+    expected = list(split_documents_from_endpoint(kg))
+    assert [doc.metadata["subject"] for doc in docs] == [
+        doc.metadata["subject"] for doc in expected
+    ]
+    for doc, other in zip(docs, expected):
+        assert sorted(doc.page_content.splitlines()) == sorted(
+            other.page_content.splitlines()
+        )
+    subject_docs = list(get_subjects_docs(kg, page_size=page_size))
+    assert subject_docs == list(get_subjects_docs(kg))
+
+
+@pytest.mark.parametrize("ext", [".gz", ".bz2", ".xz"])
+def test_setup_kg_compressed(rdflib_kg, tmp_path, ext):
+    """Test if compressed RDF files are parsed without a temporary copy."""
+    path = tmp_path / f"data.trig{ext}"
+    with open("data/test_data.trig", "rb") as src, open_file(path, "wb") as dst:
+        dst.write(src.read())
+    kg = setup_kg(str(path))
+    assert set(kg.triples((None, None, None))) == set(
+        rdflib_kg.triples((None, None, None))
+    )
+    ontology = URIRef("https://example.org/ontology")
+    assert set(kg.get_context(ontology)) == set(rdflib_kg.get_context(ontology))
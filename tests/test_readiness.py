@@ -0,0 +1,57 @@
+# Test the readiness tracking of components loaded in the background.
+import asyncio
+import time
+
+from aikg.utils.readiness import ComponentError, Readiness
+import pytest
+
+
+def test_readiness_order():
+    """Test if components wait for their dependencies, and record
+    their time to ready."""
+
+    async def run():
+        readiness = Readiness()
+        loaded = []
+
+        def load(name, delay):
+            time.sleep(delay)
+            loaded.append(name)
+
+        await asyncio.gather(
+            readiness.run("index", load, "index", 0.0, after=["model"]),
+            readiness.run("model", load, "model", 0.05),
+        )
+        return readiness, loaded
+
+    readiness, loaded = asyncio.run(run())
+    assert loaded == ["model", "index"]
+    status = readiness.status()
+    assert status["ready"]
+    components = status["components"]
+    assert components["index"]["seconds"] >= components["model"]["seconds"] >= 0.05
+
+
+def test_readiness_failure():
+    """Test if failures are reported without blocking other components,
+    and waiting for a failed component raises."""
+
+    async def run():
+        readiness = Readiness()
+        readiness.add("kg")
+
+        def fail():
+            raise OSError("no such file")
+
+        await readiness.run("model", fail)
+        await readiness.run("index", lambda: None, after=["model"])
+        assert not readiness.ready
+        with pytest.raises(ComponentError, match="no such file"):
+            await readiness.wait("model")
+        await readiness.run("kg", lambda: None)
+        return readiness.status()["components"]
+
+    components = asyncio.run(run())
+    assert components["model"]["status"] == "failed"
+    assert components["index"]["status"] == "failed"
+    assert components["kg"]["status"] == "ready"
@@ -0,0 +1,122 @@
+# Test the chat server endpoints, with stand-in components.
+from aikg.config import ChatConfig, ChromaConfig, SparqlConfig
+from aikg.server import COMPONENTS, ChatServer, create_app
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+import pytest
+import time
+
+QUERY = "SELECT ?s WHERE { ?s ?p ?o }"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Chat server whose components are ready right away. The vector index,
+    knowledge graph and LLM are not used: queries are generated by a stub."""
+
+    async def warm_up(self):
+        self.embed = lambda texts: [[float(len(text)), 1.0] for text in texts]
+        for name in COMPONENTS:
+            await self.readiness.run(name, lambda: None)
+
+    async def get_query(self, question, embedding, limit=5):
+        return QUERY
+
+    monkeypatch.setattr(ChatServer, "warm_up", warm_up)
+    monkeypatch.setattr(ChatServer, "check_index_builds", lambda self: None)
+    monkeypatch.setattr(ChatServer, "get_query", get_query)
+    app = create_app(
+        ChatConfig(metrics_enabled=True),
+        ChromaConfig(host="local", persist_directory=str(tmp_path / "chroma")),
+        SparqlConfig(generation_file=str(tmp_path / "generation")),
+    )
+    with TestClient(app) as client:
+        for _ in range(100):
+            if client.get("/readyz").status_code == 200:
+                break
+            time.sleep(0.01)
+        assert client.get("/readyz").status_code == 200
+        yield client
+
+
+def parse_events(text: str) -> list:
+    """Return the (event, data) pairs of a server-sent events stream."""
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = [line for line in block.split("\n") if not line.startswith(":")]
+        if lines:
+            event = lines[0].removeprefix("event: ")
+            data = "\n".join(line.removeprefix("data: ") for line in lines[1:])
+            events.append((event, data))
+    return events
+
+
+@pytest.mark.parametrize(
+    "error,detail",
+    [
+        (HTTPException(status_code=504, detail="Timed out."), "Timed out."),
+        (RuntimeError("Connection refused."), "Internal server error"),
+    ],
+)
+def test_ask_stream_error(client, monkeypatch, error, detail):
+    """Test if errors raised after the stream started are sent as a last
+    error event, without leaking unexpected error messages."""
+
+    async def run_query(self, query):
+        raise error
+
+    monkeypatch.setattr(ChatServer, "run_query", run_query)
+    response = client.get("/ask/stream/", params={"question": "Who is Alice?"})
+    assert response.status_code == 200
+    events = parse_events(response.text)
+    assert events[0] == ("query", QUERY)
+    assert events[-1] == ("error", f'{{"detail": "{detail}"}}')
+
+
+def test_metrics_labels(client):
+    """Test if request durations are labelled with route templates, and
+    cache statistics are exported as counters."""
+    client.get("/healthz")
+    client.get("/unknown/12345")
+    text = client.get("/metrics").text
+    assert 'aikg_request_duration_seconds_count{path="/healthz"} 1' in text
+    assert 'aikg_request_duration_seconds_count{path="unmatched"} 1' in text
+    assert "/unknown/12345" not in text
+    assert "# TYPE aikg_cache_hits_total counter" in text
+    assert 'aikg_cache_misses_total{cache="answers"} 0.0' in text
+
+
+@pytest.mark.parametrize(
+    "token,header,status",
+    [
+        ("", "Bearer ", 404),
+        ("secret", "", 401),
+        ("secret", "Bearer wrong", 401),
+        ("secret", "Bearer secret", 200),
+    ],
+)
+def test_invalidate_cache_token(client, token, header, status):
+    """Test if clearing the caches requires the admin token, and is disabled
+    without one."""
+    client.app.state.server.chat_config.admin_token = token
+    headers = {"Authorization": header} if header else {}
+    response = client.post("/cache/invalidate/", headers=headers)
+    assert response.status_code == status
+
+
+def test_cached_query_limit(client, monkeypatch):
+    """Test if queries generated for /sparql/ with fewer context documents
+    are not reused to answer questions."""
+
+    async def get_query(self, question, embedding, limit=5):
+        return f"{QUERY} # {limit}"
+
+    async def run_query(self, query):
+        raise HTTPException(status_code=504, detail="Timed out.")
+
+    monkeypatch.setattr(ChatServer, "get_query", get_query)
+    monkeypatch.setattr(ChatServer, "run_query", run_query)
+    params = {"question": "Who is Alice?"}
+    assert client.get("/sparql/", params=params).json()["text"] == f"{QUERY} # 5"
+    response = client.get("/ask/stream/", params=params)
+    assert parse_events(response.text)[0] == ("query", f"{QUERY} # 15")
@@ -0,0 +1,49 @@
+# Test the summarization of large query results.
+from aikg.utils.chat import format_results
+from aikg.utils.llm import estimate_tokens
+from aikg.utils.rdf import ResultTable
+from aikg.utils.summary import summarize_results
+
+
+def make_results(n_rows: int) -> ResultTable:
+    rows = [
+        [f"http://ex.org/item{i}", str(i % 10), "red" if i % 3 else "blue"]
+        for i in range(n_rows)
+    ]
+    return ResultTable([["item", "size", "color"]] + rows)
+
+
+def test_summary_statistics():
+    """Test if the summary reports column statistics over all rows."""
+    summary = summarize_results(make_results(3000), token_budget=500)
+    assert summary.startswith("3000 rows, columns: item, size, color")
+    assert "size: 3000 values, 10 distinct; min 0, max 9, mean 4.5" in summary
+    assert "most frequent: red (2000), blue (1000)" in summary
+
+
+def test_summary_budget():
+    """Test if the summary size does not depend on the number of rows."""
+    for n_rows in [1000, 100000]:
+        summary = summarize_results(make_results(n_rows), token_budget=400)
+        assert 300 < estimate_tokens(summary) <= 400
+        assert "Sample of" in summary
+
+
+def test_summary_truncated_graph():
+    """Test if graph results are summarized as triples and truncation is reported."""
+    data = "".join(
+        f'<http://ex.org/{i}> <http://ex.org/p> "{i}" .\n' for i in range(500)
+    )
+    results = ResultTable([[data.encode()]])
+    results.truncated = True
+    summary = summarize_results(results, token_budget=200)
+    assert summary.startswith("500 rows (truncated, more rows exist)")
+    assert "predicate: 500 values, 1 distinct" in summary
+
+
+def test_format_results_budget():
+    """Test if only results over the token budget are summarized."""
+    small = make_results(5)
+    assert format_results(small, token_budget=500) == format_results(small)
+    (text,) = format_results(make_results(5000), token_budget=500)
+    assert text.startswith("5000 rows")